@@ -53,6 +53,8 @@ class Attack(object):
 
         # We are going to keep track of old graphs and cache them.
         self.graphs = {}
+        # The seconds spent constructing each of the cached graphs.
+        self.construct_times = {}
 
         # When calling generate_np, arguments in the following set should be
         # fed into the graph, as they are not structural items that require
@@ -68,6 +70,27 @@ class Attack(object):
         # This list should contain the names of the structural arguments.
         self.structural_kwargs = []
 
+    def model_logits(self, model, x):
+        """
+        The logits of `model` on the intermediate adversarial examples `x`.
+        Uses the reusable forward function of the model when it provides one
+        (`get_forward`), which does not keep track of the per-step inputs, so
+        it can be called in the `tf.while_loop` bodies of the attacks.
+        """
+        if hasattr(model, 'get_forward'):
+            return model.get_forward()(x)
+        return model.get_logits(x)
+
+    def build_models(self, x, *models):
+        """
+        Create the variables of the models that are not built yet (e.g. the
+        gray-box models) by `get_logits` on the inputs `x`, as the variables
+        can not be created by `model_logits` in the `tf.while_loop` bodies.
+        """
+        for model in models:
+            if hasattr(model, 'get_forward') and not model.cached:
+                model.get_logits(x)
+
     def generate(self, x, **kwargs):
         """
         Generate the attack's symbolic graph for adversarial examples. This
@@ -97,9 +120,11 @@ class Attack(object):
         # feedable keyword arguments, and check the types are one of
         # the allowed types
         import tensorflow as tf
+        import time
 
         class_name = str(self.__class__).split(".")[-1][:-2]
         _logger.info("Constructing new graph for attack " + class_name)
+        start_time = time.time()
 
         # remove the None arguments, they are just left blank
         for k in list(feedable.keys()):
@@ -127,6 +152,7 @@ class Attack(object):
         x_adv = self.generate(x, **new_kwargs)
 
         self.graphs[hash_key] = (x, new_kwargs, x_adv)
+        self.construct_times[hash_key] = time.time() - start_time
 
         if len(self.graphs) >= 10:
             warnings.warn("Calling generate_np() with multiple different "
@@ -157,7 +183,8 @@ class Attack(object):
         feed_dict = {x: x_val}
 
         for name in feedable:
-            feed_dict[new_kwargs[name]] = feedable[name]
+            if feedable[name] is not None:
+                feed_dict[new_kwargs[name]] = feedable[name]
 
         return self.sess.run(x_adv, feed_dict)
 
@@ -191,8 +218,12 @@ class Attack(object):
             # and it will have to be discarded later
             hash_key = None
         else:
-            # create a unique key for this set of fixed paramaters
-            hash_key = tuple(sorted(fixed.items()))
+            # create a unique key for this set of fixed paramaters, the
+            # set of the given feedable arguments is also structural, as only
+            # the given ones have placeholders in the graph (e.g. y/y_target)
+            hash_key = (tuple(sorted(fixed.items())),
+                        tuple(sorted(k for k, v in feedable.items()
+                                     if v is not None)))
 
         return fixed, feedable, hash_key
 
@@ -497,8 +528,9 @@ class MomentumIterativeMethod(Attack):
                                 'y': self.np_dtype,
                                 'y_target': self.np_dtype,
                                 'clip_min': self.np_dtype,
-                                'clip_max': self.np_dtype}
-        self.structural_kwargs = ['ord', 'nb_iter', 'decay_factor']
+                                'clip_max': self.np_dtype,
+                                'decay_factor': self.np_dtype}
+        self.structural_kwargs = ['ord', 'nb_iter']
 
     def generate(self, x, **kwargs):
         """
@@ -650,9 +682,11 @@ class SaliencyMapMethod(Attack):
         super(SaliencyMapMethod, self).__init__(model, back, sess, dtypestr)
 
         import tensorflow as tf
-        self.feedable_kwargs = {'y_target': self.tf_dtype}
+        self.feedable_kwargs = {'y': self.tf_dtype,
+                                'y_target': self.tf_dtype}
         self.structural_kwargs = ['theta', 'gamma',
-                                  'clip_max', 'clip_min', 'symbolic_impl']
+                                  'clip_max', 'clip_min', 'symbolic_impl',
+                                  'max_pair_features']
 
     def generate(self, x, **kwargs):
         """
@@ -664,7 +698,14 @@ class SaliencyMapMethod(Attack):
         :param gamma: (optional float) Maximum percentage of perturbed features
         :param clip_min: (optional float) Minimum component value for clipping
         :param clip_max: (optional float) Maximum component value for clipping
+        :param y: (optional) The true labels, the random targets are chosen
+                  among the other classes. Default to the model predictions
         :param y_target: (optional) Target tensor if the attack is targeted
+        :param symbolic_impl: (optional bool) Run the attack in-graph over the
+                              whole batch
+        :param max_pair_features: (optional int) Only search the pairs of
+                                  features among this number of the most
+                                  salient features in the in-graph attack
         """
         import tensorflow as tf
 
@@ -676,28 +717,20 @@ class SaliencyMapMethod(Attack):
 
             # Create random targets if y_target not provided
             if self.y_target is None:
-                from random import randint
-
-                def random_targets(gt):
-                    result = gt.copy()
-                    nb_s = gt.shape[0]
-                    nb_classes = gt.shape[1]
-
-                    for i in xrange(nb_s):
-                        result[i, :] = np.roll(result[i, :],
-                                               randint(1, nb_classes-1))
-
-                    return result
-
                 labels, nb_classes = self.get_or_guess_labels(x, kwargs)
-                self.y_target = tf.py_func(random_targets, [labels],
-                                           self.tf_dtype)
-                self.y_target.set_shape([None, nb_classes])
+                shift = tf.random_uniform([tf.shape(labels)[0]], 1,
+                                          nb_classes, dtype=tf.int32)
+                target = tf.mod(
+                    tf.cast(tf.argmax(labels, axis=1), tf.int32) + shift,
+                    nb_classes)
+                self.y_target = tf.one_hot(target, nb_classes,
+                                           dtype=self.tf_dtype)
 
             x_adv = jsma_symbolic(x, model=self.model, y_target=self.y_target,
                                   theta=self.theta, gamma=self.gamma,
                                   clip_min=self.clip_min,
-                                  clip_max=self.clip_max)
+                                  clip_max=self.clip_max,
+                                  max_pair_features=self.max_pair_features)
         else:
             from .attacks_tf import jacobian_graph, jsma_batch
 
@@ -731,7 +764,7 @@ class SaliencyMapMethod(Attack):
 
     def parse_params(self, theta=1., gamma=1., nb_classes=None,
                      clip_min=0., clip_max=1., y_target=None,
-                     symbolic_impl=True, **kwargs):
+                     symbolic_impl=True, max_pair_features=1024, **kwargs):
         """
         Take in a dictionary of parameters and applies attack-specific checks
         before saving them as attributes.
@@ -745,6 +778,12 @@ class SaliencyMapMethod(Attack):
         :param clip_min: (optional float) Minimum component value for clipping
         :param clip_max: (optional float) Maximum component value for clipping
         :param y_target: (optional) Target tensor if the attack is targeted
+        :param symbolic_impl: (optional bool) Run the attack in-graph over the
+                              whole batch
+        :param max_pair_features: (optional int) Only search the pairs of
+                                  features among this number of the most
+                                  salient features in the in-graph attack,
+                                  None to search among all the features
         """
 
         if nb_classes is not None:
@@ -756,6 +795,7 @@ class SaliencyMapMethod(Attack):
         self.clip_max = clip_max
         self.y_target = y_target
         self.symbolic_impl = symbolic_impl
+        self.max_pair_features = max_pair_features
 
         return True
 
@@ -857,7 +897,8 @@ class CarliniWagnerL2(Attack):
                                   'targeted', 'learning_rate',
                                   'binary_search_steps', 'max_iterations',
                                   'abort_early', 'initial_const',
-                                  'clip_min', 'clip_max']
+                                  'clip_min', 'clip_max',
+                                  'num_parallel_consts']
 
     def generate(self, x, **kwargs):
         """
@@ -897,6 +938,11 @@ class CarliniWagnerL2(Attack):
                               this constant gives lower distortion results.
         :param clip_min: (optional float) Minimum input component value
         :param clip_max: (optional float) Maximum input component value
+        :param num_parallel_consts: Number of tradeoff-constants optimized
+                                    simultaneously for every input in one
+                                    session call per iteration. Set it to
+                                    `binary_search_steps` to try all the
+                                    constants in one round.
         """
         import tensorflow as tf
         from .attacks_tf import CarliniWagnerL2 as CWL2
@@ -909,7 +955,8 @@ class CarliniWagnerL2(Attack):
                       self.learning_rate, self.binary_search_steps,
                       self.max_iterations, self.abort_early,
                       self.initial_const, self.clip_min, self.clip_max,
-                      nb_classes, x.get_shape().as_list()[1:])
+                      nb_classes, x.get_shape().as_list()[1:],
+                      num_parallel_consts=self.num_parallel_consts)
 
         def cw_wrap(x_val, y_val):
             return np.array(attack.attack(x_val, y_val), dtype=self.np_dtype)
@@ -922,7 +969,7 @@ class CarliniWagnerL2(Attack):
                      learning_rate=5e-3,
                      binary_search_steps=5, max_iterations=1000,
                      abort_early=True, initial_const=1e-2,
-                     clip_min=0, clip_max=1):
+                     clip_min=0, clip_max=1, num_parallel_consts=1):
 
         # ignore the y and y_target argument
         if nb_classes is not None:
@@ -937,6 +984,7 @@ class CarliniWagnerL2(Attack):
         self.initial_const = initial_const
         self.clip_min = clip_min
         self.clip_max = clip_max
+        self.num_parallel_consts = num_parallel_consts
 
 
 class ElasticNetMethod(Attack):
@@ -1102,27 +1150,37 @@ class DeepFool(Attack):
         """
 
         import tensorflow as tf
-        from .attacks_tf import jacobian_graph, deepfool_batch
+        from .attacks_tf import (jacobian_graph, deepfool_batch,
+                                 deepfool_perturbation_graph)
 
         # Parse and save attack-specific parameters
         assert self.parse_params(**kwargs)
 
-        # Define graph wrt to this input placeholder
-        logits = self.model.get_logits(x)
+        # Define graph wrt to this input placeholder, only the examples that
+        # are not fooled yet are fed in every iteration, so the batch size of
+        # the placeholder is not fixed even when that of `x` is
+        x_ph = tf.placeholder(self.tf_dtype,
+                              [None] + x.get_shape().as_list()[1:])
+        logits = self.model.get_logits(x_ph)
         self.nb_classes = logits.get_shape().as_list()[-1]
         assert self.nb_candidate <= self.nb_classes,\
             'nb_candidate should not be greater than nb_classes'
         preds = tf.reshape(tf.nn.top_k(logits, k=self.nb_candidate)[0],
                            [-1, self.nb_candidate])
         # grads will be the shape [batch_size, nb_candidate, image_size]
-        grads = tf.stack(jacobian_graph(preds, x, self.nb_candidate), axis=1)
+        grads = tf.stack(jacobian_graph(preds, x_ph, self.nb_candidate),
+                         axis=1)
+        # the labels and the perturbations are fetched by one call per
+        # iteration
+        current = tf.argmax(logits, axis=1)
+        perturbation = tf.cast(deepfool_perturbation_graph(preds, grads),
+                               self.tf_dtype)
 
         # Define graph
         def deepfool_wrap(x_val):
-            return deepfool_batch(self.sess, x, preds, logits, grads, x_val,
-                                  self.nb_candidate, self.overshoot,
-                                  self.max_iter, self.clip_min, self.clip_max,
-                                  self.nb_classes)
+            return deepfool_batch(self.sess, x_ph, current, perturbation,
+                                  x_val, self.overshoot, self.max_iter,
+                                  self.clip_min, self.clip_max)
         return tf.py_func(deepfool_wrap, [x], self.tf_dtype)
 
     def parse_params(self, nb_candidate=10, overshoot=0.02, max_iter=50,
@@ -1171,7 +1229,8 @@ class LBFGS(Attack):
         self.feedable_kwargs = {'y_target': self.tf_dtype}
         self.structural_kwargs = ['batch_size', 'binary_search_steps',
                                   'max_iterations', 'initial_const',
-                                  'clip_min', 'clip_max']
+                                  'clip_min', 'clip_max', 'history_size',
+                                  'max_line_search']
 
     def generate(self, x, **kwargs):
         """
@@ -1192,18 +1251,22 @@ class LBFGS(Attack):
                               and cross-entropy loss of the classification.
         :param clip_min: (optional float) Minimum input component value
         :param clip_max: (optional float) Maximum input component value
+        :param history_size: The number of curvature pairs kept by L-BFGS.
+        :param max_line_search: The maximum number of backtracking steps of
+                                the line search in every iteration.
         """
         import tensorflow as tf
         from .attacks_tf import LBFGS_attack
         self.parse_params(**kwargs)
 
         _, nb_classes = self.get_or_guess_labels(x, kwargs)
+        self.build_models(x, self.model)
 
-        attack = LBFGS_attack(self.sess, x, self.model.get_probs(x),
-                              self.y_target, self.binary_search_steps,
-                              self.max_iterations, self.initial_const,
-                              self.clip_min, self.clip_max, nb_classes,
-                              self.batch_size)
+        attack = LBFGS_attack(self.sess, x, self.model, self.y_target,
+                              self.binary_search_steps, self.max_iterations,
+                              self.initial_const, self.clip_min,
+                              self.clip_max, nb_classes, self.batch_size,
+                              self.history_size, self.max_line_search)
 
         def lbfgs_wrap(x_val, y_val):
             return np.array(attack.attack(x_val, y_val), dtype=self.np_dtype)
@@ -1213,7 +1276,8 @@ class LBFGS(Attack):
 
     def parse_params(self, y_target=None, batch_size=1,
                      binary_search_steps=5, max_iterations=1000,
-                     initial_const=1e-2, clip_min=0, clip_max=1):
+                     initial_const=1e-2, clip_min=0, clip_max=1,
+                     history_size=10, max_line_search=20):
 
         self.y_target = y_target
         self.batch_size = batch_size
@@ -1222,6 +1286,8 @@ class LBFGS(Attack):
         self.initial_const = initial_const
         self.clip_min = clip_min
         self.clip_max = clip_max
+        self.history_size = history_size
+        self.max_line_search = max_line_search
 
 
 def vatm(model, x, logits, eps, back='tf', num_iterations=1, xi=1e-6,
@@ -1272,8 +1338,9 @@ class MadryEtAl(Attack):
                                 'y': self.np_dtype,
                                 'y_target': self.np_dtype,
                                 'clip_min': self.np_dtype,
-                                'clip_max': self.np_dtype}
-        self.structural_kwargs = ['ord', 'nb_iter', 'rand_init']
+                                'clip_max': self.np_dtype,
+                                'rand_init': self.np_dtype}
+        self.structural_kwargs = ['ord', 'nb_iter', 'nb_restart']
 
     def generate(self, x, **kwargs):
         """
@@ -1294,6 +1361,9 @@ class MadryEtAl(Attack):
         :param clip_max: (optional float) Maximum input component value
         :param rand_init: (optional bool) If True, an initial random
                     perturbation is added.
+        :param nb_restart: (optional int) Number of random restarts, the
+                    strongest adversarial example of every input is
+                    returned.
         """
 
         # Parse and save attack-specific parameters
@@ -1301,6 +1371,10 @@ class MadryEtAl(Attack):
 
         labels, nb_classes = self.get_or_guess_labels(x, kwargs)
         self.targeted = self.y_target is not None
+        self.build_models(x, self.model, getattr(self, 'transfer_model', None))
+
+        if self.nb_restart > 1:
+            return self.attack_restarts(x, labels)
 
         # Initialize loop variables
         adv_x = self.attack(x, labels)
@@ -1309,7 +1383,7 @@ class MadryEtAl(Attack):
 
     def parse_params(self, eps=0.3, eps_iter=0.01, nb_iter=40, y=None,
                      ord=np.inf, clip_min=None, clip_max=None,
-                     y_target=None, rand_init=True, **kwargs):
+                     y_target=None, rand_init=True, nb_restart=1, **kwargs):
         """
         Take in a dictionary of parameters and applies attack-specific checks
         before saving them as attributes.
@@ -1330,6 +1404,9 @@ class MadryEtAl(Attack):
         :param clip_max: (optional float) Maximum input component value
         :param rand_init: (optional bool) If True, an initial random
                     perturbation is added.
+        :param nb_restart: (optional int) Number of random restarts, the
+                    strongest adversarial example of every input is
+                    returned.
         """
 
         # Save attack-specific parameters
@@ -1342,6 +1419,7 @@ class MadryEtAl(Attack):
         self.clip_min = clip_min
         self.clip_max = clip_max
         self.rand_init = rand_init
+        self.nb_restart = nb_restart
 
         if self.y is not None and self.y_target is not None:
             raise ValueError("Must not set both y and y_target")
@@ -1365,11 +1443,12 @@ class MadryEtAl(Attack):
         from cleverhans.loss import attack_softmax_cross_entropy
 
         adv_x = x + eta
-        logits = self.model.get_logits(adv_x)
+        logits = self.model_logits(self.model, adv_x)
         loss = attack_softmax_cross_entropy(y, logits)
         if self.targeted:
             loss = -loss
-        grad, = tf.gradients(loss, adv_x)
+        # scale the loss of half precision models to avoid gradient underflow, the sign is not affected
+        grad, = tf.gradients(loss * getattr(self.model, "loss_scale", 1.), adv_x)
         scaled_signed_grad = self.eps_iter * tf.sign(grad)
         adv_x = adv_x + scaled_signed_grad
         if self.clip_min is not None and self.clip_max is not None:
@@ -1378,6 +1457,26 @@ class MadryEtAl(Attack):
         eta = clip_eta(eta, self.ord, self.eps)
         return eta
 
+    def initial_eta(self, x):
+        """
+        The initial perturbation. `rand_init` can be a python bool or a
+        fed scalar (0 or 1), in which case the graph is shared by both.
+
+        :param x: A tensor with the input image.
+        """
+        import tensorflow as tf
+        from cleverhans.utils_tf import clip_eta
+
+        if isinstance(self.rand_init, bool):
+            if not self.rand_init:
+                return tf.zeros_like(x)
+            rand_init = 1
+        else:
+            rand_init = tf.cast(self.rand_init, self.tf_dtype)
+        eta = tf.random_uniform(tf.shape(x), -self.eps, self.eps,
+                                dtype=self.tf_dtype)
+        return clip_eta(eta, self.ord, self.eps) * rand_init
+
     def attack(self, x, y):
         """
         This method creates a symbolic graph that given an input image,
@@ -1389,17 +1488,13 @@ class MadryEtAl(Attack):
         :param x: A tensor with the input image.
         """
         import tensorflow as tf
-        from cleverhans.utils_tf import clip_eta
 
-        if self.rand_init:
-            eta = tf.random_uniform(tf.shape(x), -self.eps, self.eps,
-                                    dtype=self.tf_dtype)
-            eta = clip_eta(eta, self.ord, self.eps)
-        else:
-            eta = tf.zeros_like(x)
+        eta = self.initial_eta(x)
 
-        for i in range(self.nb_iter):
-            eta = self.attack_single_step(x, eta, y)
+        _, eta = tf.while_loop(
+            lambda i, _: i < self.nb_iter,
+            lambda i, eta: [i + 1, self.attack_single_step(x, eta, y)],
+            [0, eta], back_prop=False)
 
         adv_x = x + eta
         if self.clip_min is not None and self.clip_max is not None:
@@ -1407,6 +1502,47 @@ class MadryEtAl(Attack):
 
         return adv_x
 
+    def attack_restarts(self, x, y):
+        """
+        Run `nb_restart` random restarts of the attack side by side on the
+        batch tiled restart-major, and select the strongest adversarial
+        example of every input in the graph: the first restart that fools
+        the model, otherwise the one with the highest loss.
+
+        :param x: A tensor with the input image.
+        :param y: A tensor with the target labels or ground-truth labels.
+        """
+        import tensorflow as tf
+        from cleverhans.loss import attack_softmax_cross_entropy
+
+        def tile(t):
+            return tf.tile(t, [self.nb_restart] + [1] * (len(t.shape) - 1))
+
+        batch_size = tf.shape(x)[0]
+        adv_x = self.attack(tile(x), tile(y))
+
+        # select with the model whose gradients are used by the attack
+        model = getattr(self, 'transfer_model', None)
+        if model is None:
+            model = self.model
+        logits = model.get_logits(adv_x)
+        loss = attack_softmax_cross_entropy(tile(y), logits, mean=False)
+        success = tf.equal(tf.argmax(logits, axis=-1),
+                           tf.argmax(tile(y), axis=-1))
+        if self.targeted:
+            loss = -loss
+        else:
+            success = tf.logical_not(success)
+        loss = tf.reshape(loss, [self.nb_restart, -1])
+        success = tf.reshape(success, [self.nb_restart, -1])
+
+        first_success = tf.argmax(tf.cast(success, tf.int32), axis=0)
+        highest_loss = tf.argmax(loss, axis=0)
+        best = tf.where(reduce_any(success, axis=0), first_success,
+                        highest_loss)
+        index = tf.cast(best, tf.int32) * batch_size + tf.range(batch_size)
+        return tf.gather(adv_x, index)
+
 
 class FastFeatureAdversaries(Attack):
     """
@@ -1564,50 +1700,83 @@ class SPSA(Attack):
     def __init__(self, model, back='tf', sess=None, dtypestr='float32'):
         super(SPSA, self).__init__(model, back, sess, dtypestr)
         assert isinstance(self.model, Model)
+        self.feedable_kwargs = {'y': self.np_dtype,
+                                'y_target': self.np_dtype,
+                                'epsilon': self.np_dtype,
+                                'learning_rate': self.np_dtype,
+                                'delta': self.np_dtype,
+                                'clip_min': self.np_dtype,
+                                'clip_max': self.np_dtype}
+        self.structural_kwargs = ['num_steps', 'is_targeted',
+                                  'early_stop_loss_threshold', 'batch_size',
+                                  'spsa_iters', 'is_debug']
 
     def generate(self, x, y=None, y_target=None, epsilon=None, num_steps=None,
                  is_targeted=False, early_stop_loss_threshold=None,
                  learning_rate=0.01, delta=0.01, batch_size=128, spsa_iters=1,
-                 is_debug=False):
+                 is_debug=False, clip_min=0., clip_max=1.):
         """
         Generate symbolic graph for adversarial examples.
 
-        :param x: The model's symbolic inputs. Must be a batch of size 1.
-        :param y: A Tensor or None. The index of the correct label.
-        :param y_target: A Tensor or None. The index of the target label in a
-                         targeted attack.
+        :param x: The model's symbolic inputs, a batch of images.
+        :param y: A Tensor or None. The correct labels, as indices or one-hot.
+                  Default to the model's predictions.
+        :param y_target: A Tensor or None. The target labels in a targeted
+                         attack, as indices or one-hot.
         :param epsilon: The size of the maximum perturbation, measured in the
                         L-infinity norm.
         :param num_steps: The number of optimization steps.
         :param is_targeted: Whether to use a targeted or untargeted attack.
+                            Implied when `y_target` is given.
         :param early_stop_loss_threshold: A float or None. If specified, the
-                                          attack will end as soon as the loss
-                                          is below `early_stop_loss_threshold`.
+                                          attack of every image ends as soon
+                                          as its loss is below
+                                          `early_stop_loss_threshold`.
         :param learning_rate: Learning rate of ADAM optimizer.
         :param delta: Perturbation size used for SPSA approximation.
-        :param batch_size: Number of inputs to evaluate at a single time. Note
-                           that the true batch size (the number of evaluated
-                           inputs for each update) is `batch_size * spsa_iters`
+        :param batch_size: Number of SPSA samples evaluated at a single time
+                           for every image. Note that the true number of
+                           evaluated inputs for each update is
+                           `batch_size * spsa_iters * number of images`
         :param spsa_iters: Number of model evaluations before performing an
                            update, where each evaluation is on `batch_size`
                            different inputs.
         :param is_debug: If True, print the adversarial loss after each update.
+        :param clip_min: Minimum input component value.
+        :param clip_max: Maximum input component value.
         """
         from .attacks_tf import SPSAAdam, pgd_attack, margin_logit_loss
+        from .attacks_tf import _project_perturbation
+        import tensorflow as tf
 
         optimizer = SPSAAdam(lr=learning_rate, delta=delta,
                              num_samples=batch_size, num_iters=spsa_iters)
+        is_targeted = is_targeted or y_target is not None
 
         def loss_fn(x, label):
-            logits = self.model.get_logits(x)
+            logits = self.model_logits(self.model, x)
             loss_multiplier = 1 if is_targeted else -1
             return loss_multiplier * margin_logit_loss(
-                logits, label, num_classes=self.model.num_classes)
+                logits, label,
+                num_classes=logits.get_shape().as_list()[-1])
+
+        def project_perturbation(perturbation, epsilon, input_image):
+            return _project_perturbation(perturbation, epsilon, input_image,
+                                         clip_min, clip_max)
 
-        y_attack = y_target if is_targeted else y
+        if is_targeted:
+            y_attack = y_target
+        elif y is not None:
+            y_attack = y
+        else:
+            y_attack, _ = self.get_or_guess_labels(x, {})
+        if y_attack.get_shape().ndims == 2:  # one-hot labels
+            y_attack = tf.argmax(y_attack, axis=-1)
+        self.build_models(x, self.model)
         adv_x = pgd_attack(
             loss_fn, x, y_attack, epsilon, num_steps=num_steps,
             optimizer=optimizer,
+            project_perturbation=project_perturbation,
             early_stop_loss_threshold=early_stop_loss_threshold,
             is_debug=is_debug,
         )
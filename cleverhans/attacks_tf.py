@@ -414,7 +414,8 @@ def jsma_batch(sess, x, pred, grads, X, theta, gamma, clip_min, clip_max,
     return np.asarray(X_adv, dtype=np_dtype)
 
 
-def jsma_symbolic(x, y_target, model, theta, gamma, clip_min, clip_max):
+def jsma_symbolic(x, y_target, model, theta, gamma, clip_min, clip_max,
+                  max_pair_features=None):
     """
     TensorFlow implementation of the JSMA (see https://arxiv.org/abs/1511.07528
     for details about the algorithm design choices).
@@ -427,16 +428,23 @@ def jsma_symbolic(x, y_target, model, theta, gamma, clip_min, clip_max):
         percentage
     :param clip_min: minimum value for components of the example returned
     :param clip_max: maximum value for components of the example returned
+    :param max_pair_features: (optional) the pairs of features are only
+        searched among the `max_pair_features` most salient single features,
+        which bounds the memory of the pair scores to
+        [batch_size, max_pair_features, max_pair_features]. Default to search
+        among all the features
     :return: a tensor for the adversarial example
     """
 
     nb_classes = int(y_target.shape[-1].value)
     nb_features = int(np.product(x.shape[1:]).value)
+    nb_pair = nb_features if max_pair_features is None \
+        else min(nb_features, max_pair_features)
 
     max_iters = np.floor(nb_features * gamma / 2)
     increase = bool(theta > 0)
 
-    tmp = np.ones((nb_features, nb_features), int)
+    tmp = np.ones((nb_pair, nb_pair), int)
     np.fill_diagonal(tmp, 0)
     zero_diagonal = tf.constant(tmp, tf_dtype)
 
@@ -470,24 +478,16 @@ def jsma_symbolic(x, y_target, model, theta, gamma, clip_min, clip_max):
         preds = model.get_probs(x_in)
         preds_onehot = tf.one_hot(tf.argmax(preds, axis=1), depth=nb_classes)
 
-        # create the Jacobian graph
-        list_derivatives = []
-        for class_ind in xrange(nb_classes):
-            derivatives = tf.gradients(preds[:, class_ind], x_in)
-            list_derivatives.append(derivatives[0])
-        grads = tf.reshape(tf.stack(list_derivatives),
-                           shape=[nb_classes, -1, nb_features])
-
-        # Compute the Jacobian components
-        # To help with the computation later, reshape the target_class
-        # and other_class to [nb_classes, -1, 1].
-        # The last dimention is added to allow broadcasting later.
-        target_class = tf.reshape(tf.transpose(y_in, perm=[1, 0]),
-                                  shape=[nb_classes, -1, 1])
-        other_classes = tf.cast(tf.not_equal(target_class, 1), tf_dtype)
-
-        grads_target = reduce_sum(grads * target_class, axis=0)
-        grads_other = reduce_sum(grads * other_classes, axis=0)
+        # Compute the Jacobian components. The target and the other classes
+        # are summed before differentiation, so only two gradients are
+        # computed instead of the full Jacobian of nb_classes gradients
+        other_classes = tf.cast(tf.not_equal(y_in, 1), tf_dtype)
+        grads_target, = tf.gradients(
+            reduce_sum(tf.cast(preds, tf_dtype) * y_in), x_in)
+        grads_other, = tf.gradients(
+            reduce_sum(tf.cast(preds, tf_dtype) * other_classes), x_in)
+        grads_target = tf.reshape(grads_target, [-1, nb_features])
+        grads_other = tf.reshape(grads_other, [-1, nb_features])
 
         # Remove the already-used input features from the search space
         # Subtract 2 times the maximum value from those value so that
@@ -498,14 +498,27 @@ def jsma_symbolic(x, y_target, model, theta, gamma, clip_min, clip_max):
         target_tmp = grads_target
         target_tmp -= increase_coef \
             * reduce_max(tf.abs(grads_target), axis=1, keepdims=True)
-        target_sum = tf.reshape(target_tmp, shape=[-1, nb_features, 1]) \
-            + tf.reshape(target_tmp, shape=[-1, 1, nb_features])
 
         other_tmp = grads_other
         other_tmp += increase_coef \
             * reduce_max(tf.abs(grads_other), axis=1, keepdims=True)
-        other_sum = tf.reshape(other_tmp, shape=[-1, nb_features, 1]) \
-            + tf.reshape(other_tmp, shape=[-1, 1, nb_features])
+
+        if nb_pair < nb_features:
+            # Only keep the features that are the most salient alone
+            saliency = target_tmp - other_tmp if increase \
+                else other_tmp - target_tmp
+            _, candidates = tf.nn.top_k(saliency, k=nb_pair, sorted=False)
+            flat_candidates = candidates + nb_features * tf.expand_dims(
+                tf.range(tf.shape(candidates)[0]), 1)
+            target_tmp = tf.gather(tf.reshape(target_tmp, [-1]),
+                                   flat_candidates)
+            other_tmp = tf.gather(tf.reshape(other_tmp, [-1]),
+                                  flat_candidates)
+
+        target_sum = tf.reshape(target_tmp, shape=[-1, nb_pair, 1]) \
+            + tf.reshape(target_tmp, shape=[-1, 1, nb_pair])
+        other_sum = tf.reshape(other_tmp, shape=[-1, nb_pair, 1]) \
+            + tf.reshape(other_tmp, shape=[-1, 1, nb_pair])
 
         # Create a mask to only keep features that match conditions
         if increase:
@@ -518,12 +531,17 @@ def jsma_symbolic(x, y_target, model, theta, gamma, clip_min, clip_max):
             * (-target_sum * other_sum) * zero_diagonal
 
         # Extract the best two pixels
-        best = tf.argmax(
-                    tf.reshape(scores, shape=[-1, nb_features * nb_features]),
-                    axis=1)
-
-        p1 = tf.mod(best, nb_features)
-        p2 = tf.floordiv(best, nb_features)
+        best = tf.cast(tf.argmax(
+                    tf.reshape(scores, shape=[-1, nb_pair * nb_pair]),
+                    axis=1), tf.int32)
+
+        p1 = tf.mod(best, nb_pair)
+        p2 = tf.floordiv(best, nb_pair)
+        if nb_pair < nb_features:
+            # Map the candidate indices back to the feature indices
+            offsets = nb_pair * tf.range(tf.shape(best)[0])
+            p1 = tf.gather(tf.reshape(candidates, [-1]), p1 + offsets)
+            p2 = tf.gather(tf.reshape(candidates, [-1]), p2 + offsets)
         p1_one_hot = tf.one_hot(p1, depth=nb_features)
         p2_one_hot = tf.one_hot(p2, depth=nb_features)
 
@@ -614,7 +632,8 @@ class CarliniWagnerL2(object):
                  targeted, learning_rate,
                  binary_search_steps, max_iterations,
                  abort_early, initial_const,
-                 clip_min, clip_max, num_labels, shape):
+                 clip_min, clip_max, num_labels, shape,
+                 num_parallel_consts=1):
         """
         Return a tensor that constructs adversarial examples for the given
         input. Generate uses tf.py_func in order to operate over tensors.
@@ -654,6 +673,15 @@ class CarliniWagnerL2(object):
         :param clip_max: (optional float) Maximum input component value.
         :param num_labels: the number of classes in the model's output.
         :param shape: the shape of the model's input tensor.
+        :param num_parallel_consts: Number of tradeoff-constants optimized
+                                    simultaneously for every instance, in the
+                                    same session calls. The binary search
+                                    runs `ceil(binary_search_steps /
+                                    num_parallel_consts)` rounds, and every
+                                    round narrows the search interval of
+                                    every instance with all the constants
+                                    of the round. 1 is the sequential
+                                    binary search.
         """
 
         self.sess = sess
@@ -668,48 +696,73 @@ class CarliniWagnerL2(object):
         self.clip_min = clip_min
         self.clip_max = clip_max
         self.model = model
+        self.num_consts = num_consts = max(
+            1, min(num_parallel_consts, binary_search_steps))
+        self.num_rounds = int(np.ceil(binary_search_steps /
+                                      float(num_consts)))
 
         self.repeat = binary_search_steps >= 10
 
         self.shape = shape = tuple([batch_size] + list(shape))
+        # the instances are tiled for the constants, constant-major
+        tiled_shape = tuple([num_consts * batch_size] + list(shape[1:]))
+
+        def tile(t):
+            return tf.tile(t, [num_consts] + [1] * (len(t.shape) - 1))
 
         # the variable we're going to optimize over
-        modifier = tf.Variable(np.zeros(shape, dtype=np_dtype))
+        modifier = tf.Variable(np.zeros(tiled_shape, dtype=np_dtype))
 
         # these are variables to be more efficient in sending data to tf
         self.timg = tf.Variable(np.zeros(shape), dtype=tf_dtype,
                                 name='timg')
         self.tlab = tf.Variable(np.zeros((batch_size, num_labels)),
                                 dtype=tf_dtype, name='tlab')
-        self.const = tf.Variable(np.zeros(batch_size), dtype=tf_dtype,
-                                 name='const')
+        self.const = tf.Variable(np.zeros(num_consts * batch_size),
+                                 dtype=tf_dtype, name='const')
+
+        # the best results are tracked in-graph, so that only the scalar loss
+        # is fetched in every iteration:
+        # whether the attack with every constant succeeded in this round
+        self.round_success = tf.Variable(np.zeros(num_consts * batch_size),
+                                         dtype=tf_dtype, trainable=False,
+                                         name='round_success')
+        # the best l2 distance and instance of every instance
+        self.o_bestl2 = tf.Variable(np.zeros(batch_size), dtype=tf_dtype,
+                                    trainable=False, name='o_bestl2')
+        self.o_bestattack = tf.Variable(np.zeros(shape), dtype=tf_dtype,
+                                        trainable=False, name='o_bestattack')
 
         # and here's what we use to assign them
         self.assign_timg = tf.placeholder(tf_dtype, shape,
                                           name='assign_timg')
         self.assign_tlab = tf.placeholder(tf_dtype, (batch_size, num_labels),
                                           name='assign_tlab')
-        self.assign_const = tf.placeholder(tf_dtype, [batch_size],
+        self.assign_const = tf.placeholder(tf_dtype,
+                                           [num_consts * batch_size],
                                            name='assign_const')
+        self.assign_oimg = tf.placeholder(tf_dtype, shape,
+                                          name='assign_oimg')
 
         # the resulting instance, tanh'd to keep bounded from clip_min
         # to clip_max
-        self.newimg = (tf.tanh(modifier + self.timg) + 1) / 2
+        self.newimg = (tf.tanh(modifier + tile(self.timg)) + 1) / 2
         self.newimg = self.newimg * (clip_max - clip_min) + clip_min
 
         # prediction BEFORE-SOFTMAX of the model
         self.output = model.get_logits(self.newimg)
 
         # distance to the input data
-        self.other = (tf.tanh(self.timg) + 1) / \
+        self.other = (tf.tanh(tile(self.timg)) + 1) / \
             2 * (clip_max - clip_min) + clip_min
         self.l2dist = reduce_sum(tf.square(self.newimg - self.other),
                                  list(range(1, len(shape))))
 
         # compute the probability of the label class versus the maximum other
-        real = reduce_sum((self.tlab) * self.output, 1)
+        tlab = tile(self.tlab)
+        real = reduce_sum((tlab) * self.output, 1)
         other = reduce_max(
-            (1 - self.tlab) * self.output - self.tlab * 10000,
+            (1 - tlab) * self.output - tlab * 10000,
             1)
 
         if self.TARGETED:
@@ -724,6 +777,30 @@ class CarliniWagnerL2(object):
         self.loss1 = reduce_sum(self.const * loss1)
         self.loss = self.loss1 + self.loss2
 
+        # whether the instances are adversarial (with the confidence margin)
+        lab = tf.argmax(tlab, 1)
+        if self.TARGETED:
+            pred = tf.argmax(self.output - tlab * self.CONFIDENCE, 1)
+            success = tf.equal(pred, lab)
+        else:
+            pred = tf.argmax(self.output + tlab * self.CONFIDENCE, 1)
+            success = tf.not_equal(pred, lab)
+        # the best successful instance among the constants of every instance
+        success_l2 = tf.reshape(
+            tf.where(success, self.l2dist, 1e10 * tf.ones_like(self.l2dist)),
+            [num_consts, batch_size])
+        best_l2 = reduce_min(success_l2, 0)
+        best_rows = tf.to_int32(tf.argmin(success_l2, 0)) * batch_size + \
+            tf.range(batch_size)
+        improved = tf.less(best_l2, self.o_bestl2)
+        self.update_best = tf.group(
+            self.round_success.assign(tf.maximum(
+                self.round_success, tf.cast(success, tf_dtype))),
+            self.o_bestl2.assign(tf.where(improved, best_l2, self.o_bestl2)),
+            self.o_bestattack.assign(tf.where(
+                improved, tf.gather(self.newimg, best_rows),
+                self.o_bestattack)))
+
         # Setup the adam optimizer and keep track of variables we're creating
         start_vars = set(x.name for x in tf.global_variables())
         optimizer = tf.train.AdamOptimizer(self.LEARNING_RATE)
@@ -736,6 +813,11 @@ class CarliniWagnerL2(object):
         self.setup.append(self.timg.assign(self.assign_timg))
         self.setup.append(self.tlab.assign(self.assign_tlab))
         self.setup.append(self.const.assign(self.assign_const))
+        self.setup.append(self.round_success.assign(
+            tf.zeros_like(self.round_success)))
+        self.setup_best = [
+            self.o_bestl2.assign(1e10 * tf.ones_like(self.o_bestl2)),
+            self.o_bestattack.assign(self.assign_oimg)]
 
         self.init = tf.variables_initializer(var_list=[modifier] + new_vars)
 
@@ -751,28 +833,23 @@ class CarliniWagnerL2(object):
         for i in range(0, len(imgs), self.batch_size):
             _logger.debug(("Running CWL2 attack on instance " +
                            "{} of {}").format(i, len(imgs)))
-            r.extend(self.attack_batch(imgs[i:i + self.batch_size],
-                                       targets[i:i + self.batch_size]))
+            batch = imgs[i:i + self.batch_size]
+            batchlab = targets[i:i + self.batch_size]
+            num = len(batch)
+            if num < self.batch_size:
+                # pad the last batch with its first instance
+                pad = [0] * (self.batch_size - num)
+                batch = np.concatenate([batch, batch[pad]])
+                batchlab = np.concatenate([batchlab, batchlab[pad]])
+            r.extend(self.attack_batch(batch, batchlab)[:num])
         return np.array(r)
 
     def attack_batch(self, imgs, labs):
         """
         Run the attack on a batch of instance and labels.
         """
-        def compare(x, y):
-            if not isinstance(x, (float, int, np.int64)):
-                x = np.copy(x)
-                if self.TARGETED:
-                    x[y] -= self.CONFIDENCE
-                else:
-                    x[y] += self.CONFIDENCE
-                x = np.argmax(x)
-            if self.TARGETED:
-                return x == y
-            else:
-                return x != y
-
         batch_size = self.batch_size
+        num_consts = self.num_consts
 
         oimgs = np.clip(imgs, self.clip_min, self.clip_max)
 
@@ -786,48 +863,39 @@ class CarliniWagnerL2(object):
 
         # set the lower and upper bounds accordingly
         lower_bound = np.zeros(batch_size)
-        CONST = np.ones(batch_size) * self.initial_const
         upper_bound = np.ones(batch_size) * 1e10
+        # the constants of every instance: [num_consts, batch size].
+        # The parallel constants start from the successive magnitudes that
+        # the sequential search tries while no solution is found.
+        CONST = self.initial_const * np.tile(
+            10. ** np.arange(num_consts)[:, np.newaxis], (1, batch_size))
 
-        # placeholders for the best l2, score, and instance attack found so far
-        o_bestl2 = [1e10] * batch_size
-        o_bestscore = [-1] * batch_size
-        o_bestattack = np.copy(oimgs)
+        self.sess.run(self.setup_best, {self.assign_oimg: oimgs})
 
-        for outer_step in range(self.BINARY_SEARCH_STEPS):
+        for outer_step in range(self.num_rounds):
             # completely reset adam's internal state.
             self.sess.run(self.init)
-            batch = imgs[:batch_size]
-            batchlab = labs[:batch_size]
-
-            bestl2 = [1e10] * batch_size
-            bestscore = [-1] * batch_size
-            _logger.debug("  Binary search step {} of {}".
-                          format(outer_step, self.BINARY_SEARCH_STEPS))
+            _logger.debug("  Binary search round {} of {}".
+                          format(outer_step, self.num_rounds))
 
             # The last iteration (if we run many steps) repeat the search once.
-            if self.repeat and outer_step == self.BINARY_SEARCH_STEPS - 1:
-                CONST = upper_bound
+            if self.repeat and outer_step == self.num_rounds - 1:
+                CONST[0] = upper_bound
 
             # set the variables so that we don't have to send them over again
-            self.sess.run(self.setup, {self.assign_timg: batch,
-                                       self.assign_tlab: batchlab,
-                                       self.assign_const: CONST})
+            self.sess.run(self.setup, {self.assign_timg: imgs,
+                                       self.assign_tlab: labs,
+                                       self.assign_const: CONST.reshape(-1)})
 
             prev = 1e6
             for iteration in range(self.MAX_ITERATIONS):
-                # perform the attack
-                _, l, l2s, scores, nimg = self.sess.run([self.train,
-                                                         self.loss,
-                                                         self.l2dist,
-                                                         self.output,
-                                                         self.newimg])
+                # perform the attack, and track the best results
+                _, _, l = self.sess.run([self.train, self.update_best,
+                                         self.loss])
 
                 if iteration % ((self.MAX_ITERATIONS // 10) or 1) == 0:
-                    _logger.debug(("    Iteration {} of {}: loss={:.3g} " +
-                                   "l2={:.3g} f={:.3g}")
-                                  .format(iteration, self.MAX_ITERATIONS,
-                                          l, np.mean(l2s), np.mean(scores)))
+                    _logger.debug(("    Iteration {} of {}: loss={:.3g}")
+                                  .format(iteration, self.MAX_ITERATIONS, l))
 
                 # check if we should abort search if we're getting nowhere.
                 if self.ABORT_EARLY and \
@@ -838,42 +906,35 @@ class CarliniWagnerL2(object):
                         break
                     prev = l
 
-                # adjust the best result found so far
-                for e, (l2, sc, ii) in enumerate(zip(l2s, scores, nimg)):
-                    lab = np.argmax(batchlab[e])
-                    if l2 < bestl2[e] and compare(sc, lab):
-                        bestl2[e] = l2
-                        bestscore[e] = np.argmax(sc)
-                    if l2 < o_bestl2[e] and compare(sc, lab):
-                        o_bestl2[e] = l2
-                        o_bestscore[e] = np.argmax(sc)
-                        o_bestattack[e] = ii
-
-            # adjust the constant as needed
-            for e in range(batch_size):
-                if compare(bestscore[e], np.argmax(batchlab[e])) and \
-                   bestscore[e] != -1:
-                    # success, divide const by two
-                    upper_bound[e] = min(upper_bound[e], CONST[e])
-                    if upper_bound[e] < 1e9:
-                        CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-                else:
-                    # failure, either multiply by 10 if no solution found yet
-                    #          or do binary search with the known upper bound
-                    lower_bound[e] = max(lower_bound[e], CONST[e])
-                    if upper_bound[e] < 1e9:
-                        CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-                    else:
-                        CONST[e] *= 10
+            # adjust the constants as needed
+            success = self.sess.run(self.round_success).reshape(
+                num_consts, batch_size) > 0
+            # success: the smallest successful constant is the new upper bound
+            upper_bound = np.minimum(upper_bound, np.min(
+                np.where(success, CONST, 1e10), axis=0))
+            # failure: the largest failed constant below the upper bound is
+            #          the new lower bound
+            lower_bound = np.maximum(lower_bound, np.max(
+                np.where(~success & (CONST < upper_bound), CONST, 0.),
+                axis=0))
+            # either multiply by 10 if no solution found yet
+            # or split the known interval evenly
+            found = upper_bound < 1e9
+            steps = np.arange(1, num_consts + 1)[:, np.newaxis]
+            CONST = np.where(
+                found,
+                lower_bound + (upper_bound - lower_bound) * steps /
+                (num_consts + 1.),
+                lower_bound * 10. ** steps)
             _logger.debug("  Successfully generated adversarial examples " +
                           "on {} of {} instances.".
-                          format(sum(upper_bound < 1e9), batch_size))
-            o_bestl2 = np.array(o_bestl2)
-            mean = np.mean(np.sqrt(o_bestl2[o_bestl2 < 1e9]))
-            _logger.debug("   Mean successful distortion: {:.4g}".format(mean))
+                          format(sum(found), batch_size))
 
         # return the best solution found
-        o_bestl2 = np.array(o_bestl2)
+        o_bestl2, o_bestattack = self.sess.run([self.o_bestl2,
+                                                self.o_bestattack])
+        mean = np.mean(np.sqrt(o_bestl2[o_bestl2 < 1e9]))
+        _logger.debug("   Mean successful distortion: {:.4g}".format(mean))
         return o_bestattack
 
 
@@ -1256,111 +1317,108 @@ class ElasticNetMethod(object):
         return o_bestattack
 
 
-def deepfool_batch(sess, x, pred, logits, grads, X, nb_candidate, overshoot,
-                   max_iter, clip_min, clip_max, nb_classes, feed=None):
+def deepfool_perturbation_graph(predictions, grads):
+    """
+    Create the graph of the minimal linearized perturbation of one DeepFool
+    iteration, vectorized over the batch and the candidate classes
+    :param predictions: The model's sorted symbolic output of logits, only the
+                        top nb_candidate classes are contained
+    :param grads: Symbolic gradients of the top nb_candidate classes, of shape
+                  [batch_size, nb_candidate, image axes...]
+    :return: The perturbation towards the closest candidate boundary, of the
+             shape of the inputs
+    """
+    nb_candidate = predictions.get_shape().as_list()[-1]
+    batch_size = tf.shape(grads)[0]
+    # w_k and f_k of all the candidates against the current class
+    w = grads[:, 1:] - grads[:, :1]
+    f = predictions[:, 1:] - predictions[:, :1]
+    w_norm = tf.sqrt(tf.reduce_sum(
+        tf.square(tf.reshape(w, [batch_size, nb_candidate - 1, -1])), axis=2))
+    # avoid nan perturbations of the candidates with vanishing gradients
+    w_norm = tf.maximum(w_norm, 1e-12)
+    # adding value 0.00001 to prevent f_k = 0
+    pert = (tf.abs(f) + 0.00001) / w_norm
+    best = tf.cast(tf.argmin(pert, axis=1), tf.int32)
+    best = tf.stack([tf.range(batch_size), best], axis=1)
+    scale = tf.gather_nd(pert, best) / tf.gather_nd(w_norm, best)
+    w_best = tf.gather_nd(w, best)
+    scale = tf.reshape(scale, [-1] + [1] * (len(w_best.get_shape()) - 1))
+    return scale * w_best
+
+
+def deepfool_batch(sess, x, current, perturbation, X, overshoot, max_iter,
+                   clip_min, clip_max, feed=None):
     """
     Applies DeepFool to a batch of inputs
     :param sess: TF session
     :param x: The input placeholder
-    :param pred: The model's sorted symbolic output of logits, only the top
-                 nb_candidate classes are contained
-    :param logits: The model's unnormalized output tensor (the input to
-                   the softmax layer)
-    :param grads: Symbolic gradients of the top nb_candidate classes, procuded
-                  from gradient_graph
+    :param current: The model's symbolic predicted labels
+    :param perturbation: The symbolic perturbation of one iteration, produced
+                         from deepfool_perturbation_graph
     :param X: Numpy array with sample inputs
-    :param nb_candidate: The number of classes to test against, i.e.,
-                         deepfool only consider nb_candidate classes when
-                         attacking(thus accelerate speed). The nb_candidate
-                         classes are chosen according to the prediction
-                         confidence during implementation.
     :param overshoot: A termination criterion to prevent vanishing updates
     :param max_iter: Maximum number of iteration for DeepFool
     :param clip_min: Minimum value for components of the example returned
     :param clip_max: Maximum value for components of the example returned
-    :param nb_classes: Number of model output classes
     :return: Adversarial examples
     """
-    X_adv = deepfool_attack(sess, x, pred, logits, grads, X, nb_candidate,
-                            overshoot, max_iter, clip_min, clip_max, feed=feed)
+    X_adv = deepfool_attack(sess, x, current, perturbation, X, overshoot,
+                            max_iter, clip_min, clip_max, feed=feed)
 
     return np.asarray(X_adv, dtype=np_dtype)
 
 
-def deepfool_attack(sess, x, predictions, logits, grads, sample, nb_candidate,
-                    overshoot, max_iter, clip_min, clip_max, feed=None):
+def deepfool_attack(sess, x, current, perturbation, sample, overshoot,
+                    max_iter, clip_min, clip_max, feed=None):
     """
     TensorFlow implementation of DeepFool.
     Paper link: see https://arxiv.org/pdf/1511.04599.pdf
+    Every iteration is one session call that returns both the predicted
+    labels and the perturbations, and only the samples that are still
+    classified as their original labels are fed.
     :param sess: TF session
     :param x: The input placeholder
-    :param predictions: The model's sorted symbolic output of logits, only the
-                       top nb_candidate classes are contained
-    :param logits: The model's unnormalized output tensor (the input to
-                   the softmax layer)
-    :param grads: Symbolic gradients of the top nb_candidate classes, procuded
-                 from gradient_graph
+    :param current: The model's symbolic predicted labels
+    :param perturbation: The symbolic perturbation of one iteration, produced
+                         from deepfool_perturbation_graph
     :param sample: Numpy array with sample input
-    :param nb_candidate: The number of classes to test against, i.e.,
-                         deepfool only consider nb_candidate classes when
-                         attacking(thus accelerate speed). The nb_candidate
-                         classes are chosen according to the prediction
-                         confidence during implementation.
     :param overshoot: A termination criterion to prevent vanishing updates
     :param max_iter: Maximum number of iteration for DeepFool
     :param clip_min: Minimum value for components of the example returned
     :param clip_max: Maximum value for components of the example returned
     :return: Adversarial examples
     """
-    import copy
+    def run(adv_x):
+        feed_dict = {x: adv_x}
+        if feed is not None:
+            feed_dict.update(feed)
+        return sess.run([current, perturbation], feed_dict=feed_dict)
 
-    adv_x = copy.copy(sample)
     # Initialize the loop variables
     iteration = 0
-    current = utils_tf.model_argmax(sess, x, logits, adv_x, feed=feed)
-    if current.shape == ():
-        current = np.array([current])
-    w = np.squeeze(np.zeros(sample.shape[1:]))  # same shape as original image
+    original, r_i = run(sample)  # use original label as the reference
     r_tot = np.zeros(sample.shape)
-    original = current  # use original label as the reference
+    # the indices of the samples that are not adversarial yet
+    active = np.arange(sample.shape[0])
 
     _logger.debug("Starting DeepFool attack up to {} iterations".
                   format(max_iter))
     # Repeat this main loop until we have achieved misclassification
-    while (np.any(current == original) and iteration < max_iter):
+    while active.size and iteration < max_iter:
 
         if iteration % 5 == 0 and iteration > 0:
-            _logger.info("Attack result at iteration {} is {}".format(
-                iteration,
-                current))
-        gradients = sess.run(grads, feed_dict={x: adv_x})
-        predictions_val = sess.run(predictions, feed_dict={x: adv_x})
-        for idx in range(sample.shape[0]):
-            pert = np.inf
-            if current[idx] != original[idx]:
-                continue
-            for k in range(1, nb_candidate):
-                w_k = gradients[idx, k, ...] - gradients[idx, 0, ...]
-                f_k = predictions_val[idx, k] - predictions_val[idx, 0]
-                # adding value 0.00001 to prevent f_k = 0
-                pert_k = (abs(f_k) + 0.00001) / np.linalg.norm(w_k.flatten())
-                if pert_k < pert:
-                    pert = pert_k
-                    w = w_k
-            r_i = pert*w/np.linalg.norm(w)
-            r_tot[idx, ...] = r_tot[idx, ...] + r_i
-
-        adv_x = np.clip(r_tot + sample, clip_min, clip_max)
-        current = utils_tf.model_argmax(sess, x, logits, adv_x, feed=feed)
-        if current.shape == ():
-            current = np.array([current])
+            _logger.info("Attack result at iteration {}: {} out of {} remain"
+                         .format(iteration, active.size, sample.shape[0]))
+        r_tot[active] += r_i
+        adv_x = np.clip(r_tot[active] + sample[active], clip_min, clip_max)
+        current_val, r_i = run(adv_x)
+        remain = current_val == original[active]
+        active, r_i = active[remain], r_i[remain]
         # Update loop variables
         iteration = iteration + 1
 
-    # need more revision, including info like how many succeed
-    _logger.info("Attack result at iteration {} is {}".format(iteration,
-                 current))
-    _logger.info("{} out of {}".format(sum(current != original),
+    _logger.info("{} out of {}".format(sample.shape[0] - active.size,
                                        sample.shape[0]) +
                  " becomes adversarial examples at iteration {}".format(
                      iteration))
@@ -1371,16 +1429,21 @@ def deepfool_attack(sess, x, predictions, logits, grads, sample, nb_candidate,
 
 class LBFGS_attack(object):
 
-    def __init__(self, sess, x, model_preds, targeted_label,
+    def __init__(self, sess, x, model, targeted_label,
                  binary_search_steps, max_iterations, initial_const,
-                 clip_min, clip_max, nb_classes, batch_size):
+                 clip_min, clip_max, nb_classes, batch_size,
+                 history_size=10, max_line_search=20):
         """
         Return a tensor that constructs adversarial examples for the given
         input. Generate uses tf.py_func in order to operate over tensors.
 
+        The box-constrained problem of every example is minimized by an
+        in-graph projected L-BFGS loop, which runs on the whole batch in one
+        session call per binary search step.
+
         :param sess: a TF session.
         :param x: A tensor with the inputs.
-        :param model_preds: A tensor with model's predictions.
+        :param model: a cleverhans.model.Model object.
         :param targeted_label: A tensor with the target labels.
         :param binary_search_steps: The number of times we perform binary
                                     search to find the optimal tradeoff-
@@ -1394,11 +1457,14 @@ class LBFGS_attack(object):
         :param clip_max: Maximum input component value
         :param num_labels: The number of classes in the model's output.
         :param batch_size: Number of attacks to run simultaneously.
+        :param history_size: The number of curvature pairs kept by L-BFGS.
+        :param max_line_search: The maximum number of backtracking steps of
+                                the line search in every iteration.
 
         """
         self.sess = sess
         self.x = x
-        self.model_preds = model_preds
+        self.model = model
         self.targeted_label = targeted_label
         self.binary_search_steps = binary_search_steps
         self.max_iterations = max_iterations
@@ -1406,56 +1472,182 @@ class LBFGS_attack(object):
         self.clip_min = clip_min
         self.clip_max = clip_max
         self.batch_size = batch_size
+        self.history_size = history_size
+        self.max_line_search = max_line_search
 
         self.repeat = self.binary_search_steps >= 10
-        self.shape = shape = tuple([self.batch_size] +
-                                   list(self.x.get_shape().as_list()[1:]))
-        self.ori_img = tf.Variable(np.zeros(self.shape), dtype=tf_dtype,
-                                   name='ori_img')
-        self.const = tf.Variable(np.zeros(self.batch_size), dtype=tf_dtype,
-                                 name='const')
-
-        self.score = loss_module.attack_softmax_cross_entropy(
-            self.targeted_label, self.model_preds, mean=False)
-        self.l2dist = reduce_sum(tf.square(self.x - self.ori_img))
+        shape = self.x.get_shape().as_list()[1:]
+        self.red_axes = list(range(1, len(shape) + 1))
+        self.ori_img = tf.placeholder(tf_dtype, [None] + shape,
+                                      name='ori_img')
+        self.const = tf.placeholder(tf_dtype, [None], name='const')
+
+        self.adv_x = self._minimize(self.ori_img)
+        self.adv_preds = tf.argmax(self.model.get_probs(self.adv_x), axis=1)
+
+    def _dot(self, a, b):
+        return reduce_sum(a * b, axis=self.red_axes)
+
+    def _expand(self, v):
+        # [batch] -> [batch, 1, ...] to broadcast over the image axes
+        return tf.reshape(v, [-1] + [1] * len(self.red_axes))
+
+    def _loss_and_grad(self, x_in):
+        # the loss of every example, and its gradient w.r.t. the example
+        # the reusable forward function does not keep track of the inputs
+        # of every iteration of the loop
+        if hasattr(self.model, 'get_forward'):
+            preds = tf.nn.softmax(self.model.get_forward()(x_in))
+        else:
+            preds = self.model.get_probs(x_in)
+        score = tf.cast(loss_module.attack_softmax_cross_entropy(
+            self.targeted_label, preds, mean=False), tf_dtype)
+        l2dist = reduce_sum(tf.square(x_in - self.ori_img),
+                            axis=self.red_axes)
         # small self.const will result small adversarial perturbation
-        self.loss = reduce_sum(self.score*self.const) + self.l2dist
-        self.grad, = tf.gradients(self.loss, self.x)
+        loss = score * self.const + l2dist
+        # scale the loss of half precision models to avoid gradient underflow
+        loss_scale = getattr(self.model, "loss_scale", 1.)
+        grad, = tf.gradients(reduce_sum(loss) * loss_scale, x_in)
+        return loss, grad / loss_scale
+
+    def _direction(self, grad, s_hist, y_hist, rho_hist):
+        # the two-loop recursion, the empty history slots have rho = 0 and
+        # do not change the direction
+        q = grad
+        alphas = []
+        for j in reversed(range(self.history_size)):
+            alpha = rho_hist[j] * self._dot(s_hist[j], q)
+            q = q - self._expand(alpha) * y_hist[j]
+            alphas.append(alpha)
+        # scale the initial hessian by the newest curvature pair, or take a
+        # step of unit length when there is no history yet
+        s_new, y_new = s_hist[-1], y_hist[-1]
+        gamma = tf.where(
+            rho_hist[-1] > 0,
+            self._dot(s_new, y_new) / tf.maximum(self._dot(y_new, y_new),
+                                                 1e-30),
+            1. / tf.maximum(tf.sqrt(self._dot(grad, grad)), 1e-30))
+        r = self._expand(gamma) * q
+        for j, alpha in zip(range(self.history_size), reversed(alphas)):
+            beta = rho_hist[j] * self._dot(y_hist[j], r)
+            r = r + self._expand(alpha - beta) * s_hist[j]
+        return -r
+
+    def _line_search(self, x, loss, grad, direction, active):
+        # backtracking line search with the armijo condition along the
+        # projected path, every example keeps its own step size. The
+        # converged examples do not keep the search running
+        def evaluate(step):
+            x_t = tf.clip_by_value(x + self._expand(step) * direction,
+                                   self.clip_min, self.clip_max)
+            loss_t, grad_t = self._loss_and_grad(x_t)
+            done = loss_t <= loss + 1e-4 * self._dot(grad, x_t - x)
+            return x_t, loss_t, grad_t, tf.logical_or(done,
+                                                      tf.logical_not(active))
+
+        def cond(i, step, x_t, loss_t, grad_t, done):
+            return tf.logical_and(i < self.max_line_search,
+                                  tf.logical_not(tf.reduce_all(done)))
+
+        def body(i, step, x_t, loss_t, grad_t, done):
+            step = tf.where(done, step, step * 0.5)
+            n_x, n_loss, n_grad, n_done = evaluate(step)
+            keep = self._expand(tf.cast(done, tf_dtype))
+            x_t = keep * x_t + (1. - keep) * n_x
+            loss_t = tf.where(done, loss_t, n_loss)
+            grad_t = keep * grad_t + (1. - keep) * n_grad
+            return i + 1, step, x_t, loss_t, grad_t, tf.logical_or(done,
+                                                                  n_done)
+
+        step = tf.ones_like(loss)
+        x_t, loss_t, grad_t, done = evaluate(step)
+        _, _, x_t, loss_t, grad_t, done = tf.while_loop(
+            cond, body, [0, step, x_t, loss_t, grad_t, done],
+            back_prop=False, parallel_iterations=1)
+        return x_t, loss_t, grad_t, done
+
+    def _push(self, hist, new, push):
+        # drop the oldest slot and append `new` for the pushed examples
+        push = tf.cast(push, tf_dtype)
+        push = tf.reshape(push, [1, -1] + [1] * (len(new.get_shape()) - 1))
+        pushed = tf.concat([hist[1:], tf.expand_dims(new, 0)], axis=0)
+        return push * pushed + (1. - push) * hist
+
+    def _minimize(self, x0):
+        loss0, grad0 = self._loss_and_grad(x0)
+        hist_shape = tf.concat([[self.history_size], tf.shape(x0)], axis=0)
+        s_hist = tf.zeros(hist_shape, dtype=tf_dtype)
+        y_hist = tf.zeros(hist_shape, dtype=tf_dtype)
+        rho_hist = tf.zeros([self.history_size, tf.shape(x0)[0]],
+                            dtype=tf_dtype)
+        active = tf.ones_like(loss0, dtype=tf.bool)
+
+        def cond(i, x, loss, grad, s_hist, y_hist, rho_hist, active):
+            return tf.logical_and(i < self.max_iterations,
+                                  tf.reduce_any(active))
+
+        def body(i, x, loss, grad, s_hist, y_hist, rho_hist, active):
+            direction = self._direction(grad, s_hist, y_hist, rho_hist)
+            # fall back to steepest descent when the direction does not
+            # descend
+            descent = self._dot(grad, direction) < 0
+            direction = tf.where(descent, direction, -grad)
+            x_t, loss_t, grad_t, done = self._line_search(x, loss, grad,
+                                                          direction, active)
+            # the examples whose line search failed to decrease the loss
+            # have converged
+            active = tf.logical_and(active,
+                                    tf.logical_and(done, loss_t < loss))
+            s = x_t - x
+            y = grad_t - grad
+            sy = self._dot(s, y)
+            # only push the pairs that satisfy the curvature condition
+            push = tf.logical_and(active, sy > 1e-10)
+            rho = tf.where(push, 1. / tf.where(push, sy, tf.ones_like(sy)),
+                           tf.zeros_like(sy))
+            s_hist = self._push(s_hist, s, push)
+            y_hist = self._push(y_hist, y, push)
+            rho_hist = self._push(rho_hist, rho, push)
+            act_e = self._expand(tf.cast(active, tf_dtype))
+            x = act_e * x_t + (1. - act_e) * x
+            loss = tf.where(active, loss_t, loss)
+            grad = act_e * grad_t + (1. - act_e) * grad
+            return i + 1, x, loss, grad, s_hist, y_hist, rho_hist, active
+
+        _, x, _, _, _, _, _, _ = tf.while_loop(
+            cond, body,
+            [0, x0, loss0, grad0, s_hist, y_hist, rho_hist, active],
+            back_prop=False, parallel_iterations=1)
+        return x
 
     def attack(self, x_val, targets):
         """
         Perform the attack on the given instance for the given targets.
         """
-        def lbfgs_objective(adv_x, self, targets, oimgs, CONST):
-            # returns the function value and the gradient for fmin_l_bfgs_b
-            loss = self.sess.run(self.loss, feed_dict={
-                                 self.x: adv_x.reshape(oimgs.shape),
-                                 self.targeted_label: targets,
-                                 self.ori_img: oimgs,
-                                 self.const: CONST})
-            grad = self.sess.run(self.grad, feed_dict={
-                                 self.x: adv_x.reshape(oimgs.shape),
-                                 self.targeted_label: targets,
-                                 self.ori_img: oimgs,
-                                 self.const: CONST})
-            return loss, grad.flatten().astype(float)
-
-        # begin the main part for the attack
-        from scipy.optimize import fmin_l_bfgs_b
+        r = []
+        for i in range(0, len(x_val), self.batch_size):
+            _logger.debug(("Running L-BFGS attack on instance " +
+                           "{} of {}").format(i, len(x_val)))
+            r.extend(self.attack_batch(x_val[i:i + self.batch_size],
+                                       targets[i:i + self.batch_size]))
+        return np.array(r)
+
+    def attack_batch(self, x_val, targets):
+        """
+        Run the attack on a batch of instances and targets.
+        """
+        batch_size = len(x_val)
         oimgs = np.clip(x_val, self.clip_min, self.clip_max)
-        CONST = np.ones(self.batch_size) * self.initial_const
+        labels = np.argmax(targets, axis=1)
+        CONST = np.ones(batch_size) * self.initial_const
 
         # set the lower and upper bounds accordingly
-        lower_bound = np.zeros(self.batch_size)
-        upper_bound = np.ones(self.batch_size) * 1e10
-
-        # set the box constraints for the optimization function
-        clip_min = self.clip_min*np.ones(oimgs.shape[:])
-        clip_max = self.clip_max*np.ones(oimgs.shape[:])
-        clip_bound = list(zip(clip_min.flatten(), clip_max.flatten()))
+        lower_bound = np.zeros(batch_size)
+        upper_bound = np.ones(batch_size) * 1e10
 
         # placeholders for the best l2 and instance attack found so far
-        o_bestl2 = [1e10] * self.batch_size
+        o_bestl2 = np.ones(batch_size) * 1e10
         o_bestattack = np.copy(oimgs)
 
         for outer_step in range(self.binary_search_steps):
@@ -1464,62 +1656,44 @@ class LBFGS_attack(object):
 
             # The last iteration (if we run many steps) repeat the search once.
             if self.repeat and outer_step == self.binary_search_steps - 1:
-                CONST = upper_bound
-
-            # optimization function
-            adv_x, f, _ = fmin_l_bfgs_b(lbfgs_objective,
-                                        oimgs.flatten().astype(float),
-                                        args=(self, targets, oimgs, CONST),
-                                        bounds=clip_bound,
-                                        maxiter=self.max_iterations,
-                                        iprint=0)
-
-            adv_x = adv_x.reshape(oimgs.shape)
-            assert np.amax(adv_x) <= self.clip_max and \
-                np.amin(adv_x) >= self.clip_min, \
-                'fmin_l_bfgs_b returns are invalid'
+                CONST = np.copy(upper_bound)
+
+            # one session call optimizes the whole batch
+            adv_x, preds = self.sess.run([self.adv_x, self.adv_preds],
+                                         feed_dict={
+                                             self.ori_img: oimgs,
+                                             self.targeted_label: targets,
+                                             self.const: CONST})
+            _logger.debug("predicted labels are {}".format(preds))
 
             # adjust the best result (i.e., the adversarial example with the
             # smallest perturbation in terms of L_2 norm) found so far
-            preds = np.atleast_1d(utils_tf.model_argmax(self.sess, self.x,
-                                                        self.model_preds,
-                                                        adv_x))
-            _logger.debug("predicted labels are {}".format(preds))
-
-            l2s = np.zeros(self.batch_size)
-            for i in range(self.batch_size):
-                l2s[i] = np.sum(np.square(adv_x[i] - oimgs[i]))
-
-            for e, (l2, pred, ii) in enumerate(zip(l2s, preds, adv_x)):
-                if l2 < o_bestl2[e] and pred == np.argmax(targets[e]):
-                    o_bestl2[e] = l2
-                    o_bestattack[e] = ii
+            l2s = np.sum(np.square(adv_x - oimgs).reshape(batch_size, -1),
+                         axis=1)
+            success = preds == labels
+            better = success & (l2s < o_bestl2)
+            o_bestl2[better] = l2s[better]
+            o_bestattack[better] = adv_x[better]
 
             # adjust the constant as needed
-            for e in range(self.batch_size):
-                if preds[e] == np.argmax(targets[e]):
-                    # success, divide const by two
-                    upper_bound[e] = min(upper_bound[e], CONST[e])
-                    if upper_bound[e] < 1e9:
-                        CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-                else:
-                    # failure, either multiply by 10 if no solution found yet
-                    #          or do binary search with the known upper bound
-                    lower_bound[e] = max(lower_bound[e], CONST[e])
-                    if upper_bound[e] < 1e9:
-                        CONST[e] = (lower_bound[e] + upper_bound[e]) / 2
-                    else:
-                        CONST[e] *= 10
+            # success, divide const by two
+            upper_bound[success] = np.minimum(upper_bound[success],
+                                              CONST[success])
+            # failure, either multiply by 10 if no solution found yet
+            #          or do binary search with the known upper bound
+            lower_bound[~success] = np.maximum(lower_bound[~success],
+                                               CONST[~success])
+            found = upper_bound < 1e9
+            CONST = np.where(found, (lower_bound + upper_bound) / 2,
+                             np.where(success, CONST, CONST * 10))
 
             _logger.debug("  Successfully generated adversarial examples " +
                           "on {} of {} instances.".
-                          format(sum(upper_bound < 1e9), self.batch_size))
-            o_bestl2 = np.array(o_bestl2)
+                          format(sum(found), batch_size))
             mean = np.mean(np.sqrt(o_bestl2[o_bestl2 < 1e9]))
             _logger.debug("   Mean successful distortion: {:.4g}".format(mean))
 
         # return the best solution found
-        o_bestl2 = np.array(o_bestl2)
         return o_bestattack
 
 
@@ -1645,16 +1819,21 @@ class SPSAAdam(UnrolledAdam):
         self._compare_to_analytic_grad = compare_to_analytic_grad
 
     def _get_delta(self, x, delta):
-        x_shape = x.get_shape().as_list()
+        # one set of `num_samples` random directions for every image
         delta_x = delta * tf.sign(tf.random_uniform(
-                [self._num_samples] + x_shape[1:],
+                tf.concat([[self._num_samples], tf.shape(x)], axis=0),
                 minval=-1., maxval=1., dtype=tf_dtype))
         return delta_x
 
     def _compute_gradients(self, loss_fn, x, unused_optim_state):
-        """Compute gradient estimates using SPSA."""
-        # Assumes `x` is a list, containing a [1, H, W, C] image
-        assert len(x) == 1 and x[0].get_shape().as_list()[0] == 1
+        """Compute gradient estimates using SPSA.
+
+        The perturbed copies of all the images in the batch are evaluated in
+        one `loss_fn` call, stacked sample-major:
+        [2 * num_samples * batch size, H, W, C].
+        """
+        # Assumes `x` is a list, containing a [batch size, H, W, C] image
+        assert len(x) == 1
         x = x[0]
         x_shape = x.get_shape().as_list()
 
@@ -1662,11 +1841,12 @@ class SPSAAdam(UnrolledAdam):
             delta = self._delta
             delta_x = self._get_delta(x, delta)
             delta_x = tf.concat([delta_x, -delta_x], axis=0)
+            perturbed_x = tf.reshape(tf.expand_dims(x, 0) + delta_x,
+                                     tf.concat([[-1], tf.shape(x)[1:]], 0))
             loss_vals = tf.reshape(
-                loss_fn(x + delta_x),
-                [2 * self._num_samples] + [1] * (len(x_shape) - 1))
+                loss_fn(perturbed_x),
+                [2 * self._num_samples, -1] + [1] * (len(x_shape) - 1))
             avg_grad = reduce_mean(loss_vals * delta_x, axis=0) / delta
-            avg_grad = tf.expand_dims(avg_grad, axis=0)
             new_grad_array = grad_array.write(i, avg_grad)
             return i + 1, new_grad_array
 
@@ -1682,10 +1862,12 @@ class SPSAAdam(UnrolledAdam):
         return [avg_grad]
 
 
-def _project_perturbation(perturbation, epsilon, input_image):
+def _project_perturbation(perturbation, epsilon, input_image, clip_min=0.,
+                          clip_max=1.):
     """Project `perturbation` onto L-infinity ball of radius `epsilon`."""
     clipped_perturbation = tf.clip_by_value(perturbation, -epsilon, epsilon)
-    new_image = tf.clip_by_value(input_image + clipped_perturbation, 0., 1.)
+    new_image = tf.clip_by_value(input_image + clipped_perturbation,
+                                 clip_min, clip_max)
     return new_image - input_image
 
 
@@ -1710,8 +1892,11 @@ def pgd_attack(loss_fn, input_image, label, epsilon, num_steps,
                                      some constraint. It should have the same
                                      signature as `_project_perturbation`.
         :param early_stop_loss_threshold: A float or None. If specified, the
-                                          attack will end if the loss is below
-                                          `early_stop_loss_threshold`.
+                                          optimization of every image ends
+                                          when its loss is below
+                                          `early_stop_loss_threshold`, and
+                                          the attack ends when all the images
+                                          are stopped.
         :param is_debug: A bool. If True, print debug info for attack progress.
 
     Returns:
@@ -1731,38 +1916,87 @@ def pgd_attack(loss_fn, input_image, label, epsilon, num_steps,
                                              epsilon, input_image)
     init_optim_state = optimizer.init_state([init_perturbation])
     nest = tf.contrib.framework.nest
+    batch_size = tf.shape(input_image)[0]
 
-    def loop_body(i, perturbation, flat_optim_state):
-        """Update perturbation to input image."""
+    def loop_body(i, active, perturbation, flat_optim_state):
+        """Update perturbation to the images that are not stopped."""
         optim_state = nest.pack_sequence_as(structure=init_optim_state,
                                             flat_sequence=flat_optim_state)
+        if early_stop_loss_threshold is not None:
+            # only the images that are not stopped are evaluated and updated
+            active_idx = tf.to_int32(tf.where(active)[:, 0])
+            inactive_idx = tf.to_int32(tf.where(tf.logical_not(active))[:, 0])
+
+            def gather(t):
+                return tf.gather(t, active_idx)
+
+            def stitch(full, rows):
+                return tf.dynamic_stitch(
+                    [inactive_idx, active_idx],
+                    [tf.gather(full, inactive_idx), rows])
+        else:
+            def gather(t):
+                return t
+
+            def stitch(full, rows):
+                return rows
+
+        def per_image(fn):
+            # apply `fn` on the per-image optimizer states only (not `t`)
+            def _fn(*states):
+                if states[0].get_shape().ndims:
+                    return fn(*states)
+                return states[-1]
+            return _fn
+
+        sub_image = gather(input_image)
+        sub_label = gather(label)
+        sub_perturbation = gather(perturbation)
+        sub_optim_state = nest.map_structure(per_image(gather), optim_state)
 
         def wrapped_loss_fn(x):
-            return loss_fn(input_image + x, label)
+            # `x` can hold multiple perturbations of every image,
+            # stacked sample-major (e.g. the SPSA samples)
+            num_tiles = tf.shape(x)[0] // tf.shape(sub_image)[0]
+            tiled_image = tf.tile(
+                sub_image,
+                tf.concat([[num_tiles],
+                           tf.ones([tf.rank(sub_image) - 1], tf.int32)], 0))
+            return loss_fn(tiled_image + x, tf.tile(sub_label, [num_tiles]))
         new_perturbation_list, new_optim_state = optimizer.minimize(
-                wrapped_loss_fn, [perturbation], optim_state)
-        loss = reduce_mean(wrapped_loss_fn(perturbation), axis=0)
+                wrapped_loss_fn, [sub_perturbation], sub_optim_state)
+        losses = wrapped_loss_fn(sub_perturbation)
+        loss = reduce_mean(losses, axis=0)
         if is_debug:
             with tf.device("/cpu:0"):
                 loss = tf.Print(loss, [loss], "Total batch loss")
         projected_perturbation = project_perturbation(
-                new_perturbation_list[0], epsilon, input_image)
+                new_perturbation_list[0], epsilon, sub_image)
         with tf.control_dependencies([loss]):
             i = tf.identity(i)
-            if early_stop_loss_threshold:
-                i = tf.cond(tf.less(loss, early_stop_loss_threshold),
-                            lambda: float(num_steps), lambda: i)
-        return i + 1, projected_perturbation, nest.flatten(new_optim_state)
-
-    def cond(i, *_):
-        return tf.less(i, num_steps)
+            if early_stop_loss_threshold is not None:
+                # the stopped images keep the perturbation that reaches the
+                # threshold
+                stopped = tf.less(losses, early_stop_loss_threshold)
+                projected_perturbation = tf.where(
+                    stopped, sub_perturbation, projected_perturbation)
+                active = tf.logical_and(active, tf.logical_not(tf.greater(
+                    tf.scatter_nd(tf.expand_dims(active_idx, 1),
+                                  tf.to_float(stopped), [batch_size]), 0.)))
+        new_optim_state = nest.map_structure(per_image(stitch), optim_state,
+                                             new_optim_state)
+        return (i + 1, active, stitch(perturbation, projected_perturbation),
+                nest.flatten(new_optim_state))
+
+    def cond(i, active, *_):
+        return tf.logical_and(tf.less(i, num_steps), reduce_any(active))
 
     flat_init_optim_state = nest.flatten(init_optim_state)
-    _, final_perturbation, _ = tf.while_loop(
+    _, _, final_perturbation, _ = tf.while_loop(
         cond,
         loop_body,
-        loop_vars=[tf.constant(0.), init_perturbation,
-                   flat_init_optim_state],
+        loop_vars=[tf.constant(0.), tf.ones([batch_size], dtype=tf.bool),
+                   init_perturbation, flat_init_optim_state],
         parallel_iterations=1,
         back_prop=False)
 
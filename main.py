@@ -9,10 +9,12 @@ import argparse
 import subprocess
 
 from nics_at import utils
-from nics_at import MutualTrainer, DistillTrainer
+from nics_at import MutualTrainer, DistillTrainer, AdvGenerator, ModelExporter
 trainers = {
     "mutual": MutualTrainer,
-    "distill": DistillTrainer
+    "distill": DistillTrainer,
+    "generate": AdvGenerator, # offline adversarial generation into the `generated_adv` format
+    "export": ModelExporter # export checkpoints as frozen inference graphs for the `frozen` model type
 }
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -29,6 +31,10 @@ parser.add_argument("--save-every", default=-1, type=int)
 parser.add_argument("--print-every", default=10, type=int, help="print every PRINT_EVERY step")
 parser.add_argument("--test-path", default=None, help="Used when test_only is true, dataset-specific arg to change test data.")
 parser.add_argument("--load-file-test", default=[], action="append", help="Used when test_only is true, test more stu models.")
+parser.add_argument("--no-stu-test", action="store_true", default=False, help="Used when test_only is true, only test the --load-file-test models.")
+parser.add_argument("--test-workers", default=1, type=int, help="Used when test_only is true, number of worker processes that test the --load-file-test models in parallel (distill trainer only).")
+parser.add_argument("--test-cache-dir", default=None, help="Used when test_only is true, directory to record/replay the test batches and model-independent adversarial examples.")
+parser.add_argument("--test-results", default=None, help="Used when test_only is true, file to write the test results into.")
 
 subparsers = parser.add_subparsers(dest="trainer_type")
 for t_tp, t_cls in trainers.iteritems():
@@ -37,11 +43,22 @@ for t_tp, t_cls in trainers.iteritems():
     t_cls.populate_arguments(sub_parser)
 
 args = parser.parse_args()
+if args.test_only and args.test_workers > 1 and args.load_file_test:
+    from nics_at.eval_runner import run_parallel_test
+    utils.log = utils.get_log_func(None)
+    assert args.trainer_type == "distill", "Parallel testing is only supported by the distill trainer"
+    run_parallel_test(args, sys.argv)
+    sys.exit(0)
+if args.trainer_type == "generate" and args.gen_workers > 1:
+    from nics_at.adv_generator import run_parallel_generate
+    utils.log = utils.get_log_func(None)
+    sys.exit(0 if run_parallel_generate(args, sys.argv) else 1)
+is_training = not args.test_only and args.trainer_type not in {"generate", "export"}
 os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
 with open(args.config) as config_file:
     config = yaml.load(config_file)
 
-if not args.test_only:
+if is_training:
     if not os.path.exists(args.train_dir):
         subprocess.check_call("mkdir -p {}".format(args.train_dir),
                               shell=True)
@@ -58,9 +75,10 @@ else:
     args.log_file = None
 utils.log = utils.get_log_func(args.log_file)
 utils.log("CMD: ", " ".join(sys.argv))
-if not args.test_only and not args.train_dir:
+if is_training and not args.train_dir:
     utils.log("WARNING: model will not be saved if `--train_dir` option is not given.")
 trainer = trainers[args.trainer_type](args, config)
 trainer.init()
 trainer.start()
-trainer.sess.close()
+if trainer.sess is not None:
+    trainer.sess.close()
@@ -1,2 +1,4 @@
 from mutual_trainer import MutualTrainer
 from distill_trainer import DistillTrainer
+from adv_generator import AdvGenerator
+from model_exporter import ModelExporter
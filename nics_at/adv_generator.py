@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import sys
+import time
+import threading
+import subprocess
+from six.moves import queue
+
+import numpy as np
+import tensorflow as tf
+
+from models import QCNN
+import utils
+from utils import AvailModels
+from attacks import Attack, CleverhansAttack
+from base_trainer import settings, Trainer
+from eval_runner import _strip_options
+
+class _RecordingQueue(object):
+    """
+    Proxy of a filename queue that remembers the last dequeued item, so that the item
+    (which ends with the output path) can be batched together with the images read by `Dataset.read_image`.
+    """
+    def __init__(self, filename_q):
+        self.filename_q = filename_q
+        self.item = None
+
+    def dequeue(self):
+        self.item = self.filename_q.dequeue()
+        return self.item
+
+class AdvGenerator(Trainer):
+    """
+    Generate the adversarial examples of one split of the dataset offline, and write them in the
+    storage format of the dataset (one uint8 `.bin` file per image, `<output_dir>/<mode>/<image name>.<suffix>`),
+    so that the output directory can be used directly as a `generated_adv` path.
+
+    The images are sharded among `--num-shards` processes by `--shard-index`. The images whose outputs
+    already exist are skipped, so an interrupted generation is resumed by running the same command again.
+    """
+    class _settings(settings):
+        default_cfg = {
+            # Data gen
+            "dataset": "tinyimagenet",
+            "dataset_info": {},
+            "num_threads": 4,
+            "capacity": 1024,
+            "more_augs": False,
+            "aug_saltpepper": None,
+            "aug_gaussian": None,
+            "generated_adv": [],
+            "epochs": 1,
+            "batch_size": 256, # generation batch size
+
+            # Models and attacks
+            "precision": "float32",
+            "loss_scale": 128.,
+            "models": [], # e.g. [{"namescope": "", "type": "resnet18", "checkpoint": "path", "load_namescope": ""}]
+            "available_attacks": [],
+            "attack": None, # the id of the attack in `available_attacks` to run, default to the first one
+            "suffix": "bin"
+        }
+
+    def __init__(self, args, cfg):
+        assert not cfg.get("dataset", "").startswith("gray_"), "Fault: generate from the plain dataset instead of {}".format(cfg["dataset"])
+        super(AdvGenerator, self).__init__(args, cfg)
+        assert hasattr(self.dataset, "load_filenames_labels"), "Fault: dataset {} is not stored as files".format(self.FLAGS.dataset)
+        assert self.FLAGS.models, "Fault: no source model is configured"
+        assert 0 <= self.FLAGS.shard_index < self.FLAGS.num_shards, "Fault: invalid shard {}/{}".format(self.FLAGS.shard_index, self.FLAGS.num_shards)
+
+    def _load_todo(self):
+        # Let the dataset compute the output paths, the last column of every item is the output path.
+        generated_adv = self.dataset.generated_adv
+        self.dataset.generated_adv = [{"path": self.FLAGS.output_dir, "suffix": self.FLAGS.suffix}]
+        filenames_labels = sorted(self.dataset.load_filenames_labels(self.FLAGS.mode))
+        self.dataset.generated_adv = generated_adv
+        shard = filenames_labels[self.FLAGS.shard_index::self.FLAGS.num_shards]
+        todo = [item for item in shard if not os.path.exists(item[-1])]
+        utils.log("Shard {}/{}: {} images, {} already generated".format(self.FLAGS.shard_index, self.FLAGS.num_shards, len(shard), len(shard) - len(todo)))
+        return todo
+
+    def init(self):
+        self.todo = self._load_todo()
+        if not self.todo:
+            return
+        with tf.device("/cpu:0"):
+            filename_q = tf.train.input_producer(self.todo, num_epochs=1, shuffle=False, name="generate_producer")
+            reads = []
+            for _ in range(self.dataset.num_threads["val"]):
+                r_q = _RecordingQueue(filename_q)
+                img, _, label, _ = self.dataset.read_image(r_q, "val")
+                reads.append([img, label, r_q.item[-1]])
+            self.imgs, labels, self.out_paths = tf.train.batch_join(reads, self.FLAGS.batch_size,
+                                                                    shapes=[tuple(self.dataset.image_shape), (), ()],
+                                                                    capacity=self.FLAGS.capacity, allow_smaller_final_batch=True)
+            self.labels = tf.one_hot(labels, self.dataset.num_labels)
+
+        QCNN.default_precision = self.FLAGS.precision
+        QCNN.default_loss_scale = self.FLAGS.loss_scale
+        self.models = []
+        for i, m_cfg in enumerate(self.FLAGS.models):
+            x = tf.placeholder(tf.float32, shape=[None] + self.dataset.image_shape, name="x_{}".format(i))
+            model = QCNN.create_model(m_cfg)
+            AvailModels.add(model, x, model.get_logits(x))
+            self.models.append(model)
+
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        self.sess = tf.Session(config=config)
+        [Attack.create_attack(self.sess, a_cfg) for a_cfg in self.FLAGS.available_attacks]
+        a_id = self.FLAGS.attack or self.FLAGS.available_attacks[0]["id"]
+        self.attack = Attack.get_attack(a_id)
+        assert isinstance(self.attack, CleverhansAttack), "Fault: only cleverhans attacks are supported, {} is not".format(a_id)
+
+    def _write_loop(self):
+        while True:
+            item = self.write_q.get()
+            if item is None:
+                break
+            for path, adv in zip(*item):
+                out_dir = os.path.dirname(path)
+                if not os.path.exists(out_dir):
+                    try:
+                        os.makedirs(out_dir)
+                    except OSError: # created by other shards
+                        pass
+                # write into a temporary file first, so that half-written images are regenerated when resuming
+                with open(path + ".tmp", "wb") as w_f:
+                    w_f.write(adv.tobytes())
+                os.rename(path + ".tmp", path)
+
+    def start(self):
+        if not self.todo:
+            utils.log("Nothing to generate")
+            return
+        sess = self.sess
+        sess.run(tf.group(tf.global_variables_initializer(), tf.local_variables_initializer()))
+        for model, m_cfg in zip(self.models, self.FLAGS.models):
+            model.load_checkpoint(m_cfg["checkpoint"], sess, m_cfg.get("load_namescope", None))
+        self.write_q = queue.Queue(maxsize=4)
+        writer = threading.Thread(target=self._write_loop)
+        writer.daemon = True
+        writer.start()
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+
+        num = 0
+        step = 0
+        start_time = time.time()
+        try:
+            while True:
+                x_v, y_v, paths = sess.run([self.imgs, self.labels, self.out_paths])
+                adv_x = self.attack.generate(x_v, y_v)
+                self.write_q.put((paths, np.clip(np.round(adv_x), 0, 255).astype(np.uint8)))
+                num += len(paths)
+                step += 1
+                if step % self.FLAGS.print_every == 0:
+                    speed = num / (time.time() - start_time)
+                    utils.log("\rGenerated {}/{} images; {:.1f} images/s; ETA: {:.1f} min".format(
+                        num, len(self.todo), speed, (len(self.todo) - num) / speed / 60), flush=True)
+        except tf.errors.OutOfRangeError:
+            pass
+        finally:
+            coord.request_stop()
+            coord.join(threads)
+            self.write_q.put(None)
+            writer.join()
+        utils.log("Generated {} images into {} in {:.1f} s".format(num, self.FLAGS.output_dir, time.time() - start_time))
+
+    @classmethod
+    def populate_arguments(cls, parser):
+        parser.add_argument("--output-dir", required=True, help="The directory that is used as the `generated_adv` path")
+        parser.add_argument("--mode", default="train", choices=["train", "val"], help="The dataset split to generate")
+        parser.add_argument("--num-shards", default=1, type=int, help="Number of shards the images are split into")
+        parser.add_argument("--shard-index", default=0, type=int, help="The shard generated by this process")
+        parser.add_argument("--gen-workers", default=1, type=int,
+                            help="Number of worker processes, every worker generates one shard on one GPU in `--gpu`")
+
+def run_parallel_generate(args, argv):
+    """
+    Run `args.gen_workers` generation worker processes, worker i generates the shard i on the GPU i (round-robin) in `--gpu`.
+    """
+    gpus = args.gpu.split(",")
+    base_argv = _strip_options(argv[1:], {"--gpu", "--gen-workers", "--num-shards", "--shard-index"})
+    procs = []
+    for i in range(args.gen_workers):
+        gpu = gpus[i % len(gpus)]
+        utils.log("Worker {}: gpu {}; shard {}/{}".format(i, gpu, i, args.gen_workers))
+        # the top-level options must precede the sub-command, and the sub-command options are appended
+        cmd = [sys.executable, argv[0], "--gpu", gpu] + base_argv + ["--num-shards", str(args.gen_workers), "--shard-index", str(i)]
+        procs.append(subprocess.Popen(cmd))
+    failed = [i for i, proc in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        utils.log("WARNING: generation workers {} failed, run the same command again to resume".format(failed))
+    return not failed
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import re
+import glob
+import hashlib
+import threading
+from six.moves import queue
+
+import numpy as np
+
+from nics_at import utils
+
+def get_sample_ids(x):
+    """
+    The ids of the clean (not augmented) samples, they are stable across runs.
+    """
+    return np.array([int(hashlib.md5(np.ascontiguousarray(sx).tobytes()).hexdigest()[:15], 16) for sx in x], dtype=np.int64)
+
+def _key_dirname(key):
+    return re.sub(r"[^\w.-]", "_", key)
+
+class AdvStoreWriter(object):
+    """
+    Append the adversarial batches generated during training to an on-disk store from a background thread.
+
+    Layout: `store_dir/<attack key>/epoch_<epoch>/shard_<pid>_<n>.npz`, every shard contains
+        sample_ids: int64 [N], the ids of the clean samples (see `get_sample_ids`)
+        advs: uint8 [N, ... image axes ...], the adversarial examples
+    """
+    def __init__(self, store_dir, shard_size=5000, keys=None, max_pending=16):
+        """
+        :param shard_size: Number of adversarial examples per shard file.
+        :param keys: (optional) Only store the adversarials of these attack keys, default to store all the white-box adversarials.
+        :param max_pending: Maximum number of batches waiting to be written, `put` blocks when reached.
+        """
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        self.keys = set(keys) if keys is not None else None
+        self.buffers = {} # (epoch, key) -> [list of sample_ids, list of advs, number]
+        self.num_shards = 0
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        utils.log("Storing the training adversarial examples into {}".format(self.store_dir))
+
+    def accept(self, key):
+        return self.keys is None or key in self.keys
+
+    def put(self, epoch, key, sample_ids, advs):
+        self.queue.put((epoch, key, sample_ids, np.clip(np.round(advs), 0, 255).astype(np.uint8)))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            epoch, key, sample_ids, advs = item
+            try:
+                # flush the buffers of former epochs
+                [self._flush(b_key) for b_key in list(self.buffers.keys()) if b_key[0] != epoch]
+                buf = self.buffers.setdefault((epoch, key), [[], [], 0])
+                buf[0].append(sample_ids)
+                buf[1].append(advs)
+                buf[2] += len(sample_ids)
+                if buf[2] >= self.shard_size:
+                    self._flush((epoch, key))
+            except Exception as e:
+                utils.log("WARNING: adversarial store failed to write {} of epoch {}: {}".format(key, epoch, e))
+        [self._flush(b_key) for b_key in list(self.buffers.keys())]
+
+    def _flush(self, b_key):
+        epoch, key = b_key
+        sample_ids, advs, _ = self.buffers.pop(b_key)
+        shard_dir = os.path.join(self.store_dir, _key_dirname(key), "epoch_{}".format(epoch))
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        fname = os.path.join(shard_dir, "shard_{}_{}.npz".format(os.getpid(), self.num_shards))
+        # write into a temporary file first, so that readers never see partial shards
+        with open(fname + ".tmp", "wb") as w_f:
+            np.savez(w_f, sample_ids=np.concatenate(sample_ids), advs=np.concatenate(advs))
+        os.rename(fname + ".tmp", fname)
+        self.num_shards += 1
+
+    def close(self):
+        # wait for all the pending batches to be written
+        self.queue.put(None)
+        self.thread.join()
+
+class AdvStoreReader(object):
+    """
+    Look up the stored adversarial examples of one attack key by sample ids.
+    When `epoch` is not given, the shards of all epochs are loaded, and later epochs override earlier ones.
+    """
+    def __init__(self, store_dir, key, epoch=None):
+        self.key = key
+        key_dir = os.path.join(store_dir, _key_dirname(key))
+        epochs = sorted(int(os.path.basename(d).split("_")[-1]) for d in glob.glob(os.path.join(key_dir, "epoch_*")))
+        if epoch is not None:
+            assert epoch in epochs, "Fault: epoch {} of {} not found in {}".format(epoch, key, store_dir)
+            epochs = [epoch]
+        self.index = {}
+        advs = []
+        num = 0
+        for e in epochs:
+            for fname in sorted(glob.glob(os.path.join(key_dir, "epoch_{}".format(e), "shard_*.npz"))):
+                data = np.load(fname)
+                self.index.update(zip(data["sample_ids"].tolist(), range(num, num + len(data["sample_ids"]))))
+                advs.append(data["advs"])
+                num += len(data["sample_ids"])
+        assert advs, "Fault: no stored adversarial examples of {} in {}".format(key, store_dir)
+        self.advs = np.concatenate(advs)
+        self.num_missed = 0
+        utils.log("Loaded {} stored adversarial examples of {} (epochs {})".format(len(self.index), key, epochs))
+
+    def lookup(self, sample_ids, fallback):
+        """
+        :param fallback: The examples used for the samples that are not stored, e.g. the clean examples.
+        :return: float32 array of shape [batch size, 1, ... image axes ...]
+        """
+        rows = [self.index.get(s_id, None) for s_id in sample_ids.tolist()]
+        res = np.array(fallback, dtype=np.float32, copy=True)
+        found = [i for i, row in enumerate(rows) if row is not None]
+        res[found] = self.advs[[rows[i] for i in found]]
+        self.num_missed += len(rows) - len(found)
+        return np.expand_dims(res, 1)
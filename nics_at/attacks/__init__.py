@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import time
 import contextlib
 
 import numpy as np
+import tensorflow as tf
 
 import cleverhans.attacks
 import foolbox
@@ -12,6 +14,7 @@ from foolbox.models import TensorFlowModel
 
 from nics_at import utils
 from nics_at.utils import AvailModels, profiling
+from nics_at.adv_store import get_sample_ids
 from pgd_variants import MadryEtAl_L2, MadryEtAl_transfer, MadryEtAl_transfer_re, MadryEtAl_KLloss, MadryEtAl_L2_transfer_re, Langevin_transfer
 cleverhans.attacks.MadryEtAl_L2 = MadryEtAl_L2
 cleverhans.attacks.MadryEtAl_transfer = MadryEtAl_transfer
@@ -36,7 +39,7 @@ def substitute_argscope(_callable, dct):
 class AttackGenerator(object):
     def __init__(self, generate_cfg, merge=False, split_adv=False, random_split_adv=False,
                  random_interp=None, random_interp_adv=None, use_cache=False,
-                 mixup_alpha=1.0, name=""):
+                 mixup_alpha=1.0, adv_store=None, stored_advs=None, fuse_attacks=False, name=""):
         self.name = name
         self.cfg = generate_cfg
         self.merge = merge # whether or not to merge all adv into 1 array
@@ -47,10 +50,13 @@ class AttackGenerator(object):
         self.mixup_alpha = mixup_alpha
         self.use_cache = use_cache
         self.batch_cache = {}
+        self.adv_store = adv_store # (optional) an `AdvStoreWriter` that the generated white-box adversarials are written into
+        self.stored_advs = stored_advs or [] # `AdvStoreReader`s, the stored adversarials are used as additional `__generated__` ones
+        self.fuse_attacks = fuse_attacks # generate all the white-box adversarials of one batch in one graph execution
         self.epoch = 0
         self.batch = 0
-        utils.log("AttackGenerator {}: split_adv: {}; random_split_adv: {}; random_interp: {}; random_interp_adv: {}; use_cache: {}".
-                  format(self.name, self.split_adv, self.random_split_adv, self.random_interp, self.random_interp_adv, self.use_cache))
+        utils.log("AttackGenerator {}: split_adv: {}; random_split_adv: {}; random_interp: {}; random_interp_adv: {}; use_cache: {}; fuse_attacks: {}".
+                  format(self.name, self.split_adv, self.random_split_adv, self.random_interp, self.random_interp_adv, self.use_cache, self.fuse_attacks))
 
     def set_epoch(self, epoch):
         self.epoch = epoch
@@ -71,8 +77,15 @@ class AttackGenerator(object):
             return acfg["id"] + ":" + key
 
     @profiling
-    def generate_for_model(self, x, y, mid, pre_adv_x=None):
+    def generate_for_model(self, x, y, mid, pre_adv_x=None, shared_advs=None, evaluated_mids=None, clean_x=None):
+        """
+        :param clean_x: (optional) The clean (not augmented) examples, used to identify the samples in the adversarial store.
+        :param shared_advs: (optional) A dict of key -> adversarial examples that do not depend on the evaluated models.
+                            Adversarials in it are reused; newly generated ones that do not depend on `evaluated_mids` are added into it.
+        :param evaluated_mids: (optional) The ids of the evaluated models, default to `[mid]`.
+        """
         cfg = self.cfg.get(mid, []) or []
+        evaluated_mids = evaluated_mids or [mid]
         attacks = self.get_attacks(cfg)
         generated = []
         ys = []
@@ -80,6 +93,13 @@ class AttackGenerator(object):
         batch_size = x.shape[0]
         mixup_x = None
         mixup_y = None
+        sample_ids = None
+        pending = [] # the white-box attacks to be generated together: (index in `generated`, attack, acfg, key, x, y)
+        if (self.adv_store is not None or self.stored_advs) and clean_x is not None:
+            sample_ids = get_sample_ids(clean_x)
+            if self.stored_advs:
+                stored_x = np.concatenate([reader.lookup(sample_ids, fallback=x) for reader in self.stored_advs], axis=1)
+                pre_adv_x = stored_x if pre_adv_x is None else np.concatenate([pre_adv_x, stored_x], axis=1)
         for a in attacks:
             normal_x = x
             normal_y = y
@@ -139,15 +159,35 @@ class AttackGenerator(object):
                     keys.append("random_interp_advs")
             else: # if __generated__ not in key, generate white-box adversarials
                 # white-box attack is the bottleneck of adversarial generation, use cache when needed
-                if self.use_cache and key in self.batch_cache:
+                if shared_advs is not None and key in shared_advs:
+                    adv_x = shared_advs[key]
+                elif self.use_cache and key in self.batch_cache:
                     adv_x = self.batch_cache[key]
                 else:
-                    adv_x = Attack.get_attack(a["id"]).generate(normal_x, normal_y)
-                    if self.use_cache:
-                        self.batch_cache[key] = adv_x # cached
+                    attack = Attack.get_attack(a["id"])
+                    if self.fuse_attacks and attack.fusable:
+                        pending.append((len(generated), attack, a, key, normal_x, normal_y))
+                        generated.append(None) # filled after all the pending attacks are generated
+                        ys.append(normal_y)
+                        continue
+                    adv_x = attack.generate(normal_x, normal_y)
+                    self._record_generated(attack, a, key, adv_x, sample_ids, shared_advs, evaluated_mids)
                 generated.append(adv_x)
                 ys.append(normal_y)
 
+        # the pending attacks on the same inputs (the normal or the mixup ones) are generated in one graph execution
+        groups = {}
+        for item in pending:
+            groups.setdefault((id(item[4]), item[1].sess), []).append(item)
+        for group in groups.values():
+            if len(group) == 1:
+                advs = [group[0][1].generate(group[0][4], group[0][5])]
+            else:
+                advs = CleverhansAttack.generate_fused([item[1] for item in group], group[0][4], group[0][5])
+            for (ind, attack, a, key, _, _), adv_x in zip(group, advs):
+                self._record_generated(attack, a, key, adv_x, sample_ids, shared_advs, evaluated_mids)
+                generated[ind] = adv_x
+
         if self.random_split_adv:
             generated = [np.expand_dims(g, 1) if len(g.shape) == 4 else g for g in generated]
             total = np.concatenate(generated, axis=1)
@@ -170,6 +210,26 @@ class AttackGenerator(object):
         ys = [s_y.reshape([-1, y.shape[-1]]) for s_y in ys]
         return keys, generated, ys
 
+    def _record_generated(self, attack, acfg, key, adv_x, sample_ids, shared_advs, evaluated_mids):
+        if sample_ids is not None and self.adv_store is not None and not acfg.get("mixup", False) and self.adv_store.accept(key):
+            self.adv_store.put(self.epoch, key, sample_ids, adv_x)
+        if self.use_cache:
+            self.batch_cache[key] = adv_x # cached
+        if shared_advs is not None and not acfg.get("mixup", False) and not attack.depends_on(evaluated_mids):
+            shared_advs[key] = adv_x
+
+    def get_attack_ids(self):
+        """
+        :return: The ids of all the attacks that the schedules of this generator can reach, regardless of the conditions.
+        """
+        ids = []
+        for cfg in self.cfg.values():
+            for acfg in cfg or []:
+                for sacfg in (acfg if isinstance(acfg, (list, tuple)) else [acfg]):
+                    if sacfg["id"] is not None and "__generated__" not in sacfg["id"] and sacfg["id"] not in ids:
+                        ids.append(sacfg["id"])
+        return ids
+
     def epoch_mod(self, modn, leftn):
         return self.epoch % modn == leftn
 
@@ -200,8 +260,24 @@ class AttackGenerator(object):
                 choosed.append(acfg)
         return choosed
 
+def warm_up_attacks(attack_ids, image_shape, num_labels, batch_size, run=False):
+    """
+    Construct the graphs of the attacks ahead of their first use, and report the cost of every attack.
+    :param run: Also run every attack once on a dummy batch, which includes the one-time runtime costs (e.g. kernel selection).
+    """
+    x_v = np.zeros([batch_size] + list(image_shape), dtype=np.float32)
+    y_v = np.eye(num_labels, dtype=np.float32)[np.arange(batch_size) % num_labels]
+    total_start = time.time()
+    for aid in attack_ids:
+        start = time.time()
+        Attack.get_attack(aid).warm_up(x_v, y_v, run=run)
+        utils.log("Attack {}: warm-up{} in {:.2f} s".format(aid, " (construct and run)" if run else "", time.time() - start))
+    utils.log("Warmed up {} attacks in {:.2f} s".format(len(attack_ids), time.time() - total_start))
+
 class Attack(object):
     registry = {}
+    # whether `generate` with the default params can be fused with other attacks, see `CleverhansAttack.generate_fused`
+    fusable = False
 
     def __init__(self, sess, cfg):
         self.cfg = cfg
@@ -220,6 +296,12 @@ class Attack(object):
         cls.registry[atk.cfg["id"]] = atk
         return atk
 
+    def depends_on(self, mids):
+        """
+        Whether the generated adversarial examples depend on any of the models in `mids`.
+        """
+        return any(self.cfg.get(n, None) in mids for n in ["model", "transfer"])
+
     def generate_tensor(self, x, y, params={}):
         t_params = {k: v for k, v in self.default_params.iteritems()}
         t_params.update(params)
@@ -230,6 +312,12 @@ class Attack(object):
         t_params.update(params)
         return self._generate(x, y, t_params)
 
+    def warm_up(self, x_v, y_v, run=False):
+        """
+        Construct the graphs that `generate` with the default params needs, and optionally run them once on `x_v`.
+        """
+        pass
+
 class FoolboxAttack(Attack):
     attack_methods = {
         "pgd": "PGD",
@@ -270,9 +358,9 @@ class CleverhansAttack(Attack):
     attack_methods = {
         "fgsm": "FastGradientMethod",
         "bim": "BasicIterativeMethod",
-        "jsma": "SaliencyMapMethod",
+        "jsma": "SaliencyMapMethod", # in-graph, random targets when untargeted, e.g. {theta: 255., gamma: 0.05, clip_max: 255., max_pair_features: 1024}
         "cw": "CarliniWagnerL2",
-        "pgd": "MadryEtAl",
+        "pgd": "MadryEtAl", # the pgd variants accept `nb_restart`: run the random restarts in one graph and keep the strongest adversarials
         "transfer_pgd": "MadryEtAl_transfer",
         "re_transfer_pgd": "MadryEtAl_transfer_re",
         "l2_re_transfer_pgd": "MadryEtAl_L2_transfer_re",
@@ -280,28 +368,144 @@ class CleverhansAttack(Attack):
         "l2_transfer_pgd": "MadryEtAl_L2",
         "momentum_pgd": "MomentumIterativeMethod",
         "langevin_transfer": "Langevin_transfer",
-        "kl_vat": "MadryEtAl_KLloss" # https://github.com/takerum/vat
+        "kl_vat": "MadryEtAl_KLloss", # https://github.com/takerum/vat
+        "spsa": "SPSA", # gradient-free, e.g. {epsilon: 4.0, num_steps: 100, batch_size: 64, early_stop_loss_threshold: 0., clip_max: 255.}
+        "deepfool": "DeepFool", # untargeted and label-free, e.g. {attack_with_y: false, nb_candidate: 10, max_iter: 50, clip_max: 255.}
+        "lbfgs": "LBFGS" # targeted only, e.g. {targeted: true, batch_size: 128, binary_search_steps: 5, max_iterations: 100, clip_max: 255.}
     }
+    # these methods only use the gradients of the transfer model when the labels are given
+    transfer_only_methods = {"transfer_pgd", "langevin_transfer"}
+    # The cleverhans attack objects are shared by all the attacks with the same attack class, models and dtype,
+    # so that their `generate_np` graphs are shared too (e.g. pgd attacks with different `eps` use one graph).
+    # (attack class name, model, transfer model, dtype, session) -> [cleverhans attack, ids of the attacks sharing it]
+    shared_attacks = {}
+    # (input shape, ((shared key, hash key) of every fused attack)) -> (input placeholders, [placeholders of the fed params], [adversarials])
+    fused_graphs = {}
+    # (optional) an `AttackGraphCache`, the `generate_np` graphs cached by a former run of the same configuration are imported from it
+    graph_cache = None
+
     def __init__(self, sess, cfg):
         super(CleverhansAttack, self).__init__(sess, cfg)
-        if "transfer" in cfg:
-            self.attack = getattr(cleverhans.attacks, self.attack_methods[self.cfg["method"]])(AvailModels.get_model(self.cfg["model"]), AvailModels.get_model(self.cfg["transfer"]), sess=sess)
+        # the dtype of the attack graph (the perturbation arithmetic). The half precision models compute in float16 internally
+        # even with the default float32 attack graph, which keeps the perturbation steps/projections exact and the metrics comparable.
+        dtypestr = self.cfg.get("dtype", "float32")
+        cls_name = self.attack_methods[self.cfg["method"]]
+        self.shared_key = (cls_name, self.cfg["model"], self.cfg.get("transfer", None), dtypestr, sess)
+        if self.shared_key not in self.shared_attacks:
+            if "transfer" in cfg:
+                attack = getattr(cleverhans.attacks, cls_name)(AvailModels.get_model(self.cfg["model"]), AvailModels.get_model(self.cfg["transfer"]), sess=sess, dtypestr=dtypestr)
+            else:
+                attack = getattr(cleverhans.attacks, cls_name)(AvailModels.get_model(self.cfg["model"]), sess=sess, dtypestr=dtypestr)
+            self.shared_attacks[self.shared_key] = [attack, []]
+        else:
+            utils.log("Attack {}: share the attack graphs with {}".format(self.cfg["id"], self.shared_attacks[self.shared_key][1]))
+        self.attack = self.shared_attacks[self.shared_key][0]
+        self.shared_attacks[self.shared_key][1].append(self.cfg["id"])
+        self.fusable = sess is not None
+
+    def _generate_np(self, x_v, **kwargs):
+        self._construct_graph(x_v, kwargs)
+        return self.attack.generate_np(x_v, **kwargs)
+
+    def _construct_graph(self, x_v, kwargs):
+        """
+        Construct the `generate_np` graph of `kwargs` if it is not constructed yet, or import it from `graph_cache`.
+        """
+        c_attack = self.attack
+        fixed, feedable, hash_key = c_attack.construct_variables(kwargs)
+        if hash_key is None or hash_key in c_attack.graphs:
+            return
+        action = "constructed"
+        if self.graph_cache is None:
+            c_attack.construct_graph(fixed, feedable, x_v, hash_key)
         else:
-            self.attack = getattr(cleverhans.attacks, self.attack_methods[self.cfg["method"]])(AvailModels.get_model(self.cfg["model"]), sess=sess)
+            names = sorted(n for n, v in feedable.iteritems() if v is not None)
+            def build():
+                c_attack.construct_graph(fixed, feedable, x_v, hash_key)
+                x, new_kwargs, x_adv = c_attack.graphs[hash_key]
+                return [x] + [new_kwargs[n] for n in names], [x_adv]
+            start = time.time()
+            # the session is not a part of the key, as its repr changes across runs
+            inputs, outputs, imported = self.graph_cache.construct(self.shared_key[:-1] + (hash_key, tuple(x_v.shape[1:])), build)
+            if imported:
+                action = "imported the cached"
+                new_kwargs = dict(fixed)
+                new_kwargs.update(zip(names, inputs[1:]))
+                c_attack.graphs[hash_key] = (inputs[0], new_kwargs, outputs[0])
+                c_attack.construct_times[hash_key] = time.time() - start
+        utils.log("Attack {}: {} the {} graph (structural params: {}; fed params: {}) in {:.2f} s; {} graphs of {} shared by {}".format(
+            self.cfg["id"], action, self.shared_key[0], dict(hash_key[0]), list(hash_key[1]), c_attack.construct_times[hash_key],
+            len(c_attack.graphs), self.shared_key[0], self.shared_attacks[self.shared_key][1]))
+
+    def depends_on(self, mids):
+        if self.cfg["method"] in self.transfer_only_methods and self.default_params.get("attack_with_y", True):
+            return self.cfg["transfer"] in mids
+        return super(CleverhansAttack, self).depends_on(mids)
 
     def _generate_tensor(self, x, y, params):
         return self.attack.generate(x, y=y, **params)
 
-    @profiling
-    def _generate(self, x_v, y_v, params):
+    def _generate_kwargs(self, y_v, params):
         attack_with_y = params.pop("attack_with_y", True)
         targeted = params.pop("targeted", False)
         if attack_with_y:
             if not targeted: # non-targeted attack
-                return self.attack.generate_np(x_v, y=y_v, **params)
+                params["y"] = y_v
             else:
                 num_classes = y_v.shape[-1]
-                other_y_v = np.eye(num_classes)[np.mod(np.argmax(y_v, axis=-1) + np.random.randint(1, num_classes, size=y_v.shape[0]), num_classes)]
-                return self.attack.generate_np(x_v, y_target=other_y_v, **params)
-        else:
-            return self.attack.generate_np(x_v, **params)
+                params["y_target"] = np.eye(num_classes)[np.mod(np.argmax(y_v, axis=-1) + np.random.randint(1, num_classes, size=y_v.shape[0]), num_classes)]
+        return params
+
+    @profiling
+    def _generate(self, x_v, y_v, params):
+        return self._generate_np(x_v, **self._generate_kwargs(y_v, params))
+
+    def warm_up(self, x_v, y_v, run=False):
+        kwargs = self._generate_kwargs(y_v, dict(self.default_params))
+        if run:
+            self._generate_np(x_v, **kwargs)
+            return
+        self._construct_graph(x_v, kwargs)
+
+    @classmethod
+    def generate_fused(cls, attacks, x_v, y_v):
+        """
+        Generate the adversarial examples of several attacks with their default params on the same batch in one graph execution.
+        All the attacks are built on the same input placeholder, so the clean forward pass of every model (e.g. in the label
+        guessing, or the clean predictions of `MadryEtAl_KLloss`) is built once through the model's cache, and is shared by
+        the attacks; the independent attack loops run side by side in the execution.
+        :param attacks: `CleverhansAttack`s that use the same session.
+        :return: The list of the adversarial examples of every attack.
+        """
+        members = []
+        for attack in attacks:
+            kwargs = attack._generate_kwargs(y_v, dict(attack.default_params))
+            fixed, feedable, hash_key = attack.attack.construct_variables(kwargs)
+            assert hash_key is not None, "Fault: attack {} has unhashable structural params, it can not be fused".format(attack.cfg["id"])
+            members.append((attack, fixed, {n: v for n, v in feedable.iteritems() if v is not None}, hash_key))
+        fused_key = (tuple(x_v.shape[1:]), tuple((attack.shared_key, hash_key) for attack, _, _, hash_key in members))
+        if fused_key not in cls.fused_graphs:
+            start = time.time()
+            xs = {} # one input placeholder per attack dtype
+            kwargs_phs = []
+            advs = []
+            for attack, fixed, feedable, _ in members:
+                c_attack = attack.attack
+                if c_attack.tf_dtype not in xs:
+                    xs[c_attack.tf_dtype] = tf.placeholder(c_attack.tf_dtype, shape=[None] + list(x_v.shape[1:]))
+                phs = {}
+                for name, value in feedable.iteritems():
+                    shape = [None] + list(value.shape[1:]) if isinstance(value, np.ndarray) else []
+                    phs[name] = tf.placeholder(c_attack.feedable_kwargs[name], shape=shape)
+                kwargs = dict(fixed)
+                kwargs.update(phs)
+                advs.append(c_attack.generate(xs[c_attack.tf_dtype], **kwargs))
+                kwargs_phs.append(phs)
+            cls.fused_graphs[fused_key] = (xs, kwargs_phs, advs)
+            utils.log("Attacks {}: constructed the fused graph in {:.2f} s".format(
+                [attack.cfg["id"] for attack in attacks], time.time() - start))
+        xs, kwargs_phs, advs = cls.fused_graphs[fused_key]
+        feed_dict = {x: x_v for x in xs.values()}
+        for (_, _, feedable, _), phs in zip(members, kwargs_phs):
+            feed_dict.update({phs[name]: value for name, value in feedable.iteritems()})
+        return attacks[0].sess.run(advs, feed_dict=feed_dict)
@@ -45,8 +45,9 @@ class MadryEtAl_KLloss(cleverhans.attacks.MadryEtAl):
         eta = eta / tf.norm(eta, ord=2) * self.eps
 
         x_p = tf.stop_gradient(tf.nn.softmax(self.model.get_logits(x)))
-        for i in range(self.nb_iter):
-            eta = self.attack_single_step(x, eta, x_p) # do not need y
+        _, eta = tf.while_loop(lambda i, _: i < self.nb_iter,
+                               lambda i, eta: [i + 1, self.attack_single_step(x, eta, x_p)], # do not need y
+                               [0, eta], back_prop=False)
         adv_x = x + eta
         return adv_x
 
@@ -62,9 +63,9 @@ class MadryEtAl_KLloss(cleverhans.attacks.MadryEtAl):
         import tensorflow as tf
 
         adv_x = x + eta
-        logits = self.model.get_logits(adv_x)
+        logits = self.model_logits(self.model, adv_x)
         loss = self.KL(x_p, tf.nn.softmax(logits))
-        grad, = tf.gradients(loss, adv_x)
+        grad, = tf.gradients(loss * getattr(self.model, "loss_scale", 1.), adv_x)
         eta = grad / tf.norm(grad, ord=2) * self.eps
         if self.clip_min is not None and self.clip_max is not None:
             adv_x = tf.clip_by_value(x + eta, self.clip_min, self.clip_max)
@@ -92,11 +93,11 @@ class MadryEtAl_L2(cleverhans.attacks.MadryEtAl):
 
         adv_x = x + eta
         model = self.model if self.transfer_model is not None else self.model
-        logits = model.get_logits(adv_x)
+        logits = self.model_logits(model, adv_x)
         loss = attack_softmax_cross_entropy(y, logits)
         if self.targeted:
             loss = -loss
-        grad, = tf.gradients(loss, adv_x)
+        grad, = tf.gradients(loss * getattr(model, "loss_scale", 1.), adv_x)
         axis = list(range(1, len(grad.shape)))
         avoid_zero_div = 1e-12
         # scaled_signed_grad = self.eps_iter * grad / tf.sqrt(tf.maximum(avoid_zero_div,
@@ -129,11 +130,11 @@ class MadryEtAl_transfer(cleverhans.attacks.MadryEtAl):
         from cleverhans.loss import attack_softmax_cross_entropy
 
         adv_x = x + eta
-        transfer_logits = self.transfer_model.get_logits(adv_x)
+        transfer_logits = self.model_logits(self.transfer_model, adv_x)
         transfer_loss = attack_softmax_cross_entropy(y, transfer_logits)
         if self.targeted:
             transfer_loss = -transfer_loss
-        grad, = tf.gradients(transfer_loss, adv_x)
+        grad, = tf.gradients(transfer_loss * getattr(self.transfer_model, "loss_scale", 1.), adv_x)
         scaled_signed_grad = self.eps_iter * tf.sign(grad)
         adv_x = adv_x + scaled_signed_grad
         if self.clip_min is not None and self.clip_max is not None:
@@ -146,7 +147,7 @@ class MadryEtAl_transfer(cleverhans.attacks.MadryEtAl):
 class MadryEtAl_transfer_re(MadryEtAl_transfer): # transfer and return early
     def __init__(self, model, transfer, back="tf", sess=None, dtypestr="float32"):
         super(MadryEtAl_transfer_re, self).__init__(model, transfer=transfer, back=back, sess=sess, dtypestr=dtypestr)
-        self.structural_kwargs = ["ord", "nb_iter", "rand_init", "min_nb_iter"]
+        self.structural_kwargs = ["ord", "nb_iter", "min_nb_iter", "nb_restart"]
 
     def parse_params(self, *args, **kwargs):
         self.min_nb_iter = kwargs.get("min_nb_iter", 0)
@@ -154,15 +155,8 @@ class MadryEtAl_transfer_re(MadryEtAl_transfer): # transfer and return early
 
     def attack(self, x, y):
         import tensorflow as tf
-        from cleverhans.utils_tf import clip_eta
-
-        if self.rand_init:
-            eta = tf.random_uniform(tf.shape(x), -self.eps, self.eps,
-                                    dtype=self.tf_dtype)
-            eta = clip_eta(eta, self.ord, self.eps)
-        else:
-            eta = tf.zeros_like(x)
 
+        eta = self.initial_eta(x)
 
         y_label = tf.argmax(y, axis=-1)
         predict = tf.argmax(self.model.get_logits(x), axis=-1)
@@ -193,18 +187,19 @@ class MadryEtAl_transfer_re(MadryEtAl_transfer): # transfer and return early
         # 3. Support batch_size > 1; it seems there are redundant calculation, but it will be actually more efficient as it can utilize the parallel computing power
         def next_step_eta(eta_):
             eta = self.attack_single_step(x, eta_, y)
-            predict = tf.argmax(self.model.get_logits(x + eta), axis=-1)
+            predict = tf.argmax(self.model_logits(self.model, x + eta), axis=-1)
             return [eta, predict]
 
-        if self.min_nb_iter > 0:
-            for iter_ in range(self.min_nb_iter):
-                eta = self.attack_single_step(x, eta, y)
-
-        for iter_ in range(self.min_nb_iter, self.nb_iter):
+        def return_early_step(i, eta, predict):
             still_correct = tf.equal(predict, y_label)
             new_eta, new_predict = next_step_eta(eta)
-            eta = tf.where(still_correct, new_eta, eta)
-            predict = tf.where(still_correct, new_predict, predict)
+            return [i + 1, tf.where(still_correct, new_eta, eta), tf.where(still_correct, new_predict, predict)]
+
+        _, eta = tf.while_loop(lambda i, _: i < self.min_nb_iter,
+                               lambda i, eta: [i + 1, self.attack_single_step(x, eta, y)],
+                               [0, eta], back_prop=False)
+        _, eta, _ = tf.while_loop(lambda i, _, __: i < self.nb_iter, return_early_step,
+                                  [self.min_nb_iter, eta, predict], back_prop=False)
 
         adv_x = x + eta
         if self.clip_min is not None and self.clip_max is not None:
@@ -232,12 +227,12 @@ class Langevin_transfer(MadryEtAl_transfer):
 
         noise = T * tf.random_normal(tf.shape(x), 0, np.sqrt(self.eps_iter), dtype=self.tf_dtype) # FIXME: 和gradient的具体大小无关吗..感觉需要有点关系吧... 或者做个pre-condition
         adv_x = x + eta + noise
-        transfer_logits = self.transfer_model.get_logits(adv_x)
+        transfer_logits = self.model_logits(self.transfer_model, adv_x)
         # **TODO**: you can add another prior, to guide the attack to generate smaller gradient. (maybe more preferable for better attack... try it)
         transfer_loss = attack_softmax_cross_entropy(y, transfer_logits) # 对于多张图片一起做一个adv pattern这个pattern会有语义吗...
         if self.targeted:
             transfer_loss = -transfer_loss
-        grad, = tf.gradients(transfer_loss, adv_x)
+        grad, = tf.gradients(transfer_loss * getattr(self.transfer_model, "loss_scale", 1.), adv_x)
         scaled_signed_grad = self.eps_iter * tf.sign(grad)
         adv_x = adv_x + scaled_signed_grad
         if self.clip_min is not None and self.clip_max is not None:
@@ -34,7 +34,7 @@ class Trainer(object):
         if self.FLAGS.test_only:
             if self.FLAGS.dataset.startswith("gray_"):
                 print("WARNINING: will not use gray dataset in test-only mode")
-                self.FLAGS.dataset = self.FLAGS.dataset[5:]
+                self.FLAGS.dataset = self.FLAGS.dataset.rsplit("_", 1)[-1]
         self.dataset = get_dataset_cls(self.FLAGS.dataset)(self.FLAGS)
 
     @classmethod
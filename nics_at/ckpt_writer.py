@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import glob
+import threading
+from six.moves import queue
+
+import tensorflow as tf
+
+from nics_at import utils
+
+class RetentionPolicy(object):
+    """
+    Decide which of the written checkpoints to keep. All the configured rules are unioned:
+        keep_last: keep the last `keep_last` checkpoints
+        keep_best: keep the `keep_best` checkpoints with the highest scores
+        keep_every: keep the checkpoints of epochs that are multiples of `keep_every`
+    Default to only keep the last 20 checkpoints (the same as `max_to_keep=20` of the savers).
+    """
+    def __init__(self, cfg=None):
+        cfg = cfg or {"keep_last": 20}
+        self.keep_last = cfg.get("keep_last", None)
+        self.keep_best = cfg.get("keep_best", None)
+        self.keep_every = cfg.get("keep_every", None)
+
+    def to_remove(self, records):
+        # records: list of (path, epoch, score) in the writing order
+        keep = set()
+        if self.keep_last:
+            keep.update(r[0] for r in records[-self.keep_last:])
+        if self.keep_best:
+            scored = [r for r in records if r[2] is not None]
+            keep.update(r[0] for r in sorted(scored, key=lambda r: r[2], reverse=True)[:self.keep_best])
+        if self.keep_every:
+            keep.update(r[0] for r in records if r[1] is not None and r[1] % self.keep_every == 0)
+        return [r for r in records if r[0] not in keep]
+
+class AsyncCheckpointWriter(object):
+    """
+    Snapshot the variable values into host memory in the calling thread, and write them as
+    normal tensorflow checkpoints from a background thread using a private CPU graph and session.
+    """
+    def __init__(self, var_mapping, retention=None, max_pending=2, name=""):
+        """
+        :param var_mapping: A dict of checkpoint variable name -> variable.
+        :param retention: (optional) The retention policy config, see `RetentionPolicy`.
+        :param max_pending: Maximum number of snapshots waiting to be written, `save` blocks when reached.
+        """
+        self.name = name
+        self.names = sorted(var_mapping.keys())
+        self.vars = [var_mapping[n] for n in self.names]
+        self.retention = RetentionPolicy(retention)
+        self.records = []
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, path, epoch=None, score=None):
+        values = sess.run(self.vars)
+        self.queue.put((path, values, epoch, score))
+
+    def _build_write_graph(self):
+        graph = tf.Graph()
+        with graph.as_default(), tf.device("/cpu:0"):
+            value_phs = [tf.placeholder(var.dtype.base_dtype, shape=var.get_shape()) for var in self.vars]
+            write_vars = [tf.Variable(ph, trainable=False, name="write_var_{}".format(i)) for i, ph in enumerate(value_phs)]
+            saver = tf.train.Saver(dict(zip(self.names, write_vars)), max_to_keep=None)
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={"GPU": 0}))
+        return sess, value_phs, [v.initializer for v in write_vars], saver
+
+    def _write_loop(self):
+        sess, value_phs, init_ops, saver = self._build_write_graph()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, values, epoch, score = item
+            try:
+                save_dir = os.path.dirname(path)
+                if save_dir and not os.path.exists(save_dir):
+                    os.makedirs(save_dir)
+                sess.run(init_ops, feed_dict=dict(zip(value_phs, values)))
+                saver.save(sess, path, write_meta_graph=False)
+                self.records.append((path, epoch, score))
+                for record in self.retention.to_remove(self.records):
+                    self._remove(record[0])
+                    self.records.remove(record)
+            except Exception as e:
+                utils.log("WARNING: checkpoint writer {} failed to write {}: {}".format(self.name, path, e))
+        sess.close()
+
+    def _remove(self, path):
+        for fname in glob.glob(path + ".*"):
+            os.remove(fname)
+        save_dir = os.path.dirname(path)
+        if save_dir and os.path.isdir(save_dir) and set(os.listdir(save_dir)) <= {"checkpoint"}:
+            [os.remove(os.path.join(save_dir, fname)) for fname in os.listdir(save_dir)]
+            os.rmdir(save_dir)
+
+    def close(self):
+        # wait for all the pending snapshots to be written
+        self.queue.put(None)
+        self.thread.join()
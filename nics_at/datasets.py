@@ -529,7 +529,7 @@ class SVHNDataset(Dataset):
         adv_imgs = tf.reshape(tf.stack(adv_imgs), (self.generated_adv_num, 32, 32, 3))
         return [img, auged_img, label, adv_imgs]
 
-from gray_datasets import GrayCifar10Dataset, GrayTIDataset
+from gray_datasets import GrayCifar10Dataset, GrayTIDataset, ProcessGrayCifar10Dataset, ProcessGrayTIDataset
 
 type_dataset_map = {
     "mnist": MnistDataset,
@@ -537,6 +537,8 @@ type_dataset_map = {
     "tinyimagenet": TinyImageNetDataset,
     "gray_cifar10": GrayCifar10Dataset,
     "gray_tinyimagenet": GrayTIDataset,
+    "gray_process_cifar10": ProcessGrayCifar10Dataset,
+    "gray_process_tinyimagenet": ProcessGrayTIDataset,
     "svhn": SVHNDataset
 }
 
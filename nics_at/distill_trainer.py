@@ -13,8 +13,14 @@ import tensorflow as tf
 from models import QCNN, QCNNProxy
 import utils
 from utils import AvailModels, LrAdjuster
-from attacks import Attack, AttackGenerator
+from tf_utils import compute_scaled_gradients, get_float32_regularization_loss
+from attacks import Attack, CleverhansAttack, AttackGenerator, warm_up_attacks
 from base_trainer import settings, Trainer
+from evaluator import BatchEvaluator
+from eval_runner import TestBatchCache, dump_test_results
+from ckpt_writer import AsyncCheckpointWriter
+from adv_store import AdvStoreWriter, AdvStoreReader
+from graph_cache import AttackGraphCache, get_config_hash
 
 class DistillTrainer(Trainer):
     class _settings(settings):
@@ -31,6 +37,9 @@ class DistillTrainer(Trainer):
             # only use when using subclass of GrayDataset
             "gray_dataset_device": 1,
             "sync_every": 5,
+            "gray_attack_batch_size": None, # default to `batch_size`
+            "gray_prefetch_batches": 4,
+            "gray_attack_threads": 1,
             "additional_models_gray": [],
             "available_attacks_gray": [],
 
@@ -42,6 +51,12 @@ class DistillTrainer(Trainer):
             "gradient_norm_reg": 0,
             "gradient_norm_reg_ord": 1,
             "multiple_head_loss": False,
+            "precision": "float32", # "float16": build the models in half precision (with float32 master weights)
+            "loss_scale": 128., # only used in float16 models
+            "async_save": False, # write checkpoints from a background thread
+            "save_retention": None, # e.g. {"keep_last": 5, "keep_best": 3, "keep_every": 10}; default to keep the last 20
+            "adv_store": None, # e.g. {"store_dir": "advs", "shard_size": 5000, "keys": None}; store the generated training adversarials
+            "stored_adv": [], # e.g. [{"store_dir": "advs", "key": "pgd", "epoch": None}]; use the stored adversarials as `__generated__` ones
             "use_mixup": False,
             "mixup_alpha": 1.0,
             "distill_use_auged": False, # 一个谜一样的bug
@@ -63,6 +78,7 @@ class DistillTrainer(Trainer):
             # Testing
             "test_saltpepper": None,
             "test_models": {},
+            "test_eval_batch_size": None, # maximum number of concatenated clean/adv rows evaluated in one run
 
             # Augmentaion
             "aug_saltpepper": None,
@@ -70,6 +86,10 @@ class DistillTrainer(Trainer):
 
             # Adversarial Augmentation
             "available_attacks": [],
+            "attack_warm_up": False, # construct the graphs of all the scheduled attacks while the checkpoints are read, instead of on their first use
+            "attack_warm_up_run": False, # also run every scheduled attack once on a dummy batch in the warm-up
+            "fuse_attacks": False, # generate all the white-box adversarials of a batch in one graph execution, sharing the clean forward passes
+            "attack_graph_cache": None, # a directory; cache the constructed attack graphs as MetaGraphs keyed by the config hash, repeated runs import them instead of constructing
             "generated_adv": [],
             "train_merge_adv": False,
             "split_adv": False,
@@ -97,6 +117,8 @@ class DistillTrainer(Trainer):
         self.stu_x = tf.placeholder(tf.float32, shape=[None] + list(self.dataset.image_shape), name="stu_x")
         self.labels = tf.placeholder(tf.float32, [None, self.dataset.num_labels], name="labels")
 
+        QCNN.default_precision = self.FLAGS.precision
+        QCNN.default_loss_scale = self.FLAGS.loss_scale
         self.model_stu = QCNN.create_model(self.FLAGS["model"])
         self.logits_stu = self.model_stu.get_logits(self.stu_x)
         AvailModels.add(self.model_stu, self.stu_x, self.logits_stu)
@@ -167,7 +189,8 @@ class DistillTrainer(Trainer):
 
         self.loss = self.original_loss * self.FLAGS.theta
         if self.FLAGS.gradient_smooth_reg or self.FLAGS.gradient_norm_reg: 
-            self.input_gradient = tf.gradients(self.original_loss * self.FLAGS.theta, self.stu_x)[0]
+            loss_scale = self.model_stu.loss_scale
+            self.input_gradient = tf.gradients(self.original_loss * self.FLAGS.theta * loss_scale, self.stu_x)[0] / loss_scale
         if self.FLAGS.gradient_smooth_reg:
             # input gradient smoothness of crossentropy loss
             vert_grad_diff = self.input_gradient[:, :-1, :, :] - self.input_gradient[:, 1:, :, :]
@@ -203,7 +226,7 @@ class DistillTrainer(Trainer):
         else:
             self.at_loss = tf.constant(0.0)
         # Add regularization loss
-        self.loss += tf.losses.get_regularization_loss()
+        self.loss += get_float32_regularization_loss()
 
         self.index_label = tf.argmax(self.labels, -1)
         _tmp = tf.expand_dims(self.index_label, -1)
@@ -217,6 +240,22 @@ class DistillTrainer(Trainer):
         else:
             self.tea_accuracy = self.accuracy
 
+        # Evaluate clean and all adversarial variants of a validation batch in one run
+        self.evaluator = BatchEvaluator(self.dataset.image_shape, self.num_labels, max_rows=self.FLAGS.test_eval_batch_size)
+        if not self.FLAGS.multiple_head_loss:
+            eval_loss_fn = None
+        else:
+            def eval_loss_fn(labels):
+                head_logits = self.model_stu.cached[self.stu_x]["group_logits_list"] + [self.logits_stu]
+                return tf.reduce_mean([self.FLAGS.multiple_head_loss[i] * tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits) for i, logits in enumerate(head_logits)], axis=0)
+        self.evaluator.add_group([self.stu_x, self.x], [self.logits_stu, self.logits if self.FLAGS.alpha != 0 else self.logits_stu],
+                                 loss_fn=eval_loss_fn, training=[self.training_stu])
+        # the models whose weights change with the tested checkpoints
+        self.evaluated_mids = set(mid for mid, (m, _, _) in AvailModels.registries[None].items()
+                                  if m is self.model_stu or getattr(m, "proxy_model", None) is self.model_stu or
+                                  (self.FLAGS.use_denoiser and m is self.model_stu.inner_model))
+        self.test_cache = None
+
         # Initialize the optimizer
         self.learning_rate = tf.placeholder(tf.float32, shape=[])
         self.lr_adjuster = LrAdjuster.create_adjuster(self.FLAGS.adjust_lr_acc)
@@ -232,14 +271,14 @@ class DistillTrainer(Trainer):
             tvs = tf.trainable_variables()
             accum_vars = [tf.Variable(tf.zeros_like(tv), trainable=False) for tv in tvs]
             self.zero_agrad_op = [tv.assign(tf.zeros_like(tv)) for tv in accum_vars]
-            self.grads_and_vars = optimizer.compute_gradients(self.loss, tvs)
+            self.grads_and_vars = compute_scaled_gradients(optimizer, self.loss, self.model_stu.loss_scale, var_list=tvs)
             # NOTE: the batch norm update is done every small iter (hope it will not cause severe vibration)
             with tf.control_dependencies(update_ops):
                 self.accum_ops = [accum_vars[i].assign_add(gv[0]) for i, gv in enumerate(self.grads_and_vars)]
             self.train_step = optimizer.apply_gradients([(accum_vars[i], gv[1]) for i, gv in enumerate(self.grads_and_vars)])
         else:
             with tf.control_dependencies(update_ops):
-                self.grads_and_var = optimizer.compute_gradients(self.loss)
+                self.grads_and_var = compute_scaled_gradients(optimizer, self.loss, self.model_stu.loss_scale)
                 self.train_step = optimizer.apply_gradients(self.grads_and_var)
 
         # Initialize relu thrshold schedule adjuster
@@ -250,10 +289,14 @@ class DistillTrainer(Trainer):
         config.gpu_options.allow_growth = True
         config.allow_soft_placement = True
         self.sess = tf.Session(config=config)
+        if self.FLAGS.attack_graph_cache:
+            CleverhansAttack.graph_cache = AttackGraphCache(self.FLAGS.attack_graph_cache, get_config_hash(self.FLAGS.dct, {"use_denoiser": self.FLAGS.use_denoiser, "test_only": self.FLAGS.test_only}))
         [Attack.create_attack(self.sess, a_cfg) for a_cfg in (self.FLAGS["available_attacks"] or [])]
+        self.adv_store = AdvStoreWriter(**self.FLAGS.adv_store) if self.FLAGS.adv_store and not self.FLAGS.test_only else None
         self.train_attack_gen = AttackGenerator(self.FLAGS["train_models"], merge=self.FLAGS.train_merge_adv, split_adv=self.FLAGS.split_adv, random_split_adv=self.FLAGS.random_split_adv,
-                                                random_interp=self.FLAGS.random_interp, random_interp_adv=self.FLAGS.random_interp_adv, mixup_alpha=self.FLAGS.mixup_alpha, name="train")
-        self.test_attack_gen = AttackGenerator(self.FLAGS["test_models"], split_adv=self.FLAGS.test_split_adv, random_interp_adv=self.FLAGS.test_random_interp_adv, name="test")
+                                                random_interp=self.FLAGS.random_interp, random_interp_adv=self.FLAGS.random_interp_adv, mixup_alpha=self.FLAGS.mixup_alpha,
+                                                adv_store=self.adv_store, stored_advs=[AdvStoreReader(**r_cfg) for r_cfg in self.FLAGS.stored_adv or []], fuse_attacks=self.FLAGS.fuse_attacks, name="train")
+        self.test_attack_gen = AttackGenerator(self.FLAGS["test_models"], split_adv=self.FLAGS.test_split_adv, random_interp_adv=self.FLAGS.test_random_interp_adv, fuse_attacks=self.FLAGS.fuse_attacks, name="test")
 
     def train(self):
         sess = self.sess
@@ -291,7 +334,7 @@ class DistillTrainer(Trainer):
                 fetch_time += time.time() - fetch_start_time
 
                 gen_start_time = time.time()
-                _, adv_xs, ys = self.train_attack_gen.generate_for_model(auged_x_v, y_v, self.FLAGS.model["namescope"], adv_x_v)
+                _, adv_xs, ys = self.train_attack_gen.generate_for_model(auged_x_v, y_v, self.FLAGS.model["namescope"], adv_x_v, clean_x=x_v)
                 gen_time += time.time() - gen_start_time
                 inner_info_v = []
                 run_start_time = time.time()
@@ -348,21 +391,28 @@ class DistillTrainer(Trainer):
                 if self.FLAGS.train_dir:
                     if is_best or (self.FLAGS.save_every > 0 and epoch % self.FLAGS.save_every == 0):
                         save_path = os.path.join(self.FLAGS.train_dir, str(epoch))
-                        self.model_stu.save_checkpoint(save_path, sess)
-                        utils.log("Saved student model to: ", save_path)
+                        if self.ckpt_writer is not None:
+                            self.ckpt_writer.save(sess, save_path, epoch=epoch, score=np.mean(test_accs))
+                            utils.log("Snapshotted student model, will be saved to: ", save_path)
+                        else:
+                            self.model_stu.save_checkpoint(save_path, sess)
+                            utils.log("Saved student model to: ", save_path)
                 self.dataset.sync_epoch(epoch)
 
     def test(self, saltpepper=None, adv=False, name=""):
         sess = self.sess
-        steps_per_epoch = self.dataset.val_num // self.FLAGS.batch_size
-        loss_v_epoch = 0
-        acc_v_epoch = 0
-        tea_acc_v_epoch = 0
-        image_disturb = 0
+        cache = self.test_cache
+        replay = cache is not None and cache.replayable
+        steps_per_epoch = cache.num_steps if replay else self.dataset.val_num // self.FLAGS.batch_size
+        clean_res = np.zeros(4)
         test_res = OrderedDict()
         for step in range(1, steps_per_epoch+1):
             self.test_attack_gen.new_batch()
-            x_v, auged_x_v, y_v, adv_x_v = sess.run([self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v])
+            if replay: # replay the recorded batch and the adversarials that do not depend on the tested model
+                (x_v, auged_x_v, y_v, adv_x_v), shared_advs = cache.get(step)
+            else:
+                x_v, auged_x_v, y_v, adv_x_v = sess.run([self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v])
+                shared_advs = {} if cache is not None else None
             print("\rTesting {}/{}".format(step, steps_per_epoch), end="")
             if saltpepper is not None: # during test, saltpepper is added at last, this is a train-test discrepancy, but i don't think it matters
                 img = x_v
@@ -373,46 +423,52 @@ class DistillTrainer(Trainer):
                 auged_x = img
             else:
                 auged_x = x_v
-            acc_v, tea_acc_v, loss_v = sess.run([self.accuracy, self.tea_accuracy, self.original_loss], feed_dict={
-                self.x: auged_x,
-                self.stu_x: auged_x,
-                self.labels: y_v,
-                self.training_stu: False
-            })
-            image_disturb += np.abs(auged_x - x_v).mean()
-            loss_v_epoch += loss_v
-            acc_v_epoch += acc_v
-            tea_acc_v_epoch += tea_acc_v
-            # test adv
+            # The clean examples' distance is measured to `x_v`, adversarial examples' distance is measured to `auged_x_v`
+            batch_size = x_v.shape[0]
+            variants = [(auged_x, np.arange(batch_size))]
+            test_ids = []
             if adv:
-                test_ids, adv_xs, _ = self.test_attack_gen.generate_for_model(auged_x_v, y_v, "stu_", adv_x_v)
-                for test_id, adv_x in zip(test_ids, adv_xs):
-                    acc_v, tea_acc_v, loss_v = sess.run([self.accuracy, self.tea_accuracy, self.original_loss], feed_dict={
-                        self.stu_x: adv_x,
-                        self.x: adv_x,
-                        self.labels: y_v,
-                        self.training_stu: False
-                    })
-                    if test_id not in test_res:
-                        test_res[test_id] = np.zeros(4)
-                    if adv_x.shape != auged_x_v.shape:
-                        sp = [auged_x_v.shape[0], adv_x.shape[0] / auged_x_v.shape[0]] + list(auged_x_v.shape[1:])
-                        tmp_adv_x = adv_x.reshape(sp)
-                        sp[1] = 1
-                        mean_dist = np.mean(np.abs(tmp_adv_x - auged_x_v.reshape(sp)))
-                    else:
-                        mean_dist = np.mean(np.abs(adv_x - auged_x_v)) # L1 dist
-                    test_res[test_id] += [acc_v, tea_acc_v, loss_v, mean_dist]
-        image_disturb /= steps_per_epoch
-        loss_v_epoch /= steps_per_epoch
-        acc_v_epoch /= steps_per_epoch
-        tea_acc_v_epoch /= steps_per_epoch
+                test_ids, adv_xs, _ = self.test_attack_gen.generate_for_model(auged_x_v, y_v, "stu_", adv_x_v, shared_advs=shared_advs,
+                                                                              evaluated_mids=self.evaluated_mids)
+                variants += [(adv_x, BatchEvaluator.get_index(adv_x, batch_size, batch_size)) for adv_x in adv_xs]
+            if cache is not None and not replay:
+                cache.put(step, (x_v, auged_x_v, y_v, adv_x_v), shared_advs)
+            # [number of variants, 4]: acc, tea_acc, ce_loss, dist
+            res = self.evaluator.evaluate(sess, np.concatenate([x_v, auged_x_v]), np.concatenate([y_v, y_v]), [variants])[0]
+            clean_res += res[0]
+            for test_id, attack_res in zip(test_ids, res[1:]):
+                if test_id not in test_res:
+                    test_res[test_id] = np.zeros(4)
+                test_res[test_id] += attack_res
+        if cache is not None and adv:
+            cache.finish()
+        acc_v_epoch, tea_acc_v_epoch, loss_v_epoch, image_disturb = clean_res / steps_per_epoch
+        self.last_test_res = OrderedDict([("normal", clean_res / steps_per_epoch)] + [(test_id, attack_res / steps_per_epoch) for test_id, attack_res in test_res.items()])
         print("\r", end="")
         utils.log("\tTest {}: \n\t\tloss: {}; accuracy: {:.2f} %; teacher accuracy: {:.2f} %; Mean pixel distance: {:.2f}".format(name, loss_v_epoch, acc_v_epoch * 100, tea_acc_v_epoch * 100, image_disturb))
         if adv:
             utils.log("\tAdv:\n\t\t{}".format("\n\t\t".join(["test {}: acc: {:.3f}; tea_acc: {:.3f}; ce_loss: {:.2f}; dist: {:.2f}".format(test_id, *(attack_res/steps_per_epoch)) for test_id, attack_res in test_res.items()])), flush=True)
         return [acc_v_epoch] + [v[0]/steps_per_epoch for v in test_res.values()]
 
+    def warm_up_attacks(self):
+        if not self.FLAGS.attack_warm_up:
+            return
+        attack_ids = self.train_attack_gen.get_attack_ids()
+        attack_ids += [aid for aid in self.test_attack_gen.get_attack_ids() if aid not in attack_ids]
+        warm_up_attacks(attack_ids, self.dataset.image_shape, self.num_labels, self.FLAGS.batch_size, run=self.FLAGS.attack_warm_up_run)
+
+    def load_models(self, loads):
+        """
+        Read the checkpoints in background threads while warming up the attacks, then assign them.
+        :param loads: A list of (model, checkpoint path, load namescope, exclude pattern)
+        """
+        # the denoiser models are loaded from multiple checkpoints, which is not supported by prefetching
+        prefetched = [model.prefetch_checkpoint(path, namescope, exclude_pattern=exclude) if not isinstance(path, (list, tuple)) else None
+                      for model, path, namescope, exclude in loads]
+        self.warm_up_attacks()
+        for (model, path, namescope, exclude), pre in zip(loads, prefetched):
+            model.load_checkpoint(path, self.sess, namescope, exclude_pattern=exclude, **({"prefetched": pre} if pre is not None else {}))
+
     def start(self):
         sess = self.sess
         if self.FLAGS.train_dir:
@@ -427,10 +483,11 @@ class DistillTrainer(Trainer):
 
             self.dataset.start(sess)
 
+            loads = []
             # Load teacher model
             if self.FLAGS.load_file_tea:
                 if self.FLAGS.alpha != 0:
-                    self.model_tea.load_checkpoint(self.FLAGS.load_file_tea, self.sess, self.FLAGS.load_namescope_tea)
+                    loads.append((self.model_tea, self.FLAGS.load_file_tea, self.FLAGS.load_namescope_tea, []))
             if not self.FLAGS.load_file_stu:
                 load_namescope_stu = self.FLAGS["teacher"]["namescope"] if self.FLAGS.load_namescope_tea is None else self.FLAGS.load_namescope_tea
                 load_file_stu = self.FLAGS.load_file_tea
@@ -439,23 +496,42 @@ class DistillTrainer(Trainer):
                 load_file_stu = self.FLAGS.load_file_stu
             # Load student model
             if self.FLAGS.use_denoiser:
-                self.model_stu.load_checkpoint([self.FLAGS.load_file_den, load_file_stu], self.sess, [self.FLAGS.load_namescope_den, load_namescope_stu], exclude_pattern=self.FLAGS.load_exclude)
+                loads.append((self.model_stu, [self.FLAGS.load_file_den, load_file_stu], [self.FLAGS.load_namescope_den, load_namescope_stu], self.FLAGS.load_exclude))
             else:
-                self.model_stu.load_checkpoint(load_file_stu, self.sess, load_namescope_stu, exclude_pattern=self.FLAGS.load_exclude)
+                loads.append((self.model_stu, load_file_stu, load_namescope_stu, self.FLAGS.load_exclude))
             for m, l_namescope, l_file in zip(self.additional_models, [m_cfg["load_namescope"] for m_cfg in self.FLAGS.additional_models], [m_cfg["checkpoint"] for m_cfg in self.FLAGS.additional_models]):
-                m.load_checkpoint(l_file, self.sess, l_namescope)
+                loads.append((m, l_file, l_namescope, []))
+            self.load_models(loads)
             # Testing
-            self.test(adv=True, name="test stu")
+            if self.FLAGS.test_cache_dir:
+                # record the validation batches and model-independent adversarials once, and replay them for other checkpoints
+                self.test_cache = TestBatchCache(self.FLAGS.test_cache_dir, {k: self.FLAGS[k] for k in [
+                    "dataset", "dataset_info", "batch_size", "test_models", "available_attacks", "additional_models", "generated_adv",
+                    "more_augs", "aug_saltpepper", "aug_gaussian", "test_saltpepper", "test_split_adv", "test_random_interp_adv"]})
+            test_results = OrderedDict()
+            if not self.FLAGS.no_stu_test:
+                self.test(adv=True, name="test stu")
+                test_results[str(load_file_stu)] = self.last_test_res
             if self.FLAGS.load_file_test: # additional student test models
+                # read the next checkpoint in a background thread while testing the current one
+                prefetch = lambda path: None if self.FLAGS.use_denoiser else \
+                           self.model_stu.prefetch_checkpoint(path, load_namescope_stu, exclude_pattern=self.FLAGS.load_exclude)
+                prefetched = prefetch(self.FLAGS.load_file_test[0])
                 for i, test_model in enumerate(self.FLAGS.load_file_test):
-                    self.model_stu.load_checkpoint(test_model, self.sess, load_namescope_stu, exclude_pattern=self.FLAGS.load_exclude)
+                    self.model_stu.load_checkpoint(test_model, self.sess, load_namescope_stu, exclude_pattern=self.FLAGS.load_exclude,
+                                                   **({"prefetched": prefetched} if prefetched is not None else {}))
+                    if i + 1 < len(self.FLAGS.load_file_test):
+                        prefetched = prefetch(self.FLAGS.load_file_test[i + 1])
                     self.test(adv=True, name="test additionan {} {}".format(i, os.path.basename(test_model)))
+                    test_results[test_model] = self.last_test_res
             elif self.FLAGS.test_saltpepper is not None:
                 if isinstance(self.FLAGS.test_saltpepper, (tuple, list)):
                     for sp in self.FLAGS.test_saltpepper:
                         self.test(saltpepper=sp, adv=False, name="saltpepper_{}".format(sp))
                 else:
                     self.test(saltpepper=self.FLAGS.test_saltpepper, adv=False, name="saltpepper_{}".format(self.FLAGS.test_saltpepper))
+            if self.FLAGS.test_results:
+                dump_test_results(self.FLAGS.test_results, test_results, ["acc", "tea_acc", "ce_loss", "dist"])
             self.dataset.end()
             sys.exit(0)
 
@@ -463,9 +539,10 @@ class DistillTrainer(Trainer):
         if not self.FLAGS.scratch and ((not self.FLAGS.alpha or self.FLAGS.distill_self) and not self.FLAGS.load_file_stu) or ((self.FLAGS.alpha and not self.FLAGS.distill_self) and not self.FLAGS.load_file_tea):
             utils.log("error: no input file. Must supply teacher model for training with disstillation; or student model for training without distillation or distill self.")
             sys.exit(1)
+        loads = []
         # Load teacher model
         if self.FLAGS.alpha != 0 and not self.FLAGS.distill_self:
-            self.model_tea.load_checkpoint(self.FLAGS.load_file_tea, self.sess, self.FLAGS.load_namescope_tea)
+            loads.append((self.model_tea, self.FLAGS.load_file_tea, self.FLAGS.load_namescope_tea, []))
         if not self.FLAGS.scratch: # if not train from scratch, load student model
             if not self.FLAGS.load_file_stu:
                 load_namescope_stu = self.FLAGS["teacher"]["namescope"] if self.FLAGS.load_namescope_tea is None else self.FLAGS.load_namescope_tea
@@ -475,9 +552,10 @@ class DistillTrainer(Trainer):
                 load_file_stu = self.FLAGS.load_file_stu
             # Load student model
             if self.FLAGS.use_denoiser:
-                self.model_stu.load_checkpoint([self.FLAGS.load_file_den, load_file_stu], self.sess, [self.FLAGS.load_namescope_den, load_namescope_stu], exclude_pattern=self.FLAGS.load_exclude)
+                loads.append((self.model_stu, [self.FLAGS.load_file_den, load_file_stu], [self.FLAGS.load_namescope_den, load_namescope_stu], self.FLAGS.load_exclude))
             else:
-                self.model_stu.load_checkpoint(load_file_stu, self.sess, load_namescope_stu, exclude_pattern=self.FLAGS.load_exclude)
+                loads.append((self.model_stu, load_file_stu, load_namescope_stu, self.FLAGS.load_exclude))
+        self.load_models(loads)
 
         # Start the dataset threads; start the dataset after model stu is loaded, in case there are following models to be copied (for graybox dataset);
         # **NOTE**: this might incur a even longer delay for the init-test or the first training batch (these delay is not avoidable for graybox dataset)
@@ -498,8 +576,20 @@ class DistillTrainer(Trainer):
         self.info_attr_names = ["accuracy", "tea_accuracy", "loss"] + self.FLAGS.additional_info_attrs
         self.info_attrs = [getattr(self, name) for name in self.info_attr_names]
         print("will print additional informations during training: ", self.FLAGS.additional_info_attrs)
+        self.ckpt_writer = None
+        if self.FLAGS.async_save and self.FLAGS.train_dir:
+            if self.FLAGS.use_denoiser:
+                utils.log("WARNING: async_save is not supported with denoiser, will save checkpoints synchronously")
+            else:
+                self.ckpt_writer = AsyncCheckpointWriter(self.model_stu.get_save_var_mapping(), retention=self.FLAGS.save_retention, name="student")
         utils.log("Start training...")
         self.train()
+        if self.ckpt_writer is not None:
+            utils.log("Waiting for the pending checkpoints to be written...")
+            self.ckpt_writer.close()
+        if self.adv_store is not None:
+            utils.log("Waiting for the pending adversarial examples to be stored...")
+            self.adv_store.close()
 
         self.dataset.end()
 
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import sys
+import json
+import yaml
+import hashlib
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+
+from nics_at import utils
+
+class TestBatchCache(object):
+    """
+    Record the validation batches together with the adversarial examples that do not depend on the evaluated model
+    (e.g. transfer attacks from other models), and replay them when testing other checkpoints.
+    When `cache_dir` is given, the batches are stored as `.npz` files, so that multiple worker processes can share them.
+    The hash of `config` (the configurations that decide the batches, e.g. the dataset, the batch size, the attacks and
+    the augmentations) is stored with the batches, the batches recorded with another configuration are recorded again.
+    """
+    META_FILE = "meta.yaml"
+
+    def __init__(self, cache_dir=None, config=None):
+        self.cache_dir = cache_dir
+        self.config_hash = hashlib.md5(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        self.batches = []
+        self.num_steps = 0
+        self.replayable = False
+        if self.cache_dir is not None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            meta_fname = os.path.join(self.cache_dir, self.META_FILE)
+            if os.path.exists(meta_fname):
+                with open(meta_fname, "r") as meta_f:
+                    meta = yaml.load(meta_f)
+                if meta.get("config_hash", None) == self.config_hash:
+                    self.num_steps = meta["num_steps"]
+                    self.replayable = True
+                    utils.log("Will replay {} test batches from {}".format(self.num_steps, self.cache_dir))
+                else:
+                    utils.log("WARNING: the test batches in {} are recorded with another configuration, record them again".format(self.cache_dir))
+                    os.remove(meta_fname)
+
+    def _batch_fname(self, step):
+        return os.path.join(self.cache_dir, "batch_{}.npz".format(step))
+
+    def put(self, step, batch, shared_advs):
+        assert not self.replayable, "Fault: TestBatchCache is already recorded"
+        keys = list(shared_advs.keys())
+        if self.cache_dir is None:
+            self.batches.append((batch, dict(shared_advs)))
+        else:
+            arrays = {"batch_{}".format(i): v for i, v in enumerate(batch)}
+            arrays.update({"adv_{}".format(i): shared_advs[k] for i, k in enumerate(keys)})
+            np.savez(self._batch_fname(step), adv_keys=np.array(keys, dtype=str), **arrays)
+        self.num_steps = step
+
+    def get(self, step):
+        if self.cache_dir is None:
+            return self.batches[step - 1]
+        data = np.load(self._batch_fname(step))
+        batch = [data["batch_{}".format(i)] for i in range(4)]
+        shared_advs = {k: data["adv_{}".format(i)] for i, k in enumerate(data["adv_keys"])}
+        return batch, shared_advs
+
+    def finish(self):
+        if self.replayable:
+            return
+        self.replayable = True
+        if self.cache_dir is not None:
+            with open(os.path.join(self.cache_dir, self.META_FILE), "w") as meta_f:
+                yaml.dump({"num_steps": self.num_steps, "config_hash": self.config_hash}, meta_f)
+        utils.log("Recorded {} test batches{}".format(self.num_steps, " to " + self.cache_dir if self.cache_dir else ""))
+
+def dump_test_results(fname, results, metric_names):
+    # results: OrderedDict of checkpoint -> OrderedDict of test_id -> metrics
+    with open(fname, "w") as r_f:
+        yaml.dump({
+            "metrics": list(metric_names),
+            "results": [[str(ckpt), [[str(test_id), [float(v) for v in res]] for test_id, res in ckpt_res.items()]]
+                        for ckpt, ckpt_res in results.items()]
+        }, r_f)
+
+def load_test_results(fname):
+    with open(fname, "r") as r_f:
+        content = yaml.load(r_f)
+    return content["metrics"], OrderedDict([(ckpt, OrderedDict([(test_id, res) for test_id, res in ckpt_res]))
+                                            for ckpt, ckpt_res in content["results"]])
+
+def write_results_table(fname, results, metric_names):
+    test_ids = []
+    [test_ids.append(test_id) for ckpt_res in results.values() for test_id in ckpt_res if test_id not in test_ids]
+    with open(fname, "w") as t_f:
+        t_f.write("\t".join(["checkpoint"] + ["{}/{}".format(test_id, m) for test_id in test_ids for m in metric_names]) + "\n")
+        for ckpt, ckpt_res in results.items():
+            t_f.write("\t".join([ckpt] + ["{:.4f}".format(ckpt_res[test_id][i]) if test_id in ckpt_res else "-"
+                                          for test_id in test_ids for i in range(len(metric_names))]) + "\n")
+
+def _strip_options(argv, options):
+    # remove top-level options(and their values) from the command line
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        if arg in options:
+            skip = True
+            continue
+        if arg.split("=", 1)[0] in options:
+            continue
+        stripped.append(arg)
+    return stripped
+
+def run_parallel_test(args, argv):
+    """
+    Score the student checkpoint and all `--load-file-test` checkpoints with `args.test_workers` worker processes.
+
+    1. A recording worker tests the student checkpoint, and records the validation batches and
+       the model-independent adversarial examples into the shared test cache directory;
+    2. The `--load-file-test` checkpoints are sharded among the worker processes (one GPU in `--gpu` per worker),
+       and all workers replay the recorded batches instead of regenerating them;
+    3. The results of all workers are consolidated into one table.
+    """
+    gpus = args.gpu.split(",")
+    cache_dir = args.test_cache_dir or tempfile.mkdtemp(prefix="nics_at_test_cache_")
+    table_fname = args.test_results or os.path.join(cache_dir, "results.tsv")
+    base_argv = _strip_options(argv[1:], {"--gpu", "--test-workers", "--load-file-test", "--test-results", "--test-cache-dir"})
+    cmd_prefix = [sys.executable, argv[0]]
+
+    def _worker_cmd(gpu, results_fname, ckpts, no_stu_test=False):
+        cmd = cmd_prefix + ["--gpu", gpu, "--test-cache-dir", cache_dir, "--test-results", results_fname]
+        if no_stu_test:
+            cmd.append("--no-stu-test")
+        for ckpt in ckpts:
+            cmd += ["--load-file-test", ckpt]
+        return cmd + base_argv
+
+    # 1. record
+    record_results = os.path.join(cache_dir, "results_record.yaml")
+    utils.log("Recording test batches into {} ...".format(cache_dir))
+    subprocess.check_call(_worker_cmd(gpus[0], record_results, []))
+
+    # 2. evaluate the shards in parallel
+    num_workers = min(args.test_workers, len(args.load_file_test))
+    procs = []
+    for i in range(num_workers):
+        shard = args.load_file_test[i::num_workers]
+        results_fname = os.path.join(cache_dir, "results_{}.yaml".format(i))
+        utils.log("Worker {}: gpu {}; {} checkpoints".format(i, gpus[i % len(gpus)], len(shard)))
+        procs.append((subprocess.Popen(_worker_cmd(gpus[i % len(gpus)], results_fname, shard, no_stu_test=True)), results_fname))
+    failed = [i for i, (proc, _) in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        utils.log("WARNING: test workers {} failed, their results are missing".format(failed))
+
+    # 3. consolidate
+    metric_names, results = load_test_results(record_results)
+    for i, (_, results_fname) in enumerate(procs):
+        if i not in failed:
+            results.update(load_test_results(results_fname)[1])
+    write_results_table(table_fname, results, metric_names)
+    utils.log("Wrote the results table of {} checkpoints to {}".format(len(results), table_fname))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+class BatchEvaluator(object):
+    """
+    Evaluate all the clean/adversarial variants of a batch for multiple models with one `sess.run`.
+
+    Every variant is a block of rows, all the variants of a model (group) are concatenated along the batch axis.
+    Each row references a sample of the fed `ref_x`/`labels` by index, and the per-row metrics
+    (accuracy of every logits, loss, L1 distance to the referenced sample) are reduced into per-variant sums on device.
+    """
+    def __init__(self, image_shape, num_labels, max_rows=None, name="batch_evaluator"):
+        self.name = name
+        self.max_rows = max_rows # split the concatenated rows into multiple runs when there are too many rows
+        self.groups = []
+        with tf.name_scope(self.name):
+            self.ref_x = tf.placeholder(tf.float32, shape=[None] + list(image_shape), name="ref_x")
+            self.labels = tf.placeholder(tf.float32, shape=[None, num_labels], name="labels")
+
+    def add_group(self, inputs, logits_lst, loss_fn=None, training=None):
+        """
+        :param inputs: Input placeholders which are all fed with the concatenated rows of this group.
+        :param logits_lst: Logits tensors (of the inputs) whose accuracies are evaluated.
+        :param loss_fn: (optional) A callable that returns the per-row loss given the per-row labels,
+                        default to the crossentropy loss of `logits_lst[0]`.
+        :param training: (optional) Training status placeholders that will be fed with False.
+        :return: The index of the group. The metrics of every variant are ordered as: accuracies of `logits_lst`, loss, L1 dist.
+        """
+        with tf.name_scope(self.name):
+            index = tf.placeholder(tf.int32, shape=[None], name="index")
+            segment_ids = tf.placeholder(tf.int32, shape=[None], name="segment_ids")
+            num_segments = tf.placeholder(tf.int32, shape=[], name="num_segments")
+            labels = tf.gather(self.labels, index)
+            index_label = tf.argmax(labels, -1)
+            metrics = [tf.cast(tf.equal(tf.argmax(logits, -1), index_label), tf.float32) for logits in logits_lst]
+            if loss_fn is None:
+                metrics.append(tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits_lst[0]))
+            else:
+                metrics.append(loss_fn(labels))
+            axes = list(range(1, len(inputs[0].get_shape())))
+            metrics.append(tf.reduce_mean(tf.abs(inputs[0] - tf.gather(self.ref_x, index)), axis=axes))
+            sums = tf.unsorted_segment_sum(tf.stack(metrics, axis=1), segment_ids, num_segments)
+            counts = tf.unsorted_segment_sum(tf.ones_like(segment_ids, dtype=tf.float32), segment_ids, num_segments)
+        training = [t for t in (training or []) if isinstance(t, tf.Tensor)]
+        self.groups.append({
+            "inputs": inputs,
+            "training": training,
+            "index": index,
+            "segment_ids": segment_ids,
+            "num_segments": num_segments,
+            "fetches": (sums, counts)
+        })
+        return len(self.groups) - 1
+
+    @staticmethod
+    def get_index(rows, ref_start, ref_num):
+        """
+        The index of the referenced samples of `rows`, every `ref_num` samples starting at `ref_start` of `ref_x` are
+        referenced by `rows.shape[0] // ref_num` consecutive rows. (e.g. [batch_size * adv_num, ...] __generated__ adversarials)
+        """
+        return ref_start + np.repeat(np.arange(ref_num), rows.shape[0] // ref_num)
+
+    def evaluate(self, sess, ref_x, labels, group_variants):
+        """
+        :param ref_x: The referenced images used to calculate the L1 distance.
+        :param labels: The one-hot labels of `ref_x`.
+        :param group_variants: A list with one item per group, each item is a list of (rows, index) variants.
+        :return: A list with one array of shape [number of variants, number of metrics] per group, the mean metrics of every variant.
+        """
+        concated = []
+        for group, variants in zip(self.groups, group_variants):
+            if not variants:
+                concated.append(None)
+                continue
+            rows = np.concatenate([v[0] for v in variants], axis=0)
+            index = np.concatenate([v[1] for v in variants], axis=0)
+            segment_ids = np.concatenate([np.full(v[0].shape[0], i, dtype=np.int32) for i, v in enumerate(variants)], axis=0)
+            concated.append((rows, index, segment_ids, len(variants)))
+        max_rows = self.max_rows or max([c[0].shape[0] for c in concated if c is not None] + [1])
+        start = 0
+        results = [None if c is None else [0., 0.] for c in concated]
+        while True:
+            feed_dict = {self.ref_x: ref_x, self.labels: labels}
+            fetches = {}
+            for i, (group, c) in enumerate(zip(self.groups, concated)):
+                if c is None or start >= c[0].shape[0]:
+                    continue
+                rows, index, segment_ids, num_segments = c
+                for inp in group["inputs"]:
+                    feed_dict[inp] = rows[start:start + max_rows]
+                for t in group["training"]:
+                    feed_dict[t] = False
+                feed_dict[group["index"]] = index[start:start + max_rows]
+                feed_dict[group["segment_ids"]] = segment_ids[start:start + max_rows]
+                feed_dict[group["num_segments"]] = num_segments
+                fetches[i] = group["fetches"]
+            if not fetches:
+                break
+            for i, (sums, counts) in sess.run(fetches, feed_dict=feed_dict).iteritems():
+                results[i][0] = results[i][0] + sums
+                results[i][1] = results[i][1] + counts
+            start += max_rows
+        return [None if res is None else res[0] / res[1][:, np.newaxis] for res in results]
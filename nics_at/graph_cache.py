@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import json
+import glob
+import hashlib
+
+import tensorflow as tf
+import cleverhans
+
+from nics_at import utils
+
+# bump when the cache format changes
+CACHE_VERSION = 1
+
+def _source_files():
+    # the code that constructs the attack graphs and the model graphs
+    nics_dir = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(cleverhans.__file__)), "*.py")) +
+                  glob.glob(os.path.join(nics_dir, "attacks", "*.py")) + glob.glob(os.path.join(nics_dir, "models", "*.py")))
+
+def get_config_hash(*cfgs):
+    """
+    A stable hash of the configurations and the code that determine the constructed graph.
+    """
+    md5 = hashlib.md5(json.dumps([CACHE_VERSION, tf.__version__] + list(cfgs), sort_keys=True, default=str).encode("utf-8"))
+    for fname in _source_files():
+        with open(fname, "rb") as r_f:
+            md5.update(r_f.read())
+    return md5.hexdigest()[:16]
+
+class AttackGraphCache(object):
+    """
+    Serialize the constructed attack graphs as MetaGraphs, so that the repeated runs of the same configuration
+    import them instead of constructing them again.
+
+    Layout: `cache_dir/<config hash>/<graph hash>.meta`, the MetaGraph of the ops created by the construction, and
+    `<graph hash>.json`, the names of the input placeholders and the outputs in the cached graph, and the descriptions of the
+    external inputs. The inputs of the cached ops that are outside the attack graph (e.g. the variables and the `training`
+    placeholders of the models) are mapped by name onto the tensors of the current graph, which are constructed the same way
+    by the trainer given the same configuration and code; the graph is constructed instead when the op type, the dtype or
+    the shape of any mapped tensor differs from the cached one.
+    """
+    # the functions of the py_func ops live in the constructing process, and the variables of the cached graph
+    # would not be in the collections of the importing graph, so the graphs containing them are not cached
+    uncached_op_types = {"PyFunc", "PyFuncStateless", "EagerPyFunc", "Variable", "VariableV2", "VarHandleOp"}
+
+    def __init__(self, cache_dir, cfg_hash):
+        self.cache_dir = os.path.join(cache_dir, cfg_hash)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        utils.log("Caching the attack graphs in {}".format(self.cache_dir))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(repr(key).encode("utf-8")).hexdigest())
+
+    def construct(self, key, build):
+        """
+        Import the cached graph of `key`, or construct it by `build` and cache it.
+        :param key: A key that identifies the graph in this configuration, its `repr` must be stable across runs.
+        :param build: A function that constructs the graph in the default graph and returns (input tensors, output tensors).
+        :return: (input tensors, output tensors, whether the graph is imported from the cache)
+        """
+        path = self._path(key)
+        if os.path.exists(path + ".meta"):
+            try:
+                inputs, outputs = self._import(path)
+                return inputs, outputs, True
+            except (KeyError, ValueError, IOError) as e:
+                utils.log("WARNING: fail to import the cached attack graph {}, construct it instead: {}".format(path, e))
+        graph = tf.get_default_graph()
+        names_before = set(op.name for op in graph.get_operations())
+        inputs, outputs = build()
+        new_ops = [op for op in graph.get_operations() if op.name not in names_before]
+        try:
+            self._save(path, new_ops, inputs, outputs)
+        except (KeyError, ValueError, IOError) as e:
+            utils.log("WARNING: fail to cache the attack graph {}: {}".format(path, e))
+        return inputs, outputs, False
+
+    def _save(self, path, new_ops, inputs, outputs):
+        uncached = set(op.type for op in new_ops) & self.uncached_op_types
+        if uncached:
+            utils.log("Attack graph {} is not cached as it contains {} ops".format(os.path.basename(path), sorted(uncached)))
+            return
+        graph = tf.get_default_graph()
+        graph_def = tf.GraphDef()
+        graph_def.versions.CopyFrom(graph.graph_def_versions)
+        graph_def.node.extend([op.node_def for op in sorted(new_ops, key=lambda op: op._id)])
+        input_map = self._get_input_map(graph_def)
+        meta_graph_def = tf.train.export_meta_graph(graph_def=graph_def, collection_list=[])
+        with open(path + ".json", "w") as w_f:
+            json.dump({"inputs": [t.name for t in inputs], "outputs": [t.name for t in outputs],
+                       "external_inputs": {n: self._describe(t) for n, t in input_map.items()}}, w_f)
+        # write into a temporary file first, so that half-written graphs are never imported
+        with open(path + ".meta.tmp", "wb") as w_f:
+            w_f.write(meta_graph_def.SerializeToString())
+        os.rename(path + ".meta.tmp", path + ".meta")
+
+    @staticmethod
+    def _describe(tensor):
+        shape = tensor.get_shape()
+        return [tensor.op.type, tensor.dtype.name, shape.as_list() if shape.ndims is not None else None]
+
+    def _get_input_map(self, graph_def):
+        graph = tf.get_default_graph()
+        nodes = set(node.name for node in graph_def.node)
+        input_map = {}
+        for node in graph_def.node:
+            for inp in node.input:
+                name = inp.lstrip("^").split(":")[0]
+                if name in nodes or inp in input_map:
+                    continue
+                if inp.startswith("^"):
+                    # control inputs are remapped through any output of the op
+                    outputs = graph.get_operation_by_name(name).outputs
+                    if not outputs:
+                        raise ValueError("the control input {} has no outputs to be mapped through".format(name))
+                    input_map[inp] = outputs[0]
+                else:
+                    input_map[inp] = graph.get_tensor_by_name(inp if ":" in inp else inp + ":0")
+        return input_map
+
+    def _import(self, path):
+        with open(path + ".json", "r") as r_f:
+            io_names = json.load(r_f)
+        meta_graph_def = tf.MetaGraphDef()
+        with open(path + ".meta", "rb") as r_f:
+            meta_graph_def.ParseFromString(r_f.read())
+        graph = tf.get_default_graph()
+        scope = graph.unique_name("attack_graph_cache", mark_as_used=False)
+        # the frame names of the while loops are not prefixed by the import scope, keep them unique in the graph
+        for node in meta_graph_def.graph_def.node:
+            if "frame_name" in node.attr:
+                node.attr["frame_name"].s = (scope + "/").encode("utf-8") + node.attr["frame_name"].s
+        input_map = self._get_input_map(meta_graph_def.graph_def)
+        for name, tensor in input_map.items():
+            if io_names["external_inputs"].get(name, None) != self._describe(tensor):
+                raise ValueError("the external input {} is {}, but {} when cached".format(
+                    name, self._describe(tensor), io_names["external_inputs"].get(name, None)))
+        tf.train.import_meta_graph(meta_graph_def, import_scope=scope, input_map=input_map)
+        get = lambda name: graph.get_tensor_by_name(scope + "/" + name)
+        return [get(name) for name in io_names["inputs"]], [get(name) for name in io_names["outputs"]]
@@ -2,7 +2,12 @@
 from __future__ import division
 from __future__ import print_function
 
+import time
+import Queue
+import ctypes
 import random
+import threading
+import multiprocessing
 
 import numpy as np
 import tensorflow as tf
@@ -13,6 +18,12 @@ from nics_at.datasets import Dataset, Cifar10Dataset, TinyImageNetDataset
 from nics_at import utils
 from utils import AvailModels
 
+# non-trainable variables that change during training (batch norm statistics, relu threshold schedule)
+_VOLATILE_VAR_PATTERNS = ["moving_mean", "moving_variance", "renorm_mean", "renorm_stddev", "relu_thresh"]
+
+def _is_volatile(var, trainable_vars):
+    return var in trainable_vars or any(p in var.op.name for p in _VOLATILE_VAR_PATTERNS)
+
 class GrayDataset(Dataset):
     def __init__(self, FLAGS):
         super(GrayDataset, self).__init__(FLAGS)
@@ -26,40 +37,38 @@ class GrayDataset(Dataset):
         # **NOTE**: all attacks build here will be directly used in __generated__. so just add __generated__ to the "train_models" configuration
 
         self.sync_every = FLAGS.sync_every
+        # following models are only used to generate adversarials with weight snapshots, build them as test-only models
+        self.available_models_cfgs = [dict(m_cfg, model_params=dict(m_cfg.get("model_params", {}), test_only=True)) if m_cfg.get("follow", None) is not None else m_cfg
+                                      for m_cfg in FLAGS.additional_models_gray]
+        self.following_ns = [m_cfg["namescope"] for m_cfg in self.available_models_cfgs if m_cfg.get("follow", None) is not None]
+        self.has_following = bool(self.following_ns) # whether following models exists
+        # the gray-box attacks are run on whole batches of `attack_batch_size` samples,
+        # and at most `prefetch_batches` attacked batches are prefetched into a bounded queue
+        self.attack_batch_size = FLAGS.gray_attack_batch_size or self.batch_size
+        self.prefetch_batches = FLAGS.gray_prefetch_batches
+        self.attack_threads = FLAGS.gray_attack_threads
         self._build_queue_trainval()
+        self._build_snapshots()
 
         # Construct all the models in this device
         self.device = FLAGS.gray_dataset_device
-        with tf.device("/gpu:{}".format(self.device)):
+        # the variables created when constructing the models (e.g. `relu_thresh`) are double-buffered as well
+        with tf.device("/gpu:{}".format(self.device)), \
+             tf.variable_scope(tf.get_variable_scope(), custom_getter=self._snapshot_getter if self.has_following else None):
             # **NOTE**: these models will use a different registry to avoid accidentaly causing too many data movement between devices
             #           for considerations of multiple aspects(especially **efficiency**), do not support foolbox type attack
-            self.available_models_cfgs = FLAGS.additional_models_gray
             self.available_models = [QCNN.create_model(m_cfg) for m_cfg in self.available_models_cfgs]
             [AvailModels.add(m, None, None, tag="gray_dataset") for m in self.available_models]
 
             # Construct all the attacks in this device
             self.available_attacks = [Attack.create_attack(None, a_cfg) for a_cfg in (self.FLAGS.available_attacks_gray or [])]
 
-        self.has_following = any(m_cfg.get("follow", None) is not None for m_cfg in self.available_models_cfgs) # whether following models exists
         self.total_generated_adv_num = self.generated_adv_num + len(self.available_attacks)
+        # whether the snapshots are fed by `load_snapshots` (e.g. by the trainer process) instead of copied from the followed models
+        self.external_snapshots = False
         self.started = False
 
     def _build_queue_trainval(self):
-        def _build_queue(mode):
-            cont_m2t_queue = tf.FIFOQueue(4, dtypes=[tf.bool], shapes=[()]) # main to thread(master) queue
-            cont_t2m_queue = tf.FIFOQueue(4, dtypes=[tf.bool], shapes=[()]) # thread(master) to main queue
-            m2s_queue = tf.FIFOQueue((self.num_threads[mode] - 1) * 2, dtypes=[tf.bool], shapes=[()]) # master to slave queue
-            s2m_queue = tf.FIFOQueue((self.num_threads[mode] - 1) * 2, dtypes=[tf.bool], shapes=[()]) # slave to master queue
-            # calculate
-            num_per_epoch = getattr(self, "{}_num".format(mode))
-            # Number of datum to process between the barrier-sync(per round) per data/queue-runner thread
-            # sync_every = self.sync_every
-            # num_per_thread_round = int(np.ceil(num_per_epoch * self.sync_every / self.num_threads[mode]))
-            # add 1 initial epoch for val gen when initial test exists
-            sync_every = tf.Variable(initial_value=(self.sync_every+1) if mode == "val" and not self.FLAGS.no_init_test else self.sync_every, trainable=False, name="sync_every_{}".format(mode), dtype=tf.int32)
-            num_per_thread_round = tf.cast(tf.ceil(tf.cast(sync_every, tf.float32) * num_per_epoch / self.num_threads[mode]), tf.int32)
-
-            return cont_m2t_queue, cont_t2m_queue, m2s_queue, s2m_queue, num_per_thread_round, sync_every
         # Prepare train/val filename queue
         self.filenames_labels_dct = {}
         self.filenames_queues_dct = {}
@@ -73,167 +82,191 @@ class GrayDataset(Dataset):
             self.filenames_labels_dct[mode] = filenames_labels
             self.filenames_queues_dct[mode] = filename_q
 
-        # Prepare the queues used to synchronize queue-runner threads and the main-training thread (train and val)
-        self.queues_dct = {mode: _build_queue(mode) for mode in ["train", "val"]}
-        self.processed_per_threads = {
-            mode: [
-                tf.get_variable("data_producer_{}/data_count/{}".format(mode, i),
-                                shape=[], dtype=tf.int32, initializer=tf.zeros_initializer())
-                for i in range(self.num_threads[mode])
-            ] for mode in ["train", "val"]
-        }
-
-    def read_image_without_following(self, mode, ind_, major):
-        # return self._read_image_with_attack(mode)
-        return self._read_image(mode)
-
-    def read_image_with_following(self, mode, ind_, major):
-        cont_m2t_queue, cont_t2m_queue, m2s_queue, s2m_queue, per_thread_num = self.queues_dct[mode][:5]
-        num = self.processed_per_threads[mode][ind_]
-        # Use per-thread num to avolid concurrent access to the same variable in multiple threads, alternatively, one can use use_locking in tf.assign_add...
-        # because per-thread counting might hurt load balancing performance...
-        other_num = self.num_threads[mode] - 1
-        def wait_and_handle(num):
-            def _func():
-                if major: # "major" data thread will communicate with the training thread, on behalf of all the data threads
-                    # 1. <-s2m_queue (waiting for slaves to reach the round end)
-                    # 2. ->cont_t2m_queue (tell main thread: this round of generation ended)
-                    # 3. <-cont_m2t_queue (waiting for main to sync and start the data generation again)
-                    # 4. 0 => num (new round!)
-                    # 5. ->m2s_queue (tell slaves to begin)
-                    # 6. +1 => num
-                    with tf.control_dependencies([s2m_queue.dequeue_many(other_num)]),\
-                         tf.control_dependencies([cont_t2m_queue.enqueue(tf.constant(True))]),\
-                         tf.control_dependencies([cont_m2t_queue.dequeue()]),\
-                         tf.control_dependencies([tf.assign(num, 0)]),\
-                         tf.control_dependencies([m2s_queue.enqueue_many([tf.constant([True])] * other_num)]),\
-                         tf.control_dependencies([tf.assign_add(num, 1)]):
-                        return self._read_image_with_attack(mode)
-                else: # if not major
-                    with tf.control_dependencies([s2m_queue.enqueue(tf.constant(True))]),\
-                         tf.control_dependencies([m2s_queue.dequeue()]),\
-                         tf.control_dependencies([tf.assign(num, 0)]),\
-                         tf.control_dependencies([tf.assign_add(num, 1)]):
-                        return self._read_image_with_attack(mode)
-            return _func
-        def handle(num):
-            def _func():
-                with tf.control_dependencies([tf.assign_add(num, 1)]):
-                    # return self._read_image_with_attack(mode)
-                    return self._read_image(mode)
-            return _func
-        # contention can occur. more examples might be produced than per_thread_num; i think this will not harm the performance
-        with tf.device('/gpu:{}'.format(self.device)):
-            return tf.cond(num>=per_thread_num, wait_and_handle(num), handle(num))
+    def _build_snapshots(self):
+        # The weights of following models are double-buffered: the attacks read the buffer of `active_slot`,
+        # a new snapshot is copied into the other buffer while the data threads keep generating, then the slot is swapped.
+        with tf.device("/cpu:0"):
+            self.active_slot = tf.Variable(0, trainable=False, name="gray_snapshot/active_slot", dtype=tf.int32)
+            self.snapshot_version = tf.Variable(0, trainable=False, name="gray_snapshot/version", dtype=tf.int32)
+            # `_reading_slot` is read only once per run, so all the weights used to attack a batch are of the same version
+            self._reading_slot = self.active_slot.read_value()
+        self.snapshot_buffers = {ns: {} for ns in self.following_ns}
+        self.active = 0
+        self.version = 0
+
+    def _snapshot_getter(self, getter, name, *args, **kwargs):
+        ns = next((ns for ns in self.following_ns if name.startswith(ns + "/")), None)
+        if ns is None:
+            return getter(name, *args, **kwargs)
+        rel_name = name[len(ns) + 1:]
+        if rel_name not in self.snapshot_buffers[ns]:
+            kwargs["trainable"] = False
+            self.snapshot_buffers[ns][rel_name] = (getter(name, *args, **kwargs), getter(name + "_snapshot", *args, **kwargs))
+        buffers = self.snapshot_buffers[ns][rel_name]
+        return tf.cond(tf.equal(self._reading_slot, 0), lambda: buffers[0].value(), lambda: buffers[1].value())
 
     def _read_image(self, mode):
         return self.read_image(self.filenames_queues_dct[mode], mode)
 
-    # def _read_image_with_attack(self, mode):
-    #     # Construct the aug/load_generated graph
-    #     img, auged_img, label, loaded_adv_imgs = self.read_image(self.filenames_queues_dct[mode], mode)
-    #     # Construct the attack graph using the already constructed attacks
-    #     with tf.device('/gpu:{}'.format(self.device)):
-    #         advs = tf.concat([loaded_adv_imgs] + [a.generate_tensor(tf.expand_dims(auged_img, 0), tf.one_hot(tf.expand_dims(label, 0), self.num_labels)) for a in self.available_attacks], axis=0)
-    #     return [img, auged_img, label, advs]
-
-    def _read_image_with_attack(self, im_tensor, label_tensor, loaded_adv_tensor):
-        # Construct the attack graph using the already constructed attacks
-        with tf.device('/gpu:{}'.format(self.device)):
-            advs = tf.concat([loaded_adv_tensor] + [tf.expand_dims(a.generate_tensor(im_tensor, label_tensor), axis=1) for a in self.available_attacks], axis=1) # concat along axis 1. (batch size, attacks, ... image axes ...)
+    def _attack_batch(self, auged_imgs, labels, loaded_advs):
+        # Construct the attack graph of a whole batch using the already constructed attacks
+        with tf.device('/gpu:{}'.format(self.device)), \
+             tf.variable_scope(tf.get_variable_scope(), custom_getter=self._snapshot_getter if self.has_following else None):
+            one_hot_labels = tf.one_hot(labels, self.num_labels)
+            advs = tf.concat([loaded_advs] + [tf.expand_dims(a.generate_tensor(auged_imgs, one_hot_labels), axis=1) for a in self.available_attacks], axis=1) # concat along axis 1. (batch size, attacks, ... image axes ...)
         return advs
 
-    def adv_batch_q(self, im_tensor, label_tensor, loaded_adv_tensor, mode):
-        # return tf.train.batch_join([_read_image_with_attack(im_tensor, label_tensor, loaded_adv_tensor) for i in range(self.num_threads[mode])], 
-        #                            1, shapes=[tuple([self.total_generated_adv_num, self.batch_size] + list(self.image_shape))],
-        #                            capacity=self.capacity)
-        return tf.train.batch_join([_read_image_with_attack(im_tensor, label_tensor, loaded_adv_tensor)], # let's use one thread to do the work
-                                   1, shapes=[tuple([self.batch_size, self.total_generated_adv_num] + list(self.image_shape))],
-                                   capacity=self.capacity)
+    def adv_batch_q(self, mode):
+        """
+        Attack the batches of `attack_batch_size` samples joined by `batch_q`, and enqueue the attacked samples into a bounded prefetch queue
+        (`attack_threads` threads, capacity `prefetch_batches` attacked batches). Training/validation batches of `batch_size` are dequeued from it.
+        """
+        imgs, auged_imgs, labels, loaded_advs = self.batch_q(mode)
+        advs = self._attack_batch(auged_imgs, labels, loaded_advs)
+        prefetch_q = tf.FIFOQueue(self.prefetch_batches * self.attack_batch_size, dtypes=[tf.float32, tf.float32, tf.uint8, tf.float32],
+                                  shapes=[tuple(self.image_shape), tuple(self.image_shape), (),
+                                          tuple([self.total_generated_adv_num] + list(self.image_shape))],
+                                  name="gray_prefetch_" + mode)
+        enqueue_op = prefetch_q.enqueue_many([imgs, auged_imgs, labels, advs])
+        tf.train.add_queue_runner(tf.train.QueueRunner(prefetch_q, [enqueue_op] * self.attack_threads))
+        return prefetch_q.dequeue_many(self.batch_size)
 
     def batch_q(self, mode):
-        read_image_func = self.read_image_with_following if self.has_following \
-                          else self.read_image_without_following
-        return tf.train.batch_join([read_image_func(mode, i, major=i==0) for i in range(self.num_threads[mode])],
-                                   self.batch_size, shapes=[tuple(self.image_shape), tuple(self.image_shape), (),
-                                                            # tuple([self.total_generated_adv_num] + list(self.image_shape))],
-                                                            tuple([self.generated_adv_num] + list(self.image_shape))],
+        return tf.train.batch_join([self._read_image(mode) for i in range(self.num_threads[mode])],
+                                   self.attack_batch_size, shapes=[tuple(self.image_shape), tuple(self.image_shape), (),
+                                                                   tuple([self.generated_adv_num] + list(self.image_shape))],
                                    capacity=self.capacity)
 
     def start(self, sess):
         self.sess = sess
-        # construct copy_ops for follow models, and run these copy_ops for the first time
+        # construct the snapshot copy ops for follow models, and fill both buffers for the first time
         # call load_checkpoint for checkpoint models;
         self.copy_ops_dct = {}
+        self.copy_bytes_dct = {}
         for m_cfg in self.available_models_cfgs:
             ns = m_cfg["namescope"]
             model = AvailModels.get_model(ns, tag="gray_dataset")
             if m_cfg.get("follow", False):
+                if self.external_snapshots:
+                    continue
                 target_ns = m_cfg["follow"]
                 target_model = AvailModels.get_model(target_ns)
-                # Pairing vars of target model and the following model
-                name_dct = {var.op.name.replace(target_ns + "/", ""): [var] for var in target_model.vars}
-                [name_dct[var.op.name.replace(ns + "/", "")].append(var) for var in model.vars]
-                assert all(len(pair) == 2 for pair in name_dct.itervalues())
-                self.copy_ops_dct[ns] = tf.group(*[v.assign(t_v.value()) for t_v, v in name_dct.itervalues()])
+                # Pairing vars of target model and the snapshot buffers of the following model
+                name_dct = {var.op.name.replace(target_ns + "/", ""): var for var in target_model.vars}
+                buffers = self.snapshot_buffers[ns]
+                assert all(n in name_dct for n in buffers), "Fault: variables of following model {} do not match {}".format(ns, target_ns)
+                pairs = [(name_dct[n], bufs) for n, bufs in sorted(buffers.items())]
+                # only the trainable variables and the batch norm statistics change during training
+                trainable_vars = set(target_model.trainable_vars)
+                volatile_pairs = [(t_v, bufs) for t_v, bufs in pairs if _is_volatile(t_v, trainable_vars)]
+                self.copy_ops_dct[ns] = {
+                    "full": [self._fused_copy(pairs, slot) for slot in range(2)],
+                    "incremental": [self._fused_copy(volatile_pairs, slot) for slot in range(2)]
+                }
+                self.copy_bytes_dct[ns] = {
+                    "full": sum(self._num_bytes(t_v) for t_v, _ in pairs),
+                    "incremental": sum(self._num_bytes(t_v) for t_v, _ in volatile_pairs)
+                }
+                utils.log("Following model {}: {} variables; {} variables ({:.1f} MB) are copied every sync".format(
+                    ns, len(pairs), len(volatile_pairs), self.copy_bytes_dct[ns]["incremental"] / 1024. / 1024.))
             else: # load-checkpoint type
                 model.load_checkpoint(m_cfg["checkpoint"], self.sess, m_cfg.get("load_namescope", None))
-
-        # Run copy ops for the first time
-        self.run_copy_ops()
+        if self.has_following:
+            self.swap_ops = [tf.group(tf.assign(self.active_slot, slot), tf.assign_add(self.snapshot_version, 1)) for slot in range(2)]
+            if self.external_snapshots:
+                self.snapshot_assign_ops = {}
+                for ns, buffers in self.snapshot_buffers.iteritems():
+                    for n, bufs in buffers.iteritems():
+                        value_ph = tf.placeholder(bufs[0].dtype.base_dtype, shape=bufs[0].get_shape())
+                        self.snapshot_assign_ops.setdefault(ns, {})[n] = (value_ph, [buf.assign(value_ph) for buf in bufs])
+            else:
+                # Fill both buffers for the first time, afterwards the buffers only differ in the volatile variables
+                self.run_copy_ops("full", 0)
+                self.run_copy_ops("full", 1)
         self.started = True
 
+        if not (self.external_snapshots and self.has_following):
+            self._start_queue_runners()
+        # else: start generating after the first snapshot is loaded
+
+    def _start_queue_runners(self):
         # Start the queue runner!
         self.coord = tf.train.Coordinator()
         self.threads = tf.train.start_queue_runners(sess=self.sess, coord=self.coord)
 
-    def run_copy_ops(self):
-        print("Copying into models: ", self.copy_ops_dct.keys())
-        self.sess.run(self.copy_ops_dct.values())
+    @staticmethod
+    def _num_bytes(var):
+        return int(np.prod(var.get_shape().as_list())) * var.dtype.base_dtype.size
 
-    def sync_epoch(self, epoch):
-        # Called in the main thread, to perform a synchronization with queue-runner threads
-        assert self.started, "Fault: GrayDataset not started"
-        if epoch % self.sync_every == 0:
-            if not self.FLAGS.no_init_test and epoch / self.sync_every == 1:
-                self.sess.run(tf.assign(self.queues_dct["val"][-1], self.sync_every))
-                utils.log("Adjust validation gen threshold back to ", self.sync_every)
-            # Sync for follow models...
-            # 1. wait for all queue runner threads to reach barrier
-            # 2. run copy_ops
-            # 3. tell all queue runner threads to continue, now with new vars!
-            utils.log("Syncing following models at epoch {}".format(epoch))
-            train_m2t, train_t2m = self.queues_dct["train"][:2]
-            val_m2t, val_t2m = self.queues_dct["val"][:2]
-            self.sess.run([train_t2m.dequeue(), val_t2m.dequeue()]) # 1
-            self.run_copy_ops() # 2
-            self.sess.run([train_m2t.enqueue(tf.constant(True)), val_m2t.enqueue(tf.constant(True))]) # 3
-            utils.log("Finished syncing following models at epoch {}".format(epoch))
-        return
+    def _fused_copy(self, pairs, slot):
+        # Copy the variables into the buffers of `slot` as one concat on the source device,
+        # one device-to-device transfer and one split on the gray-box device (per dtype)
+        copy_ops = []
+        dtype_pairs = {}
+        [dtype_pairs.setdefault(t_v.dtype.base_dtype, []).append((t_v, bufs[slot])) for t_v, bufs in pairs]
+        for d_pairs in dtype_pairs.itervalues():
+            with tf.device(d_pairs[0][0].device):
+                flat = tf.concat([tf.reshape(t_v.value(), [-1]) for t_v, _ in d_pairs], axis=0)
+            with tf.device("/gpu:{}".format(self.device)):
+                parts = tf.split(tf.identity(flat), [int(np.prod(buf.get_shape().as_list())) for _, buf in d_pairs])
+                copy_ops += [buf.assign(tf.reshape(part, buf.get_shape())) for part, (_, buf) in zip(parts, d_pairs)]
+        return tf.group(*copy_ops)
 
-    @property
-    def _normal_data_tensors(self):
-        if not self._gen_normal:
-            self._gen_normal = True
-            with tf.device("/cpu:0"):
-                self.n_imgs_t, self.n_auged_imgs_t, self.n_labels_t, self.n_adv_imgs_t = self.batch_q("train")
-                self.n_imgs_v, self.n_auged_imgs_v, self.n_labels_v, self.n_adv_imgs_v = self.batch_q("val")
+    def run_copy_ops(self, copy_type, slot):
+        start_time = time.time()
+        self.sess.run([ops[copy_type][slot] for ops in self.copy_ops_dct.values()])
+        duration = time.time() - start_time
+        num_mb = sum(b[copy_type] for b in self.copy_bytes_dct.values()) / 1024. / 1024.
+        utils.log("Copied {:.1f} MB into models {} ({} copy) in {:.3f} s: {:.1f} MB/s".format(
+            num_mb, self.copy_ops_dct.keys(), copy_type, duration, num_mb / max(duration, 1e-6)))
+
+    def _swap_snapshots(self, slot):
+        self.sess.run(self.swap_ops[slot])
+        self.active = slot
+        self.version += 1
+        utils.log("Following models swapped to snapshot version {}".format(self.version))
 
-            self.n_labels_t = tf.one_hot(self.n_labels_t, self.n_num_labels)
-            self.n_labels_v = tf.one_hot(self.n_labels_v, self.n_num_labels)
-        return (self.n_imgs_t, self.n_auged_imgs_t, self.n_labels_t, self.n_adv_imgs_t), (self.n_imgs_v, self.n_auged_imgs_v, self.n_labels_v, self.n_adv_imgs_v)
+    def update_snapshots(self):
+        # Copy into the inactive buffer while the data threads keep generating using the active one, then swap
+        inactive = 1 - self.active
+        self.run_copy_ops("incremental", inactive)
+        self._swap_snapshots(inactive)
+
+    def load_snapshots(self, values):
+        """
+        Assign the snapshot values (dict of following model namescope -> dict of variable name -> value) into the inactive buffers, then swap.
+        The first snapshot must contain all the variables, it is assigned into both buffers.
+        """
+        inactive = 1 - self.active
+        slots = [0, 1] if self.version == 0 else [inactive]
+        feed_dict = {}
+        assign_ops = []
+        for ns, ns_values in values.iteritems():
+            for n, value in ns_values.iteritems():
+                value_ph, slot_assign_ops = self.snapshot_assign_ops[ns][n]
+                feed_dict[value_ph] = value
+                assign_ops += [slot_assign_ops[slot] for slot in slots]
+        self.sess.run(assign_ops, feed_dict=feed_dict)
+        self._swap_snapshots(inactive)
+        if self.version == 1:
+            self._start_queue_runners()
+
+    def sync_epoch(self, epoch):
+        # Called in the main thread, to update the weight snapshots of the following models
+        assert self.started, "Fault: GrayDataset not started"
+        if self.has_following and epoch % self.sync_every == 0:
+            self.update_snapshots()
 
     @property
     def data_tensors(self):
         if not self._gen:
             self._gen = True
-            self._normal_data_tensor # just trigger a call
             with tf.device("/cpu:0"):
-                self.imgs_t, self.labels_t, self.adv_imgs_t = self.n_imgs_t, self.n_labels_t, self.n_adv_imgs_t
-                self.adv_imgs_t = tf.squeeze(self.adv_batch_q(self.n_auged_imgs_t, self.labels_t, self.adv_imgs_t, "train"), axis=0)
-                self.imgs_v, self.labels_v, self.adv_imgs_v = self.n_imgs_v, self.n_labels_v, self.n_adv_imgs_v
-                self.auged_imgs_v, self.adv_imgs_v = tf.squeeze(self.adv_batch_q(self.n_auged_imgs_v, self.labels_v, self.adv_imgs_v, "val"), axis=0)
+                self.imgs_t, self.auged_imgs_t, self.labels_t, self.adv_imgs_t = self.adv_batch_q("train")
+                self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v = self.adv_batch_q("val")
 
+            self.labels_t = tf.one_hot(self.labels_t, self.num_labels)
+            self.labels_v = tf.one_hot(self.labels_v, self.num_labels)
         return (self.imgs_t, self.auged_imgs_t, self.labels_t, self.adv_imgs_t), (self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v)
 
 class GrayCifar10Dataset(GrayDataset, Cifar10Dataset):
@@ -241,3 +274,158 @@ class GrayCifar10Dataset(GrayDataset, Cifar10Dataset):
 
 class GrayTIDataset(GrayDataset, TinyImageNetDataset):
     pass
+
+class ProcessGrayDataset(Dataset):
+    """
+    Run the gray-box data generation (the `SERVER_CLS` dataset with its models and attacks) in a separate local process,
+    with its own graph and session, so that the data threads do not compete with the training thread for the GIL and the session.
+
+    * The server process is forked in `__init__`, before the trainer creates any session;
+    * The weights of the following models are sent to the server as snapshots: a full snapshot in `start`, and
+      the trainable variables and batch norm statistics every `sync_every` epochs in `sync_epoch`; only the variables
+      buffered by the server, whose names are sent back by the server after it starts, are in the snapshots;
+    * The trainer raises an error instead of waiting forever when the server process dies;
+    * The adversarial batches are written into slots of shared memory ring buffers (`gray_prefetch_batches` slots per mode),
+      and the slot indexes are passed through queues.
+    """
+    SERVER_CLS = None
+    # the interval (in seconds) of checking whether the server process is alive while waiting for it
+    server_poll_interval = 10
+
+    def __init__(self, FLAGS):
+        super(ProcessGrayDataset, self).__init__(FLAGS)
+        [self.load_filenames_labels(mode) for mode in ["train", "val"]] # set `train_num` and `val_num`
+        self.sync_every = FLAGS.sync_every
+        self.following_cfgs = [m_cfg for m_cfg in FLAGS.additional_models_gray if m_cfg.get("follow", None) is not None]
+        self.total_generated_adv_num = self.generated_adv_num + len(FLAGS.available_attacks_gray or [])
+        self.num_slots = FLAGS.gray_prefetch_batches
+        self.batch_shapes = [[self.batch_size] + list(self.image_shape), [self.batch_size] + list(self.image_shape),
+                             [self.batch_size, self.num_labels], [self.batch_size, self.total_generated_adv_num] + list(self.image_shape)]
+
+        # Shared memory ring buffers: mode -> [imgs, auged_imgs, labels, adv_imgs] arrays of shape [num_slots, ...]
+        self.shm_arrays = {}
+        self.free_qs = {}
+        self.full_qs = {}
+        for mode in ["train", "val"]:
+            self.shm_arrays[mode] = [np.frombuffer(multiprocessing.RawArray(ctypes.c_float, self.num_slots * int(np.prod(shape))), dtype=np.float32)
+                                     .reshape([self.num_slots] + shape) for shape in self.batch_shapes]
+            self.free_qs[mode] = multiprocessing.Queue()
+            self.full_qs[mode] = multiprocessing.Queue()
+            [self.free_qs[mode].put(slot) for slot in range(self.num_slots)]
+        self.snapshot_q = multiprocessing.Queue()
+        self.buffer_names_q = multiprocessing.Queue()
+        self.server = multiprocessing.Process(target=self._serve, name="gray_server")
+        self.server.daemon = True
+        self.server.start()
+        utils.log("Started gray-box data server process {}".format(self.server.pid))
+
+    # ---- server process ----
+    def _serve(self):
+        graph = tf.Graph()
+        with graph.as_default():
+            dataset = self.SERVER_CLS(self.FLAGS)
+            dataset.external_snapshots = True
+            data_tensors = dict(zip(["train", "val"], dataset.data_tensors))
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+            config.allow_soft_placement = True
+            sess = tf.Session(config=config)
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            dataset.start(sess)
+            self.buffer_names_q.put({ns: sorted(buffers.keys()) for ns, buffers in dataset.snapshot_buffers.iteritems()})
+            producers = [threading.Thread(target=self._produce, args=(sess, mode, data_tensors[mode])) for mode in ["train", "val"]]
+            for producer in producers:
+                producer.daemon = True
+                producer.start()
+            while True:
+                values = self.snapshot_q.get()
+                if values is None:
+                    break
+                dataset.load_snapshots(values)
+
+    def _produce(self, sess, mode, tensors):
+        while True:
+            slot = self.free_qs[mode].get()
+            try:
+                values = sess.run(tensors)
+            except tf.errors.OutOfRangeError:
+                self.full_qs[mode].put(None)
+                break
+            for array, value in zip(self.shm_arrays[mode], values):
+                array[slot] = value
+            self.full_qs[mode].put(slot)
+
+    # ---- trainer process ----
+    def _get(self, queue):
+        # surface the death of the server process instead of blocking forever
+        while True:
+            try:
+                return queue.get(timeout=self.server_poll_interval)
+            except Queue.Empty:
+                if not self.server.is_alive():
+                    raise RuntimeError("The gray-box data server process {} exited with code {}".format(self.server.pid, self.server.exitcode))
+
+    def _next_batch(self, mode):
+        def _func():
+            slot = self._get(self.full_qs[mode])
+            if slot is None:
+                raise StopIteration()
+            batch = [array[slot].copy() for array in self.shm_arrays[mode]]
+            self.free_qs[mode].put(slot)
+            return batch
+        return _func
+
+    @property
+    def data_tensors(self):
+        if not self._gen:
+            self._gen = True
+            with tf.device("/cpu:0"):
+                tensors = {}
+                for mode in ["train", "val"]:
+                    tensors[mode] = tf.py_func(self._next_batch(mode), [], [tf.float32] * 4, stateful=True, name="gray_server_" + mode)
+                    [t.set_shape(shape) for t, shape in zip(tensors[mode], self.batch_shapes)]
+                self.imgs_t, self.auged_imgs_t, self.labels_t, self.adv_imgs_t = tensors["train"]
+                self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v = tensors["val"]
+        return (self.imgs_t, self.auged_imgs_t, self.labels_t, self.adv_imgs_t), (self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v)
+
+    def start(self, sess):
+        self.sess = sess
+        self.snapshot_vars = {}
+        self.volatile_vars = {}
+        # the names of the variables buffered by the server, e.g. only the variables used by the attacks are buffered
+        buffer_names = self._get(self.buffer_names_q)
+        for m_cfg in self.following_cfgs:
+            ns, target_ns = m_cfg["namescope"], m_cfg["follow"]
+            target_model = AvailModels.get_model(target_ns)
+            trainable_vars = set(target_model.trainable_vars)
+            name_dct = {var.op.name.replace(target_ns + "/", ""): var for var in target_model.vars}
+            assert all(n in name_dct for n in buffer_names[ns]), "Fault: variables of following model {} do not match {}".format(ns, target_ns)
+            self.snapshot_vars[ns] = {n: name_dct[n] for n in buffer_names[ns]}
+            self.volatile_vars[ns] = {n: var for n, var in self.snapshot_vars[ns].iteritems() if _is_volatile(var, trainable_vars)}
+        if self.following_cfgs:
+            self.send_snapshots(self.snapshot_vars)
+        self.started = True
+
+    def send_snapshots(self, vars_dct):
+        start_time = time.time()
+        values = self.sess.run(vars_dct)
+        self.snapshot_q.put(values)
+        num_mb = sum(v.nbytes for ns_values in values.itervalues() for v in ns_values.itervalues()) / 1024. / 1024.
+        utils.log("Sent {:.1f} MB snapshot of models {} to the gray-box data server in {:.3f} s".format(num_mb, values.keys(), time.time() - start_time))
+
+    def sync_epoch(self, epoch):
+        assert self.started, "Fault: ProcessGrayDataset not started"
+        if self.following_cfgs and epoch % self.sync_every == 0:
+            self.send_snapshots(self.volatile_vars)
+
+    def end(self):
+        self.snapshot_q.put(None)
+        self.server.join(10)
+        if self.server.is_alive():
+            self.server.terminate()
+
+class ProcessGrayCifar10Dataset(ProcessGrayDataset, Cifar10Dataset):
+    SERVER_CLS = GrayCifar10Dataset
+
+class ProcessGrayTIDataset(ProcessGrayDataset, TinyImageNetDataset):
+    SERVER_CLS = GrayTIDataset
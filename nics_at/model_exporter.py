@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from cleverhans.attacks import MadryEtAl
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from models import QCNN
+from models.frozen import FROZEN_INPUT, FROZEN_OUTPUT, FrozenModel
+import utils
+from base_trainer import settings, Trainer
+
+class ModelExporter(Trainer):
+    """
+    Export the checkpoints of `QCNN` models as frozen inference graphs, which are loaded by the `frozen` model type as
+    drop-in test-only models (e.g. teachers, or the source models of the attacks). The models are built in inference mode,
+    so the `training` placeholders, the batch-norm update ops and the regularizers are not in the graph; the variables are
+    converted into constants; the batch normalizations following convolutions are folded into the convolution weights;
+    and the constant subgraphs (e.g. the casted `substract_mean` and `div` of the preprocessing) are folded.
+
+    The graph of every model is written into `<output_dir>/<namescope or type>.pb`, and can be loaded by e.g.
+        {"type": "frozen", "namescope": "tea", "model_params": {"path": "<output_dir>/tea.pb"}}
+    """
+    class _settings(settings):
+        default_cfg = {
+            # Data gen: only the image shape of the dataset is used
+            "dataset": "tinyimagenet",
+            "dataset_info": {},
+            "num_threads": 2,
+            "capacity": 1024,
+            "more_augs": False,
+            "aug_saltpepper": None,
+            "aug_gaussian": None,
+            "generated_adv": [],
+            "epochs": 1,
+            "batch_size": 100,
+
+            # Models
+            "precision": "float32",
+            "loss_scale": 128.,
+            "models": [], # e.g. [{"namescope": "", "type": "resnet18", "checkpoint": "path", "load_namescope": ""}]
+            "transforms": ["remove_nodes(op=Identity, op=CheckNumerics)", "fold_constants(ignore_errors=true)",
+                           "fold_batch_norms", "fold_old_batch_norms", "fold_constants(ignore_errors=true)"],
+            "check_attack": True # run a PGD attack on the exported graph loaded as a `frozen` model
+        }
+
+    def __init__(self, args, cfg):
+        super(ModelExporter, self).__init__(args, cfg)
+        assert self.FLAGS.models, "Fault: no model to export is configured"
+
+    def init(self):
+        if not os.path.exists(self.FLAGS.output_dir):
+            os.makedirs(self.FLAGS.output_dir)
+        QCNN.default_precision = self.FLAGS.precision
+        QCNN.default_loss_scale = self.FLAGS.loss_scale
+
+    def export(self, m_cfg):
+        # build every model in a separate graph, so that the node names do not depend on the other models
+        graph = tf.Graph()
+        with graph.as_default():
+            params = dict(m_cfg.get("model_params", {}))
+            params["test_only"] = True # build in inference mode
+            model = QCNN.create_model(dict(m_cfg, model_params=params))
+            x = tf.placeholder(tf.float32, shape=[None] + list(self.dataset.image_shape), name=FROZEN_INPUT)
+            tf.identity(model.get_logits(x), name=FROZEN_OUTPUT)
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+            with tf.Session(graph=graph, config=config) as sess:
+                model.load_checkpoint(m_cfg["checkpoint"], sess, m_cfg.get("load_namescope", None))
+                graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [FROZEN_OUTPUT])
+        num_nodes = len(graph_def.node)
+        graph_def = TransformGraph(graph_def, [FROZEN_INPUT], [FROZEN_OUTPUT], self.FLAGS.transforms)
+        path = os.path.join(self.FLAGS.output_dir, (m_cfg["namescope"] or m_cfg["type"]) + ".pb")
+        with open(path, "wb") as w_f:
+            w_f.write(graph_def.SerializeToString())
+        utils.log("Exported {} into {}: {} nodes -> {} nodes".format(m_cfg["checkpoint"], path, num_nodes, len(graph_def.node)))
+        if self.FLAGS.check_attack:
+            self.check_attack(path)
+
+    def check_attack(self, path):
+        # the frozen models are used as the source models of the attacks, whose steps run in `tf.while_loop`
+        graph = tf.Graph()
+        with graph.as_default():
+            model = FrozenModel("frozen_check", {"path": path})
+            x = tf.placeholder(tf.float32, shape=[None] + list(self.dataset.image_shape))
+            adv_x = MadryEtAl(model).generate(x, eps=8., eps_iter=2., nb_iter=2, clip_min=0., clip_max=255.)
+            x_v = np.random.uniform(0, 255, size=[2] + list(self.dataset.image_shape)).astype(np.float32)
+            with tf.Session(graph=graph) as sess:
+                adv_v = sess.run(adv_x, feed_dict={x: x_v})
+        assert np.all(np.abs(adv_v - x_v) <= 8. + 1e-3), "Fault: the PGD attack on {} exceeds the perturbation budget".format(path)
+        utils.log("Checked a PGD attack on {}".format(path))
+
+    def start(self):
+        start_time = time.time()
+        for m_cfg in self.FLAGS.models:
+            self.export(m_cfg)
+        utils.log("Exported {} models in {:.1f} s".format(len(self.FLAGS.models), time.time() - start_time))
+
+    @classmethod
+    def populate_arguments(cls, parser):
+        parser.add_argument("--output-dir", required=True, help="The directory that the frozen graphs are written into")
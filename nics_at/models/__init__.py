@@ -9,3 +9,4 @@ import inception_cifar10
 
 import resnet_madry
 import mnist_madry
+import frozen
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import six
 import abc
+import threading
 
 import tensorflow as tf
 
@@ -27,6 +28,12 @@ def RegistryMetaFactory(registry_name):
 
 @six.add_metaclass(RegistryMetaFactory("model"))
 class QCNN(Model):
+    # set by the trainers from the config-level `precision`/`loss_scale`, can be overrided by `model_params`
+    default_precision = "float32"
+    default_loss_scale = 128.
+    # whether the model casts its (preprocessed) inputs to `compute_dtype`, see `to_compute_dtype`
+    supports_float16 = False
+
     def __init__(self, namescope, params={}):
         super(Model, self).__init__()
         self.cached = {}
@@ -43,9 +50,33 @@ class QCNN(Model):
         self.weight_decay = params.get("weight_decay", 0.0001)
         self.output_name = params.get("output_name", "logits")
 
+        # Parse precision config
+        self.precision = params.get("precision", QCNN.default_precision)
+        assert self.precision in {"float32", "float16"}, "Unsupported precision: {}".format(self.precision)
+        if self.precision == "float16" and not self.supports_float16:
+            print("WARNING: {} does not support float16, fallback to float32".format(self.__class__.__name__))
+            self.precision = "float32"
+        self.compute_dtype = tf.float16 if self.precision == "float16" else tf.float32
+        # the loss scale used when calculating gradients, to avoid the underflow of float16 gradients
+        self.loss_scale = params.get("loss_scale", QCNN.default_loss_scale) if self.precision == "float16" else 1.
+
         self._vars = []
         self._trainable_vars = []
         self._save_saver = None
+        self._load_savers = {}
+        self._assign_ops = {}
+        self._forwards = {} # output name -> the reusable forward function, see `get_forward`
+
+        # Fold the inference-mode batch normalizations into the preceding convolutions, see `fold_conv_batch_norm`.
+        # Only the test-only models build their batch normalizations in inference mode (e.g. the teachers and the transfer models)
+        self.fold_bn = params.get("fold_bn", False)
+        if self.fold_bn and not self.test_only:
+            print("WARNING: {}: fold_bn is only supported by test-only models, ignored".format(self.namescope))
+            self.fold_bn = False
+
+        # The per-model activation registry, the layers of the models apply the activations through it (e.g. `self.relu`),
+        # so replacing the activations of one model does not affect the other models being built concurrently
+        self.activations = {"relu": tf.nn.relu}
 
         # Parse patch_relu config
         patch_relu = params.get("patch_relu", None)
@@ -55,16 +86,20 @@ class QCNN(Model):
             relu_func = getattr(tf_utils, patch_relu + "_relu")
             if "thresh" in patch_relu:
                 self.relu_thresh = None
+                _before_vars = tf.global_variables()
                 with tf.variable_scope(self.namescope):
                     self.relu_thresh = tf.get_variable("relu_thresh", shape=[], dtype=tf.float32, initializer=tf.zeros_initializer(), trainable=False)
                     # from nics_at.tf_utils import get_adaptive_relu
                     # if patch_relu in {"thresh", "backthrough_thresh"}:
                     #     self.patch_relu = get_adaptive_relu(self.relu_thresh, back_through=patch_relu=="backthrough_thresh")
                     # else:
-                self._vars.append(self.relu_thresh)
-                self.patch_relu = lambda inputs: relu_func(inputs, self.relu_thresh)
+                # under custom getters (e.g. the snapshot buffers of the gray-box following models), `relu_thresh` can be
+                # a tensor read from the created variables
+                self._vars += [var_ for var_ in tf.global_variables() if var_ not in _before_vars]
+                self.patch_relu = lambda inputs: relu_func(inputs, tf.cast(self.relu_thresh, inputs.dtype))
             else:
                 self.patch_relu = relu_func
+            self.activations["relu"] = lambda inputs, name=None: self.patch_relu(inputs)
 
     def _all_update_ops(self):
         return tf.get_collection(tf.GraphKeys.UPDATE_OPS, self.namescope)
@@ -94,6 +129,40 @@ class QCNN(Model):
     def get_training_status(self):
         return self.training
 
+    def activation(self, kind, inputs, name=None):
+        return self.activations[kind](inputs, name=name)
+
+    def relu(self, inputs, name=None):
+        return self.activation("relu", inputs, name=name)
+
+    def to_compute_dtype(self, inputs):
+        # called by the subclasses after preprocessing the float32 inputs
+        return tf.cast(inputs, self.compute_dtype) if inputs.dtype.base_dtype != self.compute_dtype else inputs
+
+    def in_float32(self, fn, inputs, *args, **kwargs):
+        # run numerically sensitive layers (e.g. batch normalization with float32 moving statistics) in float32
+        if inputs.dtype.base_dtype == tf.float32:
+            return fn(inputs, *args, **kwargs)
+        return tf.cast(fn(tf.cast(inputs, tf.float32), *args, **kwargs), inputs.dtype)
+
+    @staticmethod
+    def _float32_storage_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+        # keep float32 master weights, and use their float16 copies in the computation
+        if dtype == tf.float16:
+            var = getter(name, shape, tf.float32, *args, **kwargs)
+            return tf.cast(var, tf.float16)
+        return getter(name, shape, dtype, *args, **kwargs)
+
+    @staticmethod
+    def _cast_outputs(res, dtype):
+        def _cast(v):
+            if isinstance(v, (list, tuple)):
+                return type(v)([_cast(sv) for sv in v])
+            if isinstance(v, tf.Tensor) and v.dtype.is_floating and v.dtype.base_dtype != dtype:
+                return tf.cast(v, dtype)
+            return v
+        return {n: _cast(v) for n, v in res.iteritems()}
+
     def get_logits(self, inputs, output_name=None):
         """
         :param x: A symbolic representation of the network input
@@ -112,14 +181,7 @@ class QCNN(Model):
             _before_vars = tf.global_variables()
             if not self.test_only:
                 _before_t_vars = tf.trainable_variables()
-        with tf.variable_scope(self.namescope, reuse=self.reuse):
-            if self.patch_relu is not None: # patch tf.nn.relu to another relu func
-                _backup_relu = tf.nn.relu
-                tf.nn.relu = self.patch_relu
-                res = self._get_logits(inputs)
-                tf.nn.relu = _backup_relu
-            else:
-                res = self._get_logits(inputs)
+        res = self._build(inputs, self.reuse)
         [setattr(self, n, v) for n, v in res.iteritems()]
         self.cached[inputs] = res
         _after_vars = tf.global_variables()
@@ -136,42 +198,161 @@ class QCNN(Model):
                 self._trainable_vars += _after_t_vars
         return res[output_name]
 
+    def _build(self, inputs, reuse):
+        input_dtype = inputs.dtype.base_dtype
+        # the subclasses always get float32 inputs, and the outputs are casted back to the dtype of the inputs
+        compute_inputs = tf.cast(inputs, tf.float32) if input_dtype != tf.float32 else inputs
+        custom_getter = self._float32_storage_getter if self.compute_dtype == tf.float16 else None
+        with tf.variable_scope(self.namescope, reuse=reuse, custom_getter=custom_getter):
+            res = self._get_logits(compute_inputs)
+        return self._cast_outputs(res, input_dtype)
+
+    def fold_conv_batch_norm(self, inputs, outputs):
+        """
+        Called by the layers with the inputs and the outputs of a batch normalization. When `fold_bn` and the inputs are
+        the outputs of a convolution (with or without a bias), return the outputs of the convolution with the folded
+        weights `kernel * gamma / sqrt(moving_variance + epsilon)` and bias instead, which compute the same affine map,
+        so the outputs and the gradients w.r.t. the inputs are unchanged. The folded weights are computed from the variables
+        in the graph, so they always follow the loaded weights. Otherwise, return the batch normalization outputs.
+        """
+        if not self.fold_bn:
+            return outputs
+        bn = outputs.op
+        if bn.type != "FusedBatchNorm" or bn.get_attr("is_training") or bn.inputs[0] is not inputs:
+            return outputs # e.g. the float32 batch normalizations of the float16 models
+        conv_out, bias = inputs, 0.
+        if conv_out.op.type == "BiasAdd":
+            conv_out, bias = conv_out.op.inputs
+        conv = conv_out.op
+        if conv.type != "Conv2D" or conv.get_attr("data_format") != bn.get_attr("data_format"):
+            return outputs
+        if "dilations" in conv.node_def.attr and any(d != 1 for d in conv.get_attr("dilations")):
+            return outputs
+        gamma, beta, mean, variance = bn.inputs[1:5]
+        scale = gamma * tf.rsqrt(variance + bn.get_attr("epsilon"))
+        data_format = conv.get_attr("data_format")
+        # the output channels are the last axis of the kernel
+        folded = tf.nn.conv2d(conv.inputs[0], conv.inputs[1] * scale, strides=conv.get_attr("strides"),
+                              padding=conv.get_attr("padding"), data_format=data_format, name="folded_conv")
+        return tf.nn.bias_add(folded, (bias - mean) * scale + beta, data_format=data_format)
+
+    def get_forward(self, output_name=None):
+        """
+        :return: The reusable forward function of the model, `inputs -> output`, with shared variables.
+                 Unlike `get_logits`, the inputs are not cached and the model attributes are not changed, so it can be
+                 called on the fresh tensors of every attack step, e.g. in the body of a `tf.while_loop`, which is
+                 built only once however many steps are run.
+        """
+        output_name = output_name or self.output_name
+        if output_name not in self._forwards:
+            assert self.cached, "Fault: the variables of {} must be created by `get_logits` before using its forward function".format(self.namescope)
+            self._forwards[output_name] = lambda inputs: self._forward(inputs, output_name)
+        return self._forwards[output_name]
+
+    def _forward(self, inputs, output_name):
+        update_ops = tf.get_collection_ref(tf.GraphKeys.UPDATE_OPS)
+        num_update_ops = len(update_ops)
+        # `_get_logits` of the subclasses set the intermediate outputs as attributes (e.g. `relu_list` of resnets),
+        # keep the ones set by `get_logits`
+        attrs = dict(self.__dict__)
+        res = self._build(inputs, reuse=True)
+        self.__dict__.clear()
+        self.__dict__.update(attrs)
+        # the batch-norm update ops of the forward functions (e.g. inside the attack loops) must not be run by the trainers
+        del update_ops[num_update_ops:]
+        return res[output_name]
+
     def get_probs(self, x):
         return tf.nn.softmax(self.get_logits(x))
 
-    def get_saver(self, load_namescope=None, prepend=None, exclude_pattern=[]):
+    def get_var_mapping(self, load_namescope=None, prepend=None, exclude_pattern=[]):
+        """
+        :return: A dict of checkpoint variable name -> variable
+        """
         _vars = [v for v in self.vars if all(p not in v.op.name for p in exclude_pattern)]
         var_namescope = self.namescope if not prepend else prepend + "/" + self.namescope
         if load_namescope is None or load_namescope == var_namescope:
-            saver = tf.train.Saver(_vars, max_to_keep=20)
-        else:
-            var_mapping_dct = {var.op.name.replace(var_namescope + "/", (load_namescope + "/") if load_namescope else ""): var for var in _vars}
-            saver = tf.train.Saver(var_mapping_dct, max_to_keep=20)
-        return saver
+            return {var.op.name: var for var in _vars}
+        return {var.op.name.replace(var_namescope + "/", (load_namescope + "/") if load_namescope else ""): var for var in _vars}
+
+    def get_saver(self, load_namescope=None, prepend=None, exclude_pattern=[]):
+        # savers are cached, as constructing a saver adds new restore ops into the graph
+        key = (load_namescope, prepend, tuple(exclude_pattern))
+        if key not in self._load_savers:
+            self._load_savers[key] = tf.train.Saver(self.get_var_mapping(load_namescope, prepend, exclude_pattern), max_to_keep=20)
+        return self._load_savers[key]
+
+    def get_save_var_mapping(self, prepend=None):
+        if prepend is None:
+            return {var.op.name: var for var in self.vars}
+        return {var.op.name.replace(prepend + "/", ""): var for var in self.vars}
 
     def get_save_saver(self, prepend=None):
         if not self._save_saver:
-            if prepend is None:
-                saver = tf.train.Saver(self.vars, max_to_keep=20)
-            else:
-                var_mapping_dct = {var.op.name.replace(prepend + "/", ""): var for var in self.vars}
-                saver = tf.train.Saver(var_mapping_dct, max_to_keep=20)
-            self._save_saver = saver
+            self._save_saver = tf.train.Saver(self.get_save_var_mapping(prepend), max_to_keep=20)
         return self._save_saver
 
-    def load_checkpoint(self, path, sess, load_namescope=None, prepend_namescope=None, exclude_pattern=[]):
-        self.saver = self.get_saver(load_namescope, prepend=prepend_namescope, exclude_pattern=exclude_pattern)
+    def prefetch_checkpoint(self, path, load_namescope=None, prepend_namescope=None, exclude_pattern=[]):
+        """
+        Read the variable values from the checkpoint into host memory in a background thread.
+        Pass the returned object to `load_checkpoint` as `prefetched` to assign them.
+        """
+        return PrefetchedCheckpoint(path, self.get_var_mapping(load_namescope, prepend_namescope, exclude_pattern))
+
+    def _get_assign_ops(self, _vars):
+        for var in _vars:
+            if var not in self._assign_ops:
+                value_ph = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+                self._assign_ops[var] = (value_ph, var.assign(value_ph))
+        return [self._assign_ops[var] for var in _vars]
+
+    def load_checkpoint(self, path, sess, load_namescope=None, prepend_namescope=None, exclude_pattern=[], prefetched=None):
         print("Load model from", path)
+        if prefetched is not None:
+            assert prefetched.path == path
+            values = prefetched.wait()
+            _vars = list(values.keys())
+            assign_ops = self._get_assign_ops(_vars)
+            sess.run([op for _, op in assign_ops], feed_dict={ph: values[var] for var, (ph, _) in zip(_vars, assign_ops)})
+            return
+        self.saver = self.get_saver(load_namescope, prepend=prepend_namescope, exclude_pattern=exclude_pattern)
         self.saver.restore(sess, path)
 
     def save_checkpoint(self, path, sess, prepend_namescope=None):
         self.get_save_saver(prepend=prepend_namescope).save(sess, path)
 
+class PrefetchedCheckpoint(object):
+    def __init__(self, path, var_mapping):
+        self.path = path
+        self.var_mapping = var_mapping
+        self.values = {}
+        self.error = None
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        try:
+            reader = tf.train.NewCheckpointReader(self.path)
+            self.values = {var: reader.get_tensor(name) for name, var in self.var_mapping.iteritems()}
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.values
+
 class QCNNProxy(Model): # Patch get_logits func, and proxy all other attribute to proxy_model
     def __init__(self, proxy_model, patch_get_logits):
         super(Model, self).__init__()
         self.proxy_model = proxy_model
         self.get_logits = patch_get_logits.__get__(self)
 
+    def get_forward(self, output_name=None):
+        # the patched outputs are only available through `get_logits`
+        return self.get_logits
+
     def __getattr__(self, name):
         return getattr(self.proxy_model, name)
@@ -8,6 +8,7 @@ from nics_at import utils
 
 class _Denoiser(QCNN):
     TYPE = "prepend_denoiser"
+    supports_float16 = True
     def __init__(self, namescope, params):
         super(_Denoiser, self).__init__(namescope, params)
         self.forward = []
@@ -27,14 +28,14 @@ class _Denoiser(QCNN):
                                      strides=(stride_,stride_), padding="same", use_bias=False, name="conv"+str(index_),
                                      kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=self.weight_decay),
                                      kernel_initializer=tf.contrib.layers.variance_scaling_initializer())
-            bn_ = tf.contrib.layers.batch_norm(conv_, is_training=self.training, scale=True, scope="bn"+str(index_), decay=0.9)
-            relu_ = tf.nn.relu(bn_, name="relu"+str(index_))
+            bn_ = self.fold_conv_batch_norm(conv_, self.in_float32(tf.contrib.layers.batch_norm, conv_, is_training=self.training, scale=True, scope="bn"+str(index_), decay=0.9))
+            relu_ = self.relu(bn_, name="relu"+str(index_))
             return relu_
         _R_MEAN = 123.68
         _G_MEAN = 116.78
         _B_MEAN = 103.94
         _CHANNEL_MEANS = [_R_MEAN, _G_MEAN, _B_MEAN]
-        x = input_ - tf.constant(_CHANNEL_MEANS)
+        x = self.to_compute_dtype(input_ - tf.constant(_CHANNEL_MEANS))
         counter = 0
         for i in range(len(self.num_fwd)):
             for j in range(self.num_fwd[i]):
@@ -47,7 +48,7 @@ class _Denoiser(QCNN):
                 counter += 1
         self.backward.append(self.forward[-1])
         for i in range(len(self.num_back) - 1, -1, -1):
-            upsample = tf.image.resize_bilinear(self.backward[-1], self.forward[i].shape[1:3])
+            upsample = tf.cast(tf.image.resize_bilinear(self.backward[-1], self.forward[i].shape[1:3]), self.compute_dtype) # resize_bilinear outputs float32
             x = tf.concat([upsample, self.forward[i]], 3)
             x = conv_bn_relu(x, counter, self.back_out[i])
             self.backward.append(x)
@@ -55,7 +56,7 @@ class _Denoiser(QCNN):
         x = tf.layers.conv2d(x, filters=3, kernel_size=(1,1), padding="same", use_bias=False, name="last_conv",
                              kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=self.weight_decay),
                              kernel_initializer=tf.contrib.layers.variance_scaling_initializer())
-        self.denoise_output = x + input_
+        self.denoise_output = tf.cast(x, tf.float32) + input_
         return {
             "denoise_output": self.denoise_output,
             "forward": self.forward,
@@ -64,6 +65,8 @@ class _Denoiser(QCNN):
 
 class DenoiseNet(QCNN):
     TYPE = "denoise"
+    # the precision is decided by the denoiser and the inner model
+    supports_float16 = True
     def __init__(self, namescope, params):
         super(DenoiseNet, self).__init__(namescope, params)
         self.denoiser = QCNN.create_model(params["denoiser"])
@@ -86,6 +89,12 @@ class DenoiseNet(QCNN):
             "logits": self.logits
         }
 
+    def _forward(self, inputs, output_name):
+        # `_get_logits` caches the inputs in the denoiser and the inner model and changes the attributes,
+        # compose their forward functions instead (in this variable scope, in which their variables are created)
+        with tf.variable_scope(self.namescope, reuse=True):
+            return self.inner_model.get_forward()(self.denoiser.get_forward()(inputs))
+
     def load_checkpoint(self, path, sess, load_namescope=[None, None], exclude_pattern=[]):
         assert len(path) == 2 and len(load_namescope) == 2
         utils.log("Load denoiser/inner from ", path)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import tensorflow as tf
+from nics_at.models.base import QCNN
+
+# the names of the input placeholder and the output of the frozen graphs, see `nics_at.model_exporter`
+FROZEN_INPUT = "inputs"
+FROZEN_OUTPUT = "outputs"
+
+class FrozenModel(QCNN):
+    """
+    A test-only model loaded from a frozen inference graph exported by `nics_at.model_exporter`.
+    The weights are the constants of the graph, so the model has no variables, and loading checkpoints is a no-op.
+
+    model_params:
+        path: the frozen graph `.pb` file
+        precision: the precision the graph is exported in, which decides the loss scale of the gradients, default to float32
+    """
+    TYPE = "frozen"
+    # the computation of the frozen graph is fixed, the precision only decides the loss scale
+    supports_float16 = True
+
+    def __init__(self, namescope, params={}):
+        params = dict(params)
+        params["test_only"] = True
+        params.setdefault("precision", "float32")
+        super(FrozenModel, self).__init__(namescope, params)
+        self.path = params["path"]
+        graph_def = tf.GraphDef()
+        with open(self.path, "rb") as r_f:
+            graph_def.ParseFromString(r_f.read())
+        # the constants are imported once and shared by all the forward passes, only the computation is imported every time
+        is_const = lambda node: node.op == "Const" and not node.input
+        self.const_def = tf.GraphDef()
+        self.const_def.versions.CopyFrom(graph_def.versions)
+        self.const_def.node.extend([node for node in graph_def.node if is_const(node)])
+        self.compute_def = tf.GraphDef()
+        self.compute_def.versions.CopyFrom(graph_def.versions)
+        self.compute_def.library.CopyFrom(graph_def.library)
+        self.compute_def.node.extend([node for node in graph_def.node if not is_const(node) and node.name != FROZEN_INPUT])
+        # the whole graph, imported by the forward functions, see `get_forward`
+        self.forward_def = tf.GraphDef()
+        self.forward_def.CopyFrom(self.compute_def)
+        self.forward_def.node.extend(self.const_def.node)
+        self.consts = None
+
+    def _get_logits(self, inputs):
+        if self.consts is None:
+            # outside of the control flow contexts (e.g. when the first forward is built in an attack loop)
+            with tf.control_dependencies(None):
+                names = [node.name + ":0" for node in self.const_def.node]
+                self.consts = dict(zip(names, tf.import_graph_def(self.const_def, return_elements=names, name="frozen_constants")))
+        input_map = dict(self.consts)
+        input_map[FROZEN_INPUT + ":0"] = inputs
+        logits = tf.import_graph_def(self.compute_def, input_map=input_map, return_elements=[FROZEN_OUTPUT + ":0"], name="frozen")[0]
+        return {self.output_name: logits}
+
+    def get_forward(self, output_name=None):
+        # `tf.import_graph_def` adds the inputs of the imported ops after creating them, so no `Enter` ops are added for
+        # the mapped tensors that are outside of the current while loop (e.g. the shared constants in the attack loops),
+        # import the constants together with the computation in the current control flow context instead
+        def forward(inputs):
+            return tf.import_graph_def(self.forward_def, input_map={FROZEN_INPUT + ":0": inputs},
+                                       return_elements=[FROZEN_OUTPUT + ":0"], name="frozen")[0]
+        return forward
+
+    def prefetch_checkpoint(self, path, *args, **kwargs):
+        # nothing to read, `load_checkpoint` is called without `prefetched`
+        return None
+
+    def load_checkpoint(self, path, sess, *args, **kwargs):
+        print("Model {} is frozen from {}, skip loading {}".format(self.namescope, self.path, path))
@@ -6,6 +6,7 @@ from nics_at.models.base import QCNN
 
 class Inception(QCNN):
     TYPE = "inception"
+    supports_float16 = True
     def __init__(self, namescope, params={}):
         super(Inception, self).__init__(namescope, params)
         self.num_classes = params.get("num_classes", 200)
@@ -24,13 +25,14 @@ class Inception(QCNN):
                 strides=(stride_,stride_), padding="same", use_bias=False,
              kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=weight_decay),
              kernel_initializer=tf.contrib.layers.variance_scaling_initializer(), name=name_scope+"conv"+str(index_))
-            bn_ = tf.contrib.layers.batch_norm(conv_, is_training=self.training, scale=True,
-                 scope=name_scope+"bn"+str(index_), decay=0.9)
-            relu_ = tf.nn.relu(bn_, name=name_scope+"relu"+str(index_))
+            bn_ = self.fold_conv_batch_norm(conv_, self.in_float32(tf.contrib.layers.batch_norm, conv_, is_training=self.training, scale=True,
+                 scope=name_scope+"bn"+str(index_), decay=0.9))
+            relu_ = self.relu(bn_, name=name_scope+"relu"+str(index_))
             return relu_
         inputs = inputs - tf.cast(tf.constant(self.substract_mean), tf.float32)
         if self.div is not None and not np.all(self.div == 1.):
             inputs = inputs / self.div
+        inputs = self.to_compute_dtype(inputs)
         ###stem
         c = conv_relu(inputs, 1, 32, (3, 3), 2)
         c = conv_relu(c, 2, 64, (3, 3), 1)
@@ -52,10 +54,10 @@ class Inception(QCNN):
                     strides=(2,2), padding='SAME')
         c2 = conv_relu(c, 10, 192, (3, 3), 2)
         c = tf.concat([c1, c2], 3)
-        c = tf.contrib.layers.batch_norm(c, 
+        c = self.in_float32(tf.contrib.layers.batch_norm, c,
             is_training=self.training, scale=True, 
             scope="branch3-bn1", decay=0.9)
-        c = tf.nn.relu(c, name="relu_branch3")
+        c = self.relu(c, name="relu_branch3")
         #8*8*384
         ###Inception-A
         def inception_a(input_, index_):
@@ -12,14 +12,14 @@ class Mnist_madry(QCNN):
         # first convolutional layer
         W_conv1 = self._weight_variable([5,5,1,32], "conv1")
         b_conv1 = self._bias_variable([32], "conv1")
-        h_conv1 = tf.nn.relu(self._conv2d(inputs, W_conv1) + b_conv1)
+        h_conv1 = self.relu(self._conv2d(inputs, W_conv1) + b_conv1)
         h_pool1 = self._max_pool_2x2(h_conv1)
 
         # second convolutional layer
         W_conv2 = self._weight_variable([5,5,32,64], "conv2")
         b_conv2 = self._bias_variable([64], "conv2")
 
-        h_conv2 = tf.nn.relu(self._conv2d(h_pool1, W_conv2) + b_conv2)
+        h_conv2 = self.relu(self._conv2d(h_pool1, W_conv2) + b_conv2)
         h_pool2 = self._max_pool_2x2(h_conv2)
 
         # first fully connected layer
@@ -27,7 +27,7 @@ class Mnist_madry(QCNN):
         b_fc1 = self._bias_variable([1024], "fc1")
 
         h_pool2_flat = tf.reshape(h_pool2, [-1, 7 * 7 * 64])
-        h_fc1 = tf.nn.relu(tf.matmul(h_pool2_flat, W_fc1) + b_fc1)
+        h_fc1 = self.relu(tf.matmul(h_pool2_flat, W_fc1) + b_fc1)
 
         # output layer
         W_fc2 = self._weight_variable([1024,10], "fc2")
@@ -8,6 +8,7 @@ DEFAULT_VERSION = 2
 
 class Resnet(QCNN):
     TYPE = "resnet18"
+    supports_float16 = True
     def __init__(self, namescope, params={}):
         super(Resnet, self).__init__(namescope, params)
 
@@ -57,16 +58,20 @@ class Resnet(QCNN):
         """Performs a batch normalization using a standard set of parameters."""
         # We set fused=True for a significant performance boost. See
         # https://www.tensorflow.org/performance/performance_guide#common_fused_ops
+        if self.use_bn_renorm and inputs.dtype.base_dtype == tf.float16:
+            # batch renormalization is not fused, its variables must be created in float32
+            return self.in_float32(self.batch_norm, inputs, training, data_format)
         if self.use_bias:
-            return tf.layers.batch_normalization(
+            outputs = tf.layers.batch_normalization(
                 inputs=inputs, axis=1 if data_format == 'channels_first' else 3,
                 momentum=self.batch_norm_momentum, epsilon=_BATCH_NORM_EPSILON, center=True,
                 scale=True, training=training, fused=True, renorm=self.use_bn_renorm)
         else:
-            return tf.layers.batch_normalization(
+            outputs = tf.layers.batch_normalization(
                 inputs=inputs, axis=1 if data_format == 'channels_first' else 3,
                 momentum=self.batch_norm_momentum, epsilon=_BATCH_NORM_EPSILON, center=False,
                 scale=False, training=training, fused=True, renorm=self.use_bn_renorm)
+        return self.fold_conv_batch_norm(inputs, outputs)
 
 
     def fixed_padding(self, inputs, kernel_size, data_format):
@@ -118,7 +123,7 @@ class Resnet(QCNN):
                            data_format, coarse_dropout=False):
         shortcut = inputs
         inputs = self.batch_norm(inputs, training, data_format)
-        inputs = tf.nn.relu(inputs)
+        inputs = self.relu(inputs)
         # if self.reuse == False:
         self.relu_list.append(tf.reduce_mean(inputs, [2,3]))
 
@@ -137,7 +142,7 @@ class Resnet(QCNN):
                 data_format=data_format)
 
         inputs = self.batch_norm(inputs, training, data_format)
-        inputs = tf.nn.relu(inputs)
+        inputs = self.relu(inputs)
         # if self.reuse == False:
         self.relu_list.append(tf.reduce_mean(inputs, [2,3]))
         inputs = self.conv2d_fixed_padding(
@@ -180,6 +185,7 @@ class Resnet(QCNN):
         inputs = inputs - tf.cast(tf.constant(self.substract_mean), tf.float32)
         if self.div is not None and not np.all(self.div == 1.):
             inputs = inputs / self.div
+        inputs = self.to_compute_dtype(inputs)
         # weight_decay = self.weight_decay
         if self.data_format == 'channels_first':
             # Convert the inputs from channels_last (NHWC) to channels_first (NCHW).
@@ -210,7 +216,7 @@ class Resnet(QCNN):
             group_list.append(inputs)
 
         inputs = self.batch_norm(inputs, self.training, self.data_format)
-        inputs = tf.nn.relu(inputs)
+        inputs = self.relu(inputs)
         # if self.reuse == False:
         relu_list.append(tf.reduce_mean(inputs, [2,3]))
         # The current top layer has shape
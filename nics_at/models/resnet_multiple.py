@@ -53,10 +53,11 @@ class Resnet(QCNN):
         """Performs a batch normalization using a standard set of parameters."""
         # We set fused=True for a significant performance boost. See
         # https://www.tensorflow.org/performance/performance_guide#common_fused_ops
-        return tf.layers.batch_normalization(
+        outputs = tf.layers.batch_normalization(
                 inputs=inputs, axis=1 if data_format == 'channels_first' else 3,
                 momentum=self.batch_norm_momentum, epsilon=_BATCH_NORM_EPSILON, center=True,
                 scale=True, training=training, fused=True, name=name)
+        return self.fold_conv_batch_norm(inputs, outputs)
 
 
     def fixed_padding(self, inputs, kernel_size, data_format):
@@ -108,7 +109,7 @@ class Resnet(QCNN):
                            data_format, coarse_dropout=False):
         shortcut = inputs
         inputs = self.batch_norm(inputs, training, data_format)
-        inputs = tf.nn.relu(inputs)
+        inputs = self.relu(inputs)
         # if self.reuse == False:
         self.relu_list.append(tf.reduce_mean(inputs, [2,3]))
 
@@ -127,7 +128,7 @@ class Resnet(QCNN):
                 data_format=data_format)
 
         inputs = self.batch_norm(inputs, training, data_format)
-        inputs = tf.nn.relu(inputs)
+        inputs = self.relu(inputs)
         # if self.reuse == False:
         self.relu_list.append(tf.reduce_mean(inputs, [2,3]))
         inputs = self.conv2d_fixed_padding(
@@ -200,7 +201,7 @@ class Resnet(QCNN):
             group_list.append(inputs)
 
         inputs = self.batch_norm(inputs, self.training, self.data_format)
-        inputs = tf.nn.relu(inputs)
+        inputs = self.relu(inputs)
         # if self.reuse == False:
         relu_list.append(tf.reduce_mean(inputs, [2,3]))
         # The current top layer has shape
@@ -221,7 +222,7 @@ class Resnet(QCNN):
         inputs = readout_layer(inputs)
         inputs = tf.identity(inputs, 'final_dense')
 
-        group_logits_list = [tf.layers.Dense(units=self.num_classes, name="readout_group_{}".format(i))(tf.reduce_mean(tf.nn.relu(self.batch_norm(o, self.training, self.data_format, name="bn_readout_group_{}".format(i))), axes)) for i, o in enumerate(group_list[:-1])]
+        group_logits_list = [tf.layers.Dense(units=self.num_classes, name="readout_group_{}".format(i))(tf.reduce_mean(self.relu(self.batch_norm(o, self.training, self.data_format, name="bn_readout_group_{}".format(i))), axes)) for i, o in enumerate(group_list[:-1])]
         return {
             "logits": inputs,
             "group_list": group_list,
@@ -2,7 +2,7 @@
 
 import tensorflow as tf
 
-def conv_relu(input_, index_, filters_, kernel_size_=(3, 3), stride_=2, name_scope="", weight_decay=0., training=False, use_bn=True):
+def conv_relu(input_, index_, filters_, kernel_size_=(3, 3), stride_=2, name_scope="", weight_decay=0., training=False, use_bn=True, activation=tf.nn.relu, fold_bn=None):
     if training == False:
         conv_ = tf.layers.conv2d(input_, filters=filters_, kernel_size=kernel_size_,
                                  strides=(stride_, stride_), padding="same", use_bias=False,
@@ -15,21 +15,23 @@ def conv_relu(input_, index_, filters_, kernel_size_=(3, 3), stride_=2, name_sco
     if use_bn:
         bn_ = tf.contrib.layers.batch_norm(conv_, is_training=training, scale=True,
                                            scope=name_scope+"bn"+str(index_), decay=0.9)
+        if fold_bn is not None: # e.g. `QCNN.fold_conv_batch_norm`
+            bn_ = fold_bn(conv_, bn_)
     else:
         bn_ = conv_
-    relu_ = tf.nn.relu(bn_, name=name_scope+"relu"+str(index_))
+    relu_ = activation(bn_, name=name_scope+"relu"+str(index_))
     return relu_
 
-def inception_module(input_, index_, br1, br2_1, br2_2, br3_1, br3_2, br4, pool=False, weight_decay=0., training=False, use_bn=True):
+def inception_module(input_, index_, br1, br2_1, br2_2, br3_1, br3_2, br4, pool=False, weight_decay=0., training=False, use_bn=True, activation=tf.nn.relu, fold_bn=None):
     scope_ = "inception" + str(index_)
-    br1_c = conv_relu(input_, 1, br1,   (1, 1), 1, scope_, weight_decay, training, use_bn)
-    br2_c = conv_relu(input_, 2, br2_1, (1, 1), 1, scope_, weight_decay, training, use_bn)
-    br2_c = conv_relu(br2_c,  3, br2_2, (3, 3), 1, scope_, weight_decay, training, use_bn)
-    br3_c = conv_relu(input_, 4, br3_1, (1, 1), 1, scope_, weight_decay, training, use_bn)
-    br3_c = conv_relu(br3_c,  5, br3_2, (3, 3), 1, scope_, weight_decay, training, use_bn)
-    br3_c = conv_relu(br3_c,  6, br3_2, (3, 3), 1, scope_, weight_decay, training, use_bn)
+    br1_c = conv_relu(input_, 1, br1,   (1, 1), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
+    br2_c = conv_relu(input_, 2, br2_1, (1, 1), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
+    br2_c = conv_relu(br2_c,  3, br2_2, (3, 3), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
+    br3_c = conv_relu(input_, 4, br3_1, (1, 1), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
+    br3_c = conv_relu(br3_c,  5, br3_2, (3, 3), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
+    br3_c = conv_relu(br3_c,  6, br3_2, (3, 3), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
     br4_c = tf.layers.max_pooling2d(input_, pool_size=(3, 3), strides=(1, 1), padding="SAME")
-    br4_c = conv_relu(br4_c,  7, br4,   (1, 1), 1, scope_, weight_decay, training, use_bn)
+    br4_c = conv_relu(br4_c,  7, br4,   (1, 1), 1, scope_, weight_decay, training, use_bn, activation, fold_bn)
     merge_ = tf.concat([br1_c, br2_c, br3_c, br4_c], 3)
     if pool:
         merge_ = tf.layers.max_pooling2d(merge_, pool_size=(3, 3), strides=(2, 2), padding="SAME")
@@ -28,11 +28,11 @@ class VGG11(QCNN):
              kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=weight_decay),
              kernel_initializer=tf.contrib.layers.variance_scaling_initializer(), name=name_scope + "conv"+str(index_))
             if self.use_bn:
-                bn_ = tf.contrib.layers.batch_norm(conv_, is_training=self.training, scale=True,
-                                                   scope=name_scope+"bn"+str(index_), decay=0.9)
+                bn_ = self.fold_conv_batch_norm(conv_, tf.contrib.layers.batch_norm(conv_, is_training=self.training, scale=True,
+                                                                                    scope=name_scope+"bn"+str(index_), decay=0.9))
             else:
                 bn_ = conv_
-            relu_ = tf.nn.relu(bn_, name=name_scope + "relu"+str(index_))
+            relu_ = self.relu(bn_, name=name_scope + "relu"+str(index_))
             if use_pool:
                 pool_ = tf.layers.max_pooling2d(relu_, name=name_scope+"pool"+str(index_), pool_size=(2, 2), strides=2)
                 return conv_, relu_, pool_
@@ -55,13 +55,13 @@ class VGG11(QCNN):
         ip1 = tf.layers.dense(flat, units=512/self.filter_size_div, name="ip1",
                              kernel_initializer=tf.contrib.layers.variance_scaling_initializer(),
                               kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=weight_decay), use_bias=self.use_bias)
-        relu6 = tf.nn.relu(ip1, name="relu6")
+        relu6 = self.relu(ip1, name="relu6")
         relu6 = tf.layers.dropout(relu6, 0.5, training=self.training)
         # ip2 = tf.layers.dense(relu6, units=2048/self.filter_size_div, name="ip2",
         ip2 = tf.layers.dense(relu6, units=512/self.filter_size_div, name="ip2",
                              kernel_initializer=tf.contrib.layers.variance_scaling_initializer(),
                              kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=weight_decay), use_bias=self.use_bias)
-        relu7 = tf.nn.relu(ip2, name="relu7")
+        relu7 = self.relu(ip2, name="relu7")
         logits = tf.layers.dense(relu7, units=self.num_classes, name="logits",
                              kernel_initializer=tf.contrib.layers.variance_scaling_initializer(),
                              kernel_regularizer=tf.contrib.layers.l2_regularizer(scale=weight_decay), use_bias=self.use_bias)
@@ -7,6 +7,7 @@ from nics_at.models.base import QCNN
 
 class VGG9(QCNN):
     TYPE = "vgg9"
+    supports_float16 = True
     def __init__(self, namescope, params={}):
         super(VGG9, self).__init__(namescope, params)
         self.num_classes = params.get("num_classes", 200)
@@ -29,11 +30,11 @@ class VGG9(QCNN):
              kernel_regularizer=None if self.test_only else tf.contrib.layers.l2_regularizer(scale=weight_decay),
              kernel_initializer=tf.contrib.layers.variance_scaling_initializer(), name=name_scope + "conv"+str(index_))
             if self.use_bn:
-                bn_ = tf.contrib.layers.batch_norm(conv_, is_training=self.training, scale=True,
-                                                   scope=name_scope+"bn"+str(index_), decay=0.9, renorm=self.use_bn_renorm)
+                bn_ = self.fold_conv_batch_norm(conv_, self.in_float32(tf.contrib.layers.batch_norm, conv_, is_training=self.training, scale=True,
+                                                                       scope=name_scope+"bn"+str(index_), decay=0.9, renorm=self.use_bn_renorm))
             else:
                 bn_ = conv_
-            relu_ = tf.nn.relu(bn_, name=name_scope + "relu"+str(index_))
+            relu_ = self.relu(bn_, name=name_scope + "relu"+str(index_))
             if use_pool:
                 pool_ = tf.layers.max_pooling2d(relu_, name=name_scope+"pool"+str(index_), pool_size=(2, 2), strides=2)
                 return conv_, relu_, pool_
@@ -42,6 +43,7 @@ class VGG9(QCNN):
         inputs = inputs - tf.cast(tf.constant(self.substract_mean), tf.float32)
         if self.div is not None and not np.all(self.div == 1.):
             inputs = inputs / self.div
+        inputs = self.to_compute_dtype(inputs)
         conv1, relu1, pool1 = conv_relu_pool(inputs, 1, 64)
         conv2, relu2, pool2 = conv_relu_pool(pool1, 2, 128)
         conv3_1, relu3_1 = conv_relu_pool(pool2, 3, 256, use_pool=False)
@@ -12,8 +12,13 @@ import tensorflow as tf
 from models import QCNN
 import utils
 from utils import AvailModels, LrAdjuster
-from attacks import Attack, AttackGenerator
+from tf_utils import compute_scaled_gradients
+from attacks import Attack, CleverhansAttack, AttackGenerator, warm_up_attacks
 from base_trainer import settings, Trainer
+from evaluator import BatchEvaluator
+from ckpt_writer import AsyncCheckpointWriter
+from adv_store import AdvStoreWriter, AdvStoreReader
+from graph_cache import AttackGraphCache, get_config_hash
 
 class MutualTrainer(Trainer):
     class _settings(settings):
@@ -35,6 +40,12 @@ class MutualTrainer(Trainer):
             "batch_size": 100,
             "adjust_lr_acc": None,
             "async_update_per_model": False,
+            "precision": "float32", # "float16": build the models in half precision (with float32 master weights)
+            "loss_scale": 128., # only used in float16 models
+            "async_save": False, # write checkpoints from a background thread
+            "save_retention": None, # e.g. {"keep_last": 5, "keep_best": 3, "keep_every": 10}; default to keep the last 10
+            "adv_store": None, # e.g. {"store_dir": "advs", "shard_size": 5000, "keys": None}; store the generated training adversarials
+            "stored_adv": [], # e.g. [{"store_dir": "advs", "key": "pgd", "epoch": None}]; use the stored adversarials as `__generated__` ones
 
             "alpha": 0.1,
             "beta": 0,
@@ -47,6 +58,7 @@ class MutualTrainer(Trainer):
             # Testing
             "test_saltpepper": None,
             "test_models": {},
+            "test_eval_batch_size": None, # maximum number of concatenated clean/adv rows evaluated in one run per model
 
             # Augmentaion
             "aug_saltpepper": None,
@@ -54,6 +66,10 @@ class MutualTrainer(Trainer):
 
             # Adversarial Augmentation
             "available_attacks": [],
+            "attack_warm_up": False, # construct the graphs of all the scheduled attacks while the checkpoints are read, instead of on their first use
+            "attack_warm_up_run": False, # also run every scheduled attack once on a dummy batch in the warm-up
+            "fuse_attacks": False, # generate all the white-box adversarials of a batch in one graph execution, sharing the clean forward passes
+            "attack_graph_cache": None, # a directory; cache the constructed attack graphs as MetaGraphs keyed by the config hash, repeated runs import them instead of constructing
             "use_cache": False, # whether attack generator cached adversarial for every batch
             "generated_adv": [],
             "train_models": {},
@@ -81,6 +97,8 @@ class MutualTrainer(Trainer):
         (self.imgs_t, self.auged_imgs_t, self.labels_t, self.adv_imgs_t), (self.imgs_v, self.auged_imgs_v, self.labels_v, self.adv_imgs_v) = self.dataset.data_tensors
 
         self.labels = tf.placeholder(tf.float32, [None, self.num_labels], name="labels")
+        QCNN.default_precision = self.FLAGS.precision
+        QCNN.default_loss_scale = self.FLAGS.loss_scale
         model_lst = [QCNN.create_model(m_cfg) for m_cfg in self.FLAGS["models"]]
         input_holder_lst = []
         saver_lst = []
@@ -150,7 +168,7 @@ class MutualTrainer(Trainer):
             kl_loss = tf.reduce_mean(kl_losses)
             # regularization loss
             reg_vs = [reg_v for reg_v in tf.losses.get_regularization_losses() if name_scope + "/" in reg_v.op.name]
-            reg_loss = tf.reduce_sum(reg_vs) if reg_vs else tf.constant(0.)
+            reg_loss = tf.add_n([tf.cast(reg_v, tf.float32) for reg_v in reg_vs]) if reg_vs else tf.constant(0.)
 
             loss = self.FLAGS.theta * ce_loss_lst[i] + self.FLAGS.alpha * kl_loss + reg_loss
             kl_loss_lst.append(kl_loss)
@@ -160,7 +178,7 @@ class MutualTrainer(Trainer):
             if self.FLAGS.multi_grad_accumulate:
                 tvs = model_lst[i].trainable_vars
                 accum_vars = [tf.Variable(tf.zeros_like(tv), trainable=False) for tv in tvs]
-                grads_and_vars = optimizer.compute_gradients(loss, var_list=tvs)
+                grads_and_vars = compute_scaled_gradients(optimizer, loss, model_lst[i].loss_scale, var_list=tvs)
                 zero_agrad_op = [tv.assign(tf.zeros_like(tv)) for tv in accum_vars]
                 with tf.control_dependencies(update_ops):
                     accum_ops = [accum_vars[i].assign_add(gv[0]) for i, gv in enumerate(grads_and_vars)]
@@ -170,7 +188,7 @@ class MutualTrainer(Trainer):
                 self.zero_agrad_op_lst.append(zero_agrad_op)
             else:
                 with tf.control_dependencies(update_ops):
-                    grads_and_vars = optimizer.compute_gradients(loss, var_list=model_vars_lst[i])
+                    grads_and_vars = compute_scaled_gradients(optimizer, loss, model_lst[i].loss_scale, var_list=model_vars_lst[i])
                     train_step = optimizer.apply_gradients(grads_and_vars)
                     train_step_lst.append(train_step)
 
@@ -193,6 +211,11 @@ class MutualTrainer(Trainer):
             self.zero_agrad_op_lst = tuple(self.zero_agrad_op_lst)
         self.namescope_lst = namescope_lst
 
+        # Evaluate clean and all adversarial variants of a validation batch for all the models in one run
+        self.evaluator = BatchEvaluator(self.dataset.image_shape, self.num_labels, max_rows=self.FLAGS.test_eval_batch_size)
+        for i in range(self.mutual_num):
+            self.evaluator.add_group([self.input_holder_lst[i]], [self.logits_lst[i]], training=[self.training_lst[i]])
+
         # Initialize relu thrshold schedule adjuster
         if self.FLAGS.relu_thresh_schedule is not None:
             self.relu_thresh_adjuster = LrAdjuster.create_adjuster(self.FLAGS.relu_thresh_schedule, name="relu_thresh")
@@ -200,23 +223,25 @@ class MutualTrainer(Trainer):
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
         self.sess = tf.Session(config=config)
+        if self.FLAGS.attack_graph_cache:
+            CleverhansAttack.graph_cache = AttackGraphCache(self.FLAGS.attack_graph_cache, get_config_hash(self.FLAGS.dct, {"test_only": self.FLAGS.test_only}))
         [Attack.create_attack(self.sess, a_cfg) for a_cfg in (self.FLAGS["available_attacks"] or [])]
+        self.adv_store = AdvStoreWriter(**self.FLAGS.adv_store) if self.FLAGS.adv_store and not self.FLAGS.test_only else None
         self.train_attack_gen = AttackGenerator(self.FLAGS["train_models"], merge=self.FLAGS.train_merge_adv,
                                                 split_adv=self.FLAGS.split_adv, random_split_adv=self.FLAGS.random_split_adv,
                                                 random_interp=self.FLAGS.random_interp, random_interp_adv=self.FLAGS.random_interp_adv,
                                                 use_cache=self.FLAGS.use_cache,
-                                                mixup_alpha=self.FLAGS.mixup_alpha, name="train")
+                                                mixup_alpha=self.FLAGS.mixup_alpha, adv_store=self.adv_store,
+                                                stored_advs=[AdvStoreReader(**r_cfg) for r_cfg in self.FLAGS.stored_adv or []], fuse_attacks=self.FLAGS.fuse_attacks, name="train")
         self.test_attack_gen = AttackGenerator(self.FLAGS["test_models"],
                                                split_adv=self.FLAGS.test_split_adv, random_interp_adv=self.FLAGS.test_random_interp_adv,
                                                use_cache=self.FLAGS.use_cache,
-                                               name="test")
+                                               fuse_attacks=self.FLAGS.fuse_attacks, name="test")
 
     def test(self, saltpepper=None, adv=False, name=""):
         sess = self.sess
         steps_per_epoch = self.dataset.val_num // self.FLAGS.batch_size
-        loss_lst_v_test = np.zeros(self.mutual_num)
-        acc_lst_v_test = np.zeros(self.mutual_num)
-        image_disturb = np.zeros(self.mutual_num)
+        clean_res = np.zeros((self.mutual_num, 3))
         test_res = [OrderedDict() for _ in range(self.mutual_num)]
         for step in range(1, steps_per_epoch+1):
             self.test_attack_gen.new_batch()
@@ -227,41 +252,31 @@ class MutualTrainer(Trainer):
                 u = np.random.uniform(size=list(x_v.shape[:3]) + [1])
                 salt = (u >= 1 - saltpepper/2).astype(x_v.dtype) * 256
                 pepper = - (u < saltpepper/2).astype(x_v.dtype) * 256
-                img = np.clip(img + salt + pepper, 0, 255)
-                auged_x = [img] * self.mutual_num
+                auged_x = np.clip(img + salt + pepper, 0, 255)
             else:
-                auged_x = [x_v] * self.mutual_num
-            acc_lst_v, ce_loss_lst_v = sess.run([self.accuracy_lst, self.ce_loss_lst], feed_dict={
-                self.input_holder_lst: auged_x,
-                self.labels: y_v,
-                self.training_lst: [False] * self.mutual_num
-            })
-            image_disturb += [np.abs(y - x_v).mean() for y in auged_x]
-            loss_lst_v_test += ce_loss_lst_v
-            acc_lst_v_test += acc_lst_v
-            # test adv
-            if adv:
-                for mi in range(self.mutual_num):
+                auged_x = x_v
+            # The clean examples' distance is measured to `x_v`, adversarial examples' distance is measured to `auged_x_v`
+            batch_size = x_v.shape[0]
+            group_variants = []
+            test_ids_lst = []
+            for mi in range(self.mutual_num):
+                variants = [(auged_x, np.arange(batch_size))]
+                test_ids = []
+                if adv:
                     test_ids, adv_xs, _ = self.test_attack_gen.generate_for_model(auged_x_v, y_v, self.namescope_lst[mi], adv_x_v)
-                    for test_id, adv_x in zip(test_ids, adv_xs):
-                        acc_v, ce_loss_v = sess.run([self.accuracy_lst[mi], self.ce_loss_lst[mi]], feed_dict={
-                            self.input_holder_lst[mi]: adv_x,
-                            self.labels: y_v,
-                            self.training_lst[mi]: False
-                        })
-                        if test_id not in test_res[mi]:
-                            test_res[mi][test_id] = np.zeros(3)
-                        if adv_x.shape != auged_x_v.shape:
-                            sp = [auged_x_v.shape[0], adv_x.shape[0] / auged_x_v.shape[0]] + list(auged_x_v.shape[1:])
-                            tmp_adv_x = adv_x.reshape(sp)
-                            sp[1] = 1
-                            mean_dist = np.mean(np.abs(tmp_adv_x - auged_x_v.reshape(sp)))
-                        else:
-                            mean_dist = np.mean(np.abs(adv_x - auged_x_v)) # L1 dist
-                        test_res[mi][test_id] += [acc_v, ce_loss_v, mean_dist]
-        image_disturb /= steps_per_epoch
-        loss_lst_v_test /= steps_per_epoch
-        acc_lst_v_test /= steps_per_epoch
+                    variants += [(adv_x, BatchEvaluator.get_index(adv_x, batch_size, batch_size)) for adv_x in adv_xs]
+                group_variants.append(variants)
+                test_ids_lst.append(test_ids)
+            # per model [number of variants, 3]: acc, ce_loss, dist
+            res_lst = self.evaluator.evaluate(sess, np.concatenate([x_v, auged_x_v]), np.concatenate([y_v, y_v]), group_variants)
+            for mi, (test_ids, res) in enumerate(zip(test_ids_lst, res_lst)):
+                clean_res[mi] += res[0]
+                for test_id, attack_res in zip(test_ids, res[1:]):
+                    if test_id not in test_res[mi]:
+                        test_res[mi][test_id] = np.zeros(3)
+                    test_res[mi][test_id] += attack_res
+        clean_res /= steps_per_epoch
+        acc_lst_v_test, loss_lst_v_test, image_disturb = clean_res.T
         print("\r", end="")
         utils.log("\tTest {}: \n\t\t{}".format(
             name, "\n\t\t".join(["ce loss: {}; accuracy: {:.2f} %; Mean pixel distance: {:2f}".format(l, a, d) for l, a, d in zip(loss_lst_v_test, acc_lst_v_test*100, image_disturb)])))
@@ -308,7 +323,7 @@ class MutualTrainer(Trainer):
                     # but black-box-generated do not support mixup now, so must use the prob of ori auged/non-auged normal to guide...
                     # 1. support black-box-mixup and maybe the beta distribution should encourage sparsity more? beta(1,1) is so flat, maybe the black-box will not work that well....
                     # 2. feed-forward to the prob using both mixed-up and non mixed-up, for mixedup data(normal/whitebox) and non-mixed up data(blackbox) respectively... this will further slow down the mutual trainer...
-                    _, adv_xs, ys = self.train_attack_gen.generate_for_model(auged_x_v, y_v, self.namescope_lst[mi], adv_x_v)
+                    _, adv_xs, ys = self.train_attack_gen.generate_for_model(auged_x_v, y_v, self.namescope_lst[mi], adv_x_v, clean_x=x_v)
                     if step == 1 and mi == 0 and info_v_epoch.shape[1] != len(adv_xs):
                         info_v_epoch = np.zeros((self.mutual_num, len(adv_xs), 4))
                     # if len(adv_xs) == 0: # no adv is generated
@@ -360,11 +375,16 @@ class MutualTrainer(Trainer):
                 if self.FLAGS.train_dir:
                     if is_best or (self.FLAGS.save_every > 0 and epoch % self.FLAGS.save_every == 0):
                         save_path = os.path.join(self.FLAGS.train_dir, str(epoch))
-                        if not os.path.exists(save_path):
-                            os.makedirs(save_path)
-                        for i, saver in enumerate(self.saver_lst):
-                            saver.save(sess, os.path.join(save_path, "model_{}".format(i)))
-                        utils.log("Saved multiple model to: ", save_path)
+                        if self.ckpt_writer_lst:
+                            for i, writer in enumerate(self.ckpt_writer_lst):
+                                writer.save(sess, os.path.join(save_path, "model_{}".format(i)), epoch=epoch, score=np.mean(test_accs))
+                            utils.log("Snapshotted multiple model, will be saved to: ", save_path)
+                        else:
+                            if not os.path.exists(save_path):
+                                os.makedirs(save_path)
+                            for i, saver in enumerate(self.saver_lst):
+                                saver.save(sess, os.path.join(save_path, "model_{}".format(i)))
+                            utils.log("Saved multiple model to: ", save_path)
 
     def start(self):
         if self.FLAGS.load_file:
@@ -390,10 +410,18 @@ class MutualTrainer(Trainer):
             load_files = self.FLAGS.load_file
         load_files += [m_cfg["checkpoint"] for m_cfg in self.FLAGS["additional_models"]]
         load_namescopes += [m_cfg["load_namescope"] for m_cfg in self.FLAGS["additional_models"]]
+        prefetched = []
         if load_files:
             assert len(load_files) == self.mutual_num + len(self.FLAGS.additional_models)
-            for m, l_namescope, l_file in zip(self.model_lst, load_namescopes, load_files):
-                m.load_checkpoint(l_file, self.sess, l_namescope, exclude_pattern=self.FLAGS.load_exclude)
+            # read the checkpoints in background threads while warming up the attacks
+            prefetched = [m.prefetch_checkpoint(l_file, l_namescope, exclude_pattern=self.FLAGS.load_exclude)
+                          for m, l_namescope, l_file in zip(self.model_lst, load_namescopes, load_files)]
+        if self.FLAGS.attack_warm_up:
+            attack_ids = self.train_attack_gen.get_attack_ids()
+            attack_ids += [aid for aid in self.test_attack_gen.get_attack_ids() if aid not in attack_ids]
+            warm_up_attacks(attack_ids, self.dataset.image_shape, self.dataset.num_labels, self.FLAGS.batch_size, run=self.FLAGS.attack_warm_up_run)
+        for m, l_namescope, l_file, pre in zip(self.model_lst, load_namescopes, load_files, prefetched):
+            m.load_checkpoint(l_file, self.sess, l_namescope, exclude_pattern=self.FLAGS.load_exclude, prefetched=pre)
         if self.FLAGS.test_only:
             if self.FLAGS.test_saltpepper is not None:
                 if isinstance(self.FLAGS.test_saltpepper, (tuple, list)):
@@ -418,8 +446,19 @@ class MutualTrainer(Trainer):
                 else:
                     self.test(saltpepper=self.FLAGS.test_saltpepper, name="loaded saltpepper_{}".format(self.FLAGS.test_saltpepper))
             self.test(adv=True, name="test_normal_adv")
+        self.ckpt_writer_lst = []
+        if self.FLAGS.async_save and self.FLAGS.train_dir:
+            retention = self.FLAGS.save_retention or {"keep_last": 10} # the same as `max_to_keep` of the savers
+            self.ckpt_writer_lst = [AsyncCheckpointWriter({v.op.name: v for v in model_vars}, retention=retention, name="model_{}".format(i))
+                                    for i, model_vars in enumerate(self.model_vars_lst)]
         utils.log("Start training...")
         self.train()
+        if self.ckpt_writer_lst:
+            utils.log("Waiting for the pending checkpoints to be written...")
+            [writer.close() for writer in self.ckpt_writer_lst]
+        if self.adv_store is not None:
+            utils.log("Waiting for the pending adversarial examples to be stored...")
+            self.adv_store.close()
 
         coord.request_stop()
         coord.join(threads)
@@ -23,7 +23,7 @@ def get_neg_through_grad(alpha):
         _registered_grad[reg_name] = 1
         @tf.RegisterGradient(reg_name)
         def _neg_through_grad(op, output_grad):
-            ones = tf.ones_like(op.inputs[0], dtype=tf.float32)
+            ones = tf.ones_like(op.inputs[0])
             # print(op.inputs[0])
             # return tf.where(op.inputs[0]>0., ones, tf.where(output_grad>0, tf.zeros_like(op.inputs[0], dtype=tf.float32), alpha*ones)) * output_grad # only pass negative gradient through relu when the activation is 0. let this unit to be more and more inactive, further away from being activated by chance at this input.
             return tf.where(op.inputs[0]>0., ones, alpha*ones) * output_grad # leaky relu backpropagate
@@ -81,3 +81,24 @@ def _coarse_dropout(x, keep_prob, div_h, div_w): # NCHW
 
 def coarse_dropout(x, keep_prob, div_h, div_w, training):
     return tf.cond(training, lambda: _coarse_dropout(x, keep_prob, div_h, div_w), lambda: x)
+
+def get_float32_regularization_loss(scope=None):
+    # the regularization losses of float16 models are float16
+    losses = tf.losses.get_regularization_losses(scope)
+    if not losses:
+        return tf.constant(0.)
+    return tf.add_n([tf.cast(l, tf.float32) for l in losses])
+
+def compute_scaled_gradients(optimizer, loss, loss_scale=1., **kwargs):
+    """
+    Compute the gradients of `loss * loss_scale` and unscale them, to avoid the underflow of float16 gradients.
+    """
+    if loss_scale == 1.:
+        return optimizer.compute_gradients(loss, **kwargs)
+    def _unscale(grad):
+        if grad is None:
+            return None
+        if isinstance(grad, tf.IndexedSlices):
+            return tf.IndexedSlices(grad.values / loss_scale, grad.indices, grad.dense_shape)
+        return grad / loss_scale
+    return [(_unscale(g), v) for g, v in optimizer.compute_gradients(loss * loss_scale, **kwargs)]